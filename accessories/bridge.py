@@ -0,0 +1,66 @@
+from pyhap.accessory import Bridge
+
+import metrics
+from accessories.loop_monitor import LoopMonitor
+from accessories.scheduler import Scheduler
+from accessories.zones import ZoneScheduler
+from timeseries import TimeSeriesStore
+
+
+class BrownBridge(Bridge):
+    """The Brown bridge, which also watches the lag of the event loop.
+
+    The timed jobs of the bridge run from one ``Scheduler``: the plant zones
+    of the ``ZoneScheduler`` instead of their own ``run`` loops, the history
+    flushes and those of every accessory with a ``schedule`` method, which
+    is called with the scheduler. With a ``history_dir`` their readings
+    and waterings are kept in the 'moisture' and 'watering' time series.
+    With a ``metrics_port`` the bridge's metrics, which include the loop
+    lag, are served on it as ``/metrics``, in the Prometheus text format;
+    without one the loop monitor is not started. With a ``timeline`` (see
+    boot.py) the startup is reported once the bridge runs, which is after
+    it has been advertised.
+    """
+
+    def __init__(self, *args, history_dir=None, metrics_port=None,
+                 timeline=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics_port = metrics_port
+        self.timeline = timeline
+        self._metrics_server = None
+        self.loop_monitor = LoopMonitor(self.driver)
+        self.history = []
+        if history_dir is not None:
+            self.history = [TimeSeriesStore(history_dir, 'moisture'),
+                            TimeSeriesStore(history_dir, 'watering')]
+        self.zones = ZoneScheduler(*self.history)
+        self.scheduler = Scheduler(self.driver)
+
+    def add_zone(self, sensor, switch, schedule=None):
+        self.zones.add_zone(sensor, switch, schedule)
+
+    async def run(self):
+        if self.timeline is not None:
+            self.timeline.mark('advertise')
+        if self.metrics_port is not None:
+            self._metrics_server = await metrics.serve(('', self.metrics_port))
+            self.driver.async_add_job(self.loop_monitor.run)
+        self.zones.schedule(self.scheduler)
+        for store in self.history:
+            store.schedule(self.scheduler)
+        for acc in self.accessories.values():
+            if acc not in self.zones:
+                if hasattr(acc, 'schedule'):
+                    acc.schedule(self.scheduler)
+                self.driver.async_add_job(acc.run)
+        self.driver.async_add_job(self.scheduler.run)
+        if self.timeline is not None:
+            self.timeline.mark('start')
+            self.timeline.report()
+
+    async def stop(self):
+        await super().stop()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+        for store in self.history:
+            await self.driver.async_add_job(store.flush)
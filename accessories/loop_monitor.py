@@ -0,0 +1,82 @@
+"""Event loop lag measurement for the bridge.
+
+Everything on the bridge shares the driver's event loop, so any blocking call
+delays HAP requests, stream setup and the watering switch alike. The monitor
+sleeps for a few seconds over and over and records how much later than asked
+it woke up. It only catches the stalls that overlap a wakeup, which is enough
+for the metrics without waking an idle bridge several times a second.
+"""
+import asyncio
+import logging
+
+from pyhap import util
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two lag samples
+LAG_INTERVAL = 5
+# Lag in seconds that is logged as a warning on its own
+LAG_WARNING = 0.1
+# Seconds between two summaries in the log
+LAG_REPORT_INTERVAL = 360
+
+LOOP_LAG = metrics.histogram('event_loop_lag_seconds',
+    'How much later than scheduled the event loop woke up')
+LOOP_STALLS = metrics.counter('event_loop_stalls_total',
+    'Event loop lags of at least the warning threshold')
+
+
+class LoopMonitor(object):
+    """Sample the lag of the driver's event loop until the driver stops."""
+
+    def __init__(self, driver, interval=LAG_INTERVAL, warning=LAG_WARNING,
+                 report_interval=LAG_REPORT_INTERVAL):
+        self.driver = driver
+        self.interval = interval
+        self.warning = warning
+        self.report_interval = report_interval
+        self.samples = 0
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+        self.stalls = 0
+        self._window_max = 0.0
+
+    def record(self, lag):
+        self.samples += 1
+        self.last = lag
+        self.total += lag
+        self.max = max(self.max, lag)
+        self._window_max = max(self._window_max, lag)
+        LOOP_LAG.observe(lag)
+        if lag >= self.warning:
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            logger.warning('Event loop blocked for %.3f s', lag)
+
+    def as_dict(self):
+        return {
+            'samples': self.samples,
+            'last': self.last,
+            'max': self.max,
+            'mean': self.total / self.samples if self.samples else 0.0,
+            'stalls': self.stalls,
+        }
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        report = loop.time() + self.report_interval
+        while True:
+            start = loop.time()
+            if await util.event_wait(self.driver.aio_stop_event, self.interval):
+                break
+            now = loop.time()
+            self.record(max(0.0, now - start - self.interval))
+            if now >= report:
+                logger.info('Event loop lag: max %.3f s in the last %d s '
+                    '(mean %.4f s, %d stalls overall)', self._window_max,
+                    self.report_interval, self.as_dict()['mean'], self.stalls)
+                self._window_max = 0.0
+                report = now + self.report_interval
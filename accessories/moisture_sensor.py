@@ -1,31 +1,38 @@
-import RPi.GPIO as GPIO
-
-from time import sleep
-from datetime import datetime
+from hardware import GPIO
 
 from pyhap.const import CATEGORY_SENSOR
-from pyhap.accessory import Accessory, Bridge
+from pyhap.accessory import Accessory
 
 SENSOR_PIN = 17
 RELAY_PIN = 26
+# Seconds between two readings of the sensors
+SAMPLE_INTERVAL = 360
+# Seconds the sensor is powered through the relay before it is read
+SETTLE_TIME = 2
 
 class MoistureSensor(Accessory):
+    """A moisture sensor, read by the bridge's ``ZoneScheduler``.
+
+    A sensor outside of a bridge's zones samples itself from ``run``,
+    through a ``ZoneScheduler`` of its own.
+    """
 
     category = CATEGORY_SENSOR
 
-    def __init__(self, *args, **kwargs): 
+    def __init__(self, *args, sensor_pin=SENSOR_PIN, relay_pin=RELAY_PIN, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self._pin_number = SENSOR_PIN
-        self._relay_pin_number = RELAY_PIN
+        self._zones = None
+        self.sensor_pin = sensor_pin
+        self.relay_pin = relay_pin
         GPIO.setwarnings(False)
 
         if GPIO.getmode() is None:
             GPIO.setmode(GPIO.BCM)
         
-        GPIO.setup(self._pin_number,GPIO.IN)
-        if self._relay_pin_number != 0:
-            GPIO.setup(self._relay_pin_number, 
+        GPIO.setup(self.sensor_pin,GPIO.IN)
+        if self.relay_pin != 0:
+            GPIO.setup(self.relay_pin, 
                 GPIO.OUT, 
                 initial=GPIO.HIGH
             )
@@ -33,21 +40,11 @@ class MoistureSensor(Accessory):
         serv_humidity = self.add_preload_service('HumiditySensor')
         self.char_humidity = serv_humidity.configure_char('CurrentRelativeHumidity')
 
-    @Accessory.run_at_interval(360)
+    @Accessory.run_at_interval(SAMPLE_INTERVAL)
     async def run(self):
-        if self._relay_pin_number != 0:
-            GPIO.output(self._relay_pin_number, GPIO.LOW)
-            sleep(2)
-
-        dry = GPIO.input(self._pin_number)
-
-        if self._relay_pin_number != 0:
-            GPIO.output(self._relay_pin_number, GPIO.HIGH)
-
-        self.char_humidity.set_value(0 if dry else 100)
-
-        with open("/home/pi/brown/logs/log.txt", "a") as file_object:
-            # Append 'hello' at the end of file
-            date_stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-            text = ("DRY" if dry else "NOT DRY")
-            file_object.write(f"{date_stamp}:{text}\n")
\ No newline at end of file
+        if self._zones is None:
+            # zones.py imports this module for its timings
+            from accessories.zones import ZoneScheduler
+            self._zones = ZoneScheduler()
+            self._zones.add_sensor(self)
+        await self._zones.sample()
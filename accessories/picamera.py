@@ -1,17 +1,23 @@
 import logging
 import asyncio
-import struct
 import os
+import threading
 
 from uuid import UUID
-from time import sleep
+from functools import partial
+from time import sleep, monotonic
 from io import BytesIO
 from datetime import datetime
-from picamera import PiCamera
-from pyhap import tlv
+from hardware import PiCamera
 from pyhap.camera import Camera
 from pyhap.accessory import Accessory
 from pyhap.util import to_base64_str, byte_bool
+import broker
+import metrics
+from accessories.timelapse import Timelapse
+from accessories.stream_encoder import EncoderManager
+from accessories.tlv_schema import (SelectedStreamConfiguration,
+    SetupEndpointsRequest, setup_endpoints_template)
 
 SETUP_TYPES = {
     'SESSION_ID': b'\x01',
@@ -204,6 +210,31 @@ VIDEO_CODEC_PARAM_LEVEL_VALUES = {
         b'\x02': '4.0'
 }
 
+# Resolution the snapshot camera is opened with, snapshots are resized from it
+SNAPSHOT_RESOLUTION = (1280, 720)
+# Seconds a cached snapshot is served before a new one is taken
+SNAPSHOT_TTL = 10
+# Stream configuration of the pre-warmed encoder, updated from
+# options['prewarm'] when that is a dict. This is what the Home app asks for
+# on a local network; the encoder then follows the most requested one.
+PREWARM_STREAM_CONFIG = {
+    'width': 1280,
+    'height': 720,
+    'fps': 30,
+    'v_max_bitrate': 299,
+    'a_max_bitrate': 24,
+    'a_channel': 1,
+    'a_sample_rate': 24,
+}
+
+SNAPSHOT_LATENCY = metrics.histogram('hap_snapshot_seconds',
+    'Time to answer a snapshot request, cached or not')
+STREAM_SESSIONS = metrics.gauge('hap_stream_sessions',
+    'Stream sessions attached to an encoder')
+ENCODER_UPTIME = metrics.gauge('ffmpeg_uptime_seconds',
+    'Seconds since the encoder of a stream configuration was started',
+    ['config'])
+
 logging.basicConfig(level=logging.INFO, format="[%(module)s] %(message)s")
 
 logger = logging.getLogger(__name__)
@@ -212,149 +243,346 @@ logger = logging.getLogger(__name__)
 class BrownCamera(Camera):
     def __init__(self, options, *args, **kwargs):
         super().__init__(options, *args, **kwargs)
-
-    def get_snapshot(self, image_size):  # pylint: disable=unused-argument, no-self-use
+        self.snapshot_ttl = options.get('snapshot_ttl', SNAPSHOT_TTL)
+        # Resolution the camera broker records at, if the camera is opened
+        # by the broker rather than by this process
+        self.broker = options.get('broker')
+        # Leave the camera alone until the first snapshot or stream
+        self.lazy = options.get('lazy', False)
+        self._cam = None
+        self._cam_lock = threading.Lock()
+        # Streams being started, which the camera is kept closed for
+        self._handovers = 0
+        self._snapshots = {}
+        # Encoders are shared by all sessions with the same configuration
+        feed = None
+        if self.broker:
+            feed = partial(broker.feed, broker.ring_name('h264', self.broker))
+        self.encoders = EncoderManager(self.start_stream_cmd,
+            self._prewarm_config(options), feed)
+        timelapse = options.get('timelapse')
+        self.timelapse = Timelapse(self, **timelapse) if timelapse else None
+        self._endpoints_response = setup_endpoints_template(
+            self.stream_address, self.stream_address_isv6,
+            SRTP_CRYPTO_SUITES['AES_CM_128_HMAC_SHA1_80'] if self.has_srtp else None,
+            NO_SRTP)
+        STREAM_SESSIONS.set_function(self._active_sessions)
+        ENCODER_UPTIME.set_function(self._encoder_uptimes)
+
+    def _active_sessions(self):
+        return sum('encoder' in session for session in list(self.sessions.values()))
+
+    def _encoder_uptimes(self):
+        return {'%(width)sx%(height)s@%(fps)s' % encoder.config:
+                    encoder.stats.as_dict()['uptime']
+                for encoder in list(self.encoders.encoders.values())}
+
+    @staticmethod
+    def _prewarm_config(options):
+        """Return the stream configuration to keep warm, None if disabled."""
+        prewarm = options.get('prewarm')
+        if not prewarm:
+            return None
+        config = dict(PREWARM_STREAM_CONFIG)
+        resolutions = options['video']['resolutions']
+        if [config['width'], config['height'], config['fps']] not in resolutions:
+            config['width'], config['height'], config['fps'] = resolutions[0]
+        if isinstance(prewarm, dict):
+            config.update(prewarm)
+        return config
+
+    def _get_camera(self):
+        """Return the long-lived camera, opening and warming it up if needed.
+
+        Must be called with ``self._cam_lock`` held.
+        """
+        if self._cam is None:
+            self._cam = PiCamera(resolution=SNAPSHOT_RESOLUTION)
+            # Let the sensor settle its gain and white balance once
+            sleep(1)
+        return self._cam
+
+    def _release_camera(self, hand_over=False):
+        """Close the long-lived camera. With ``hand_over`` it stays closed,
+        until ``_end_hand_over``, for an encoder about to open the sensor."""
+        with self._cam_lock:
+            if hand_over:
+                self._handovers += 1
+            if self._cam is not None:
+                self._cam.close()
+                self._cam = None
+
+    def _end_hand_over(self):
+        with self._cam_lock:
+            self._handovers -= 1
+
+    def _camera_busy(self):
+        # Whether ffmpeg holds, or is about to hold, the sensor through v4l2
+        return bool(self._handovers or self.sessions or self.encoders.encoders)
+
+    def _only_warm(self):
+        # Whether the only encoders running are idle pre-warmed ones
+        return bool(self.encoders.encoders) and not (self._handovers
+            or self.sessions or any(encoder.sessions
+                for encoder in self.encoders.encoders.values()))
+
+    def _newest_snapshot(self, size):
+        """Return the last snapshot of ``size``, else the newest of any size."""
+        if size in self._snapshots:
+            return self._snapshots[size][1]
+        if self._snapshots:
+            return max(self._snapshots.values(), key=lambda cached: cached[0])[1]
+        return None
+
+    def _cached_snapshot(self, size, max_age):
+        cached = self._snapshots.get(size)
+        if cached and monotonic() - cached[0] <= max_age:
+            return cached[1]
+        return None
+
+    def get_snapshot(self, image_size, keep_open=True):
         """Return a jpeg of a snapshot from the camera.
 
-        Overwrite to implement getting snapshots from your camera.
+        Snapshots are taken from the video port of a camera that stays open
+        and are cached per size for ``snapshot_ttl`` seconds. While a stream
+        holds the camera (including the pre-warmed encoder) it is never
+        opened: the last snapshot of that size, or else the newest of any
+        size, is returned instead, and IOError raised if there is none.
+        ``async_get_snapshot`` pauses an idle pre-warmed encoder instead.
+        With the camera broker, snapshots are its newest frame, at its
+        resolution.
 
         :param image_size: ``dict`` describing the requested image size. Contains the
             keys "image-width" and "image-height"
+        :param keep_open: whether to keep the camera open for the next
+            snapshot if it had to be opened for this one.
         """
-        with open(os.path.join('./', 'snapshot.jpg'), 'rb') as fp:
-            return fp.read()
-
-    def get_snapshot(self, image_size):
-        with BytesIO() as stream:
-            with PiCamera() as cam:
-                cam.resolution = (image_size['image-width'], image_size['image-height'])
-                cam.start_preview()
-                sleep(1)
-                cam.capture(stream, format='jpeg')
-                stream.seek(0)
-                return stream.read()
-        return 
-    
+        size = (image_size['image-width'], image_size['image-height'])
+        if self.broker:
+            snapshot = broker.latest_frame(broker.ring_name('mjpeg', self.broker))
+            if snapshot is None:
+                raise IOError('The camera broker has no frame')
+            self._snapshots[size] = (monotonic(), snapshot)
+            return snapshot
+        with self._cam_lock:
+            # Another thread may have taken it while this one was waiting
+            snapshot = self._cached_snapshot(size, self.snapshot_ttl)
+            if snapshot is None and self._camera_busy():
+                snapshot = self._newest_snapshot(size)
+                if snapshot is None:
+                    raise IOError('The camera is streaming and there is no '
+                        'snapshot yet')
+            if snapshot is None:
+                opened = self._cam is None
+                with BytesIO() as stream:
+                    self._get_camera().capture(stream, format='jpeg',
+                        use_video_port=True, resize=size)
+                    snapshot = stream.getvalue()
+                self._snapshots[size] = (monotonic(), snapshot)
+                if opened and not keep_open:
+                    self._cam.close()
+                    self._cam = None
+        return snapshot
+
+    async def async_get_snapshot(self, image_size, keep_open=True):
+        """Return a cached snapshot right away, or take one off the event loop.
+
+        If nobody is watching the pre-warmed encoder, it is stopped while
+        the snapshot is taken, and started again once the camera is closed.
+        """
+        started = monotonic()
+        size = (image_size['image-width'], image_size['image-height'])
+        snapshot = self._cached_snapshot(size, self.snapshot_ttl)
+        loop = asyncio.get_running_loop()
+        if snapshot is None and not self.broker and self._only_warm():
+            async with self.encoders.paused():
+                snapshot = await loop.run_in_executor(
+                    None, partial(self.get_snapshot, image_size, False))
+        elif snapshot is None:
+            snapshot = await loop.run_in_executor(
+                None, partial(self.get_snapshot, image_size, keep_open))
+        SNAPSHOT_LATENCY.observe(monotonic() - started)
+        return snapshot
+
     async def start_stream(self, session_info, stream_config):
-  
+
+        # The stream reads the sensor through v4l2, so hand it over
+        await asyncio.get_running_loop().run_in_executor(
+            None, partial(self._release_camera, hand_over=True))
+
         logger.info(
             '[%s] Starting stream with the following parameters: %s',
             session_info['id'],
             stream_config
         )
 
-        cmd = self.start_stream_cmd.format(**stream_config).split()
-        logger.info('Executing start stream command: "%s"', ' '.join(cmd))
         try:
-            process = await asyncio.create_subprocess_exec(*cmd,
-                    stdout=asyncio.subprocess.DEVNULL,
-                    stderr=asyncio.subprocess.PIPE,
-                    limit=1024)
-
+            encoder = await self.encoders.attach(session_info, stream_config)
         except Exception as e:  # pylint: disable=broad-except
             logger.error('Failed to start streaming process because of error: %s', e)
             return False
-
-        session_info['process'] = process
+        finally:
+            self._end_hand_over()
 
         logger.info(
-            '[%s] Started stream process - PID %d',
+            '[%s] Attached stream to encoder %s (%d sessions)',
             session_info['id'],
-            process.pid
+            encoder.key,
+            encoder.sessions
         )
 
         return True
     
-    async def _start_stream(self, objs, reconfigure):  # pylint: disable=unused-argument
-        """Start or reconfigure video streaming for the given session.
+    async def reconfigure_stream(self, session_info, stream_config):
+        """Apply a new resolution or bitrate to a running stream.
 
-        Schedules ``self.start_stream`` or ``self.reconfigure``.
+        The session moves to the encoder for the new configuration, without a
+        gap in the video where the camera allows it, see
+        ``EncoderManager.reconfigure``.
+        """
+        logger.info(
+            '[%s] Reconfiguring stream with the following parameters: %s',
+            session_info['id'],
+            stream_config
+        )
+
+        try:
+            encoder = await self.encoders.reconfigure(session_info, stream_config)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error('Failed to reconfigure stream because of error: %s', e)
+            return False
 
-        No support for reconfigure currently.
+        return encoder is not None
+
+    def get_stream_metrics(self, session_id):
+        """Return the live encoder metrics of a streaming session, or None."""
+        session_info = self.sessions.get(session_id)
+        encoder = session_info and session_info.get('encoder')
+        if encoder is None:
+            return None
+        stream_metrics = encoder.session_metrics(session_id)
+        stream_metrics['adapt_time'] = session_info.get('adapt_time')
+        stream_metrics['first_packet_time'] = session_info.get('first_packet_time')
+        return stream_metrics
+
+    def set_selected_stream_configuration(self, value):
+        """Set the selected stream configuration.
+
+        Called from iOS to set the SelectedRTPStreamConfiguration ``Characteristic``.
+
+        The value is decoded once with the schema and the stream for the
+        session is scheduled to be started, stopped or reconfigured.
+
+        :param value: base64-encoded selected configuration in TLV format
+        :type value: ``str``
+        """
+        logger.debug('set_selected_stream_config - value - %s', value)
+
+        config = SelectedStreamConfiguration.from_base64(value)
+        if config.session is None:
+            logger.error('Bad request to set selected stream configuration.')
+            return
+
+        request_type = config.session.command
+        logger.debug('Set stream config request: %s', request_type)
+        if request_type == 1:
+            job = partial(self._start_stream, reconfigure=False)
+        elif request_type == 0:
+            job = self._stop_stream
+        elif request_type == 4:
+            job = partial(self._start_stream, reconfigure=True)
+        else:
+            logger.error('Unknown request type %s', request_type)
+            return
 
-        :param objs: TLV-decoded SelectedRTPStreamConfiguration
-        :type objs: ``dict``
+        self.driver.add_job(job, config)
+
+    async def _stop_stream(self, config):
+        """Stop the stream for the specified session.
+
+        Schedules ``self.stop_stream``.
+
+        :param config: Decoded SelectedRTPStreamConfiguration
+        :type config: ``SelectedStreamConfiguration``
+        """
+        session_id = UUID(bytes=config.session.session_id)
+
+        session_info = self.sessions.get(session_id)
+        if not session_info:
+            logger.error(
+                'Requested to stop stream for session %s, but no '
+                'such session was found',
+                session_id
+            )
+            return
+
+        stream_idx = session_info['stream_idx']
+        await self.stop_stream(session_info)
+        del self.sessions[session_id]
+
+        self._streaming_status[stream_idx] = STREAMING_STATUS['AVAILABLE']
+
+    async def _start_stream(self, config, reconfigure):  # pylint: disable=unused-argument
+        """Start or reconfigure video streaming for the given session.
+
+        Schedules ``self.start_stream`` or ``self.reconfigure_stream``.
+
+        :param config: Decoded SelectedRTPStreamConfiguration
+        :type config: ``SelectedStreamConfiguration``
 
         :param reconfigure: Whether the stream should be reconfigured instead of
             started.
         :type reconfigure: bool
         """
-        video_tlv = objs.get(SELECTED_STREAM_CONFIGURATION_TYPES['VIDEO'])
-        audio_tlv = objs.get(SELECTED_STREAM_CONFIGURATION_TYPES['AUDIO'])
-
         opts = {}
 
-        if video_tlv:
-            video_objs = tlv.decode(video_tlv)
-
-            video_codec_params = video_objs.get(VIDEO_TYPES['CODEC_PARAM'])
+        video = config.video
+        if video:
+            video_codec_params = video.codec_params
             if video_codec_params:
-                video_codec_param_objs = tlv.decode(video_codec_params)
                 opts['v_profile_id'] = \
-                    VIDEO_CODEC_PARAM_PROFILE_VALUES[video_codec_param_objs[VIDEO_CODEC_PARAM_TYPES['PROFILE_ID']]]
+                    VIDEO_CODEC_PARAM_PROFILE_VALUES[video_codec_params.profile_id]
                 opts['v_level'] = \
-                    VIDEO_CODEC_PARAM_LEVEL_VALUES[video_codec_param_objs[VIDEO_CODEC_PARAM_TYPES['LEVEL']]]
+                    VIDEO_CODEC_PARAM_LEVEL_VALUES[video_codec_params.level]
 
-            video_attrs = video_objs.get(VIDEO_TYPES['ATTRIBUTES'])
+            video_attrs = video.attributes
             if video_attrs:
-                video_attr_objs = tlv.decode(video_attrs)
-                opts['width'] = struct.unpack('<H',
-                            video_attr_objs[VIDEO_ATTRIBUTES_TYPES['IMAGE_WIDTH']])[0]
-                opts['height'] = struct.unpack('<H',
-                            video_attr_objs[VIDEO_ATTRIBUTES_TYPES['IMAGE_HEIGHT']])[0]
-                opts['fps'] = struct.unpack('<B',
-                                video_attr_objs[VIDEO_ATTRIBUTES_TYPES['FRAME_RATE']])[0]
-
-            video_rtp_param = video_objs.get(VIDEO_TYPES['RTP_PARAM'])
+                opts['width'] = video_attrs.width
+                opts['height'] = video_attrs.height
+                opts['fps'] = video_attrs.fps
+
+            video_rtp_param = video.rtp_params
             if video_rtp_param:
-                video_rtp_param_objs = tlv.decode(video_rtp_param)
-                if RTP_PARAM_TYPES['SYNCHRONIZATION_SOURCE'] in video_rtp_param_objs:
-                    opts['v_ssrc'] = struct.unpack('<I',
-                        video_rtp_param_objs.get(
-                            RTP_PARAM_TYPES['SYNCHRONIZATION_SOURCE']))[0]
-                if RTP_PARAM_TYPES['PAYLOAD_TYPE'] in video_rtp_param_objs:
-                    opts['v_payload_type'] = \
-                        video_rtp_param_objs.get(RTP_PARAM_TYPES['PAYLOAD_TYPE'])
-                if RTP_PARAM_TYPES['MAX_BIT_RATE'] in video_rtp_param_objs:
-                    opts['v_max_bitrate'] = struct.unpack('<H',
-                        video_rtp_param_objs.get(RTP_PARAM_TYPES['MAX_BIT_RATE']))[0]
-                if RTP_PARAM_TYPES['RTCP_SEND_INTERVAL'] in video_rtp_param_objs:
-                    opts['v_rtcp_interval'] = struct.unpack('<f',
-                        video_rtp_param_objs.get(RTP_PARAM_TYPES['RTCP_SEND_INTERVAL']))[0]
-                if RTP_PARAM_TYPES['MAX_MTU'] in video_rtp_param_objs:
-                    opts['v_max_mtu'] = video_rtp_param_objs.get(RTP_PARAM_TYPES['MAX_MTU'])
-
-        if audio_tlv:
-            audio_objs = tlv.decode(audio_tlv)
-
-            opts['a_codec'] = audio_objs[AUDIO_TYPES['CODEC']]
-            audio_codec_param_objs = tlv.decode(
-                                        audio_objs[AUDIO_TYPES['CODEC_PARAM']])
-            audio_rtp_param_objs = tlv.decode(
-                                        audio_objs[AUDIO_TYPES['RTP_PARAM']])
-            opts['a_comfort_noise'] = audio_objs[AUDIO_TYPES['COMFORT_NOISE']]
-
-            opts['a_channel'] = \
-                audio_codec_param_objs[AUDIO_CODEC_PARAM_TYPES['CHANNEL']][0]
-            opts['a_bitrate'] = struct.unpack('?',
-                audio_codec_param_objs[AUDIO_CODEC_PARAM_TYPES['BIT_RATE']])[0]
-            opts['a_sample_rate'] = 8 * (
-                1 + audio_codec_param_objs[AUDIO_CODEC_PARAM_TYPES['SAMPLE_RATE']][0])
-            opts['a_packet_time'] = struct.unpack('<B',
-                audio_codec_param_objs[AUDIO_CODEC_PARAM_TYPES['PACKET_TIME']])[0]
-
-            opts['a_ssrc'] = struct.unpack('<I',
-                audio_rtp_param_objs[RTP_PARAM_TYPES['SYNCHRONIZATION_SOURCE']])[0]
-            opts['a_payload_type'] = audio_rtp_param_objs[RTP_PARAM_TYPES['PAYLOAD_TYPE']]
-            opts['a_max_bitrate'] = struct.unpack('<H',
-                audio_rtp_param_objs[RTP_PARAM_TYPES['MAX_BIT_RATE']])[0]
-            opts['a_rtcp_interval'] = struct.unpack('<f',
-                audio_rtp_param_objs[RTP_PARAM_TYPES['RTCP_SEND_INTERVAL']])[0]
+                for key, value in (
+                        ('v_ssrc', video_rtp_param.ssrc),
+                        ('v_payload_type', video_rtp_param.payload_type),
+                        ('v_max_bitrate', video_rtp_param.max_bitrate),
+                        ('v_rtcp_interval', video_rtp_param.rtcp_interval),
+                        ('v_max_mtu', video_rtp_param.max_mtu)):
+                    if value is not None:
+                        opts[key] = value
+
+        audio = config.audio
+        if audio:
+            audio_codec_params = audio.codec_params
+            audio_rtp_param = audio.rtp_params
+
+            opts['a_codec'] = audio.codec
+            opts['a_comfort_noise'] = audio.comfort_noise
+
+            opts['a_channel'] = audio_codec_params.channel
+            opts['a_bitrate'] = audio_codec_params.bitrate
+            opts['a_sample_rate'] = 8 * (1 + audio_codec_params.sample_rate)
+            opts['a_packet_time'] = audio_codec_params.packet_time
+
+            opts['a_ssrc'] = audio_rtp_param.ssrc
+            opts['a_payload_type'] = audio_rtp_param.payload_type
+            opts['a_max_bitrate'] = audio_rtp_param.max_bitrate
+            opts['a_rtcp_interval'] = audio_rtp_param.rtcp_interval
             opts['a_comfort_payload_type'] = \
-                audio_rtp_param_objs[RTP_PARAM_TYPES['COMFORT_NOISE_PAYLOAD_TYPE']]
+                audio_rtp_param.comfort_noise_payload_type
 
-        session_objs = tlv.decode(objs[SELECTED_STREAM_CONFIGURATION_TYPES['SESSION']])
-        session_id = UUID(bytes=session_objs[SETUP_TYPES['SESSION_ID']])
+        session_id = UUID(bytes=config.session.session_id)
         session_info = self.sessions[session_id]
         stream_idx = session_info['stream_idx']
 
@@ -384,33 +612,18 @@ class BrownCamera(Camera):
         if stream_idx is None:
             stream_idx = 0
 
-        objs = tlv.decode(value, from_base64=True)
-        session_id = UUID(bytes=objs[SETUP_TYPES['SESSION_ID']])
+        request = SetupEndpointsRequest.from_base64(value)
+        session_id = UUID(bytes=request.session_id)
 
         # Extract address info
-        address_tlv = objs[SETUP_TYPES['ADDRESS']]
-        address_info_objs = tlv.decode(address_tlv)
-        is_ipv6 = struct.unpack('?',
-            address_info_objs[SETUP_ADDR_INFO['ADDRESS_VER']])[0]
-        address = address_info_objs[SETUP_ADDR_INFO['ADDRESS']].decode('utf8')
-        target_video_port = struct.unpack(
-            '<H', address_info_objs[SETUP_ADDR_INFO['VIDEO_RTP_PORT']])[0]
-        target_audio_port = struct.unpack(
-            '<H', address_info_objs[SETUP_ADDR_INFO['AUDIO_RTP_PORT']])[0]
-
-        # Video SRTP Params
-        video_srtp_tlv = objs[SETUP_TYPES['VIDEO_SRTP_PARAM']]
-        video_info_objs = tlv.decode(video_srtp_tlv)
-        video_crypto_suite = video_info_objs[SETUP_SRTP_PARAM['CRYPTO']][0]
-        video_master_key = video_info_objs[SETUP_SRTP_PARAM['MASTER_KEY']]
-        video_master_salt = video_info_objs[SETUP_SRTP_PARAM['MASTER_SALT']]
-
-        # Audio SRTP Params
-        audio_srtp_tlv = objs[SETUP_TYPES['AUDIO_SRTP_PARAM']]
-        audio_info_objs = tlv.decode(audio_srtp_tlv)
-        audio_crypto_suite = audio_info_objs[SETUP_SRTP_PARAM['CRYPTO']][0]
-        audio_master_key = audio_info_objs[SETUP_SRTP_PARAM['MASTER_KEY']]
-        audio_master_salt = audio_info_objs[SETUP_SRTP_PARAM['MASTER_SALT']]
+        address_info = request.address
+        address = address_info.address
+        target_video_port = address_info.video_port
+        target_audio_port = address_info.audio_port
+
+        # Video and audio SRTP Params
+        video_srtp = request.video_srtp
+        audio_srtp = request.audio_srtp
 
         logger.info(
             'Received endpoint configuration:'
@@ -418,103 +631,83 @@ class BrownCamera(Camera):
             '\ntarget_video_port: %s\ntarget_audio_port: %s'
             '\nvideo_crypto_suite: %s\nvideo_srtp: %s'
             '\naudio_crypto_suite: %s\naudio_srtp: %s',
-            session_id, address, is_ipv6, target_video_port, target_audio_port,
-            video_crypto_suite,
-            to_base64_str(video_master_key + video_master_salt),
-            audio_crypto_suite,
-            to_base64_str(audio_master_key + audio_master_salt)
+            session_id, address, address_info.is_ipv6,
+            target_video_port, target_audio_port,
+            video_srtp.crypto_suite,
+            to_base64_str(video_srtp.master_key + video_srtp.master_salt),
+            audio_srtp.crypto_suite,
+            to_base64_str(audio_srtp.master_key + audio_srtp.master_salt)
         )
 
         # Configure the SetupEndpoints response
 
-        if self.has_srtp:
-            video_srtp_tlv = tlv.encode(
-                SETUP_SRTP_PARAM['CRYPTO'], SRTP_CRYPTO_SUITES['AES_CM_128_HMAC_SHA1_80'],
-                SETUP_SRTP_PARAM['MASTER_KEY'], video_master_key,
-                SETUP_SRTP_PARAM['MASTER_SALT'], video_master_salt)
-
-            audio_srtp_tlv = tlv.encode(
-                SETUP_SRTP_PARAM['CRYPTO'], SRTP_CRYPTO_SUITES['AES_CM_128_HMAC_SHA1_80'],
-                SETUP_SRTP_PARAM['MASTER_KEY'], audio_master_key,
-                SETUP_SRTP_PARAM['MASTER_SALT'], audio_master_salt)
-        else:
-            video_srtp_tlv = NO_SRTP
-            audio_srtp_tlv = NO_SRTP
-
         video_ssrc = int.from_bytes(os.urandom(3), byteorder="big")
         audio_ssrc = int.from_bytes(os.urandom(3), byteorder="big")
 
-        res_address_tlv = tlv.encode(
-            SETUP_ADDR_INFO['ADDRESS_VER'], self.stream_address_isv6,
-            SETUP_ADDR_INFO['ADDRESS'], self.stream_address.encode('utf-8'),
-            SETUP_ADDR_INFO['VIDEO_RTP_PORT'], struct.pack('<H', target_video_port),
-            SETUP_ADDR_INFO['AUDIO_RTP_PORT'], struct.pack('<H', target_audio_port))
-
-        response_tlv = tlv.encode(
-            SETUP_TYPES['SESSION_ID'], session_id.bytes,
-            SETUP_TYPES['STATUS'], SETUP_STATUS['SUCCESS'],
-            SETUP_TYPES['ADDRESS'], res_address_tlv,
-            SETUP_TYPES['VIDEO_SRTP_PARAM'], video_srtp_tlv,
-            SETUP_TYPES['AUDIO_SRTP_PARAM'], audio_srtp_tlv,
-            SETUP_TYPES['VIDEO_SSRC'], struct.pack('<I', video_ssrc),
-            SETUP_TYPES['AUDIO_SSRC'], struct.pack('<I', audio_ssrc),
-            to_base64=True)
+        srtp_keys = {}
+        if self.has_srtp:
+            srtp_keys = {
+                'video_master_key': video_srtp.master_key,
+                'video_master_salt': video_srtp.master_salt,
+                'audio_master_key': audio_srtp.master_key,
+                'audio_master_salt': audio_srtp.master_salt,
+            }
+
+        response_tlv = self._endpoints_response.render(
+            to_base64=True,
+            session_id=request.session_id,
+            status=SETUP_STATUS['SUCCESS'],
+            video_port=target_video_port,
+            audio_port=target_audio_port,
+            video_ssrc=video_ssrc,
+            audio_ssrc=audio_ssrc,
+            **srtp_keys)
 
         self.sessions[session_id] = {
             'id': session_id,
             'stream_idx': stream_idx,
             'address': address,
             'v_port': target_video_port,
-            'v_srtp_key': to_base64_str(video_master_key + video_master_salt),
+            'v_srtp_key': to_base64_str(video_srtp.master_key + video_srtp.master_salt),
             'v_ssrc': video_ssrc,
             'a_port': target_audio_port,
-            'a_srtp_key': to_base64_str(audio_master_key + audio_master_salt),
+            'a_srtp_key': to_base64_str(audio_srtp.master_key + audio_srtp.master_salt),
             'a_ssrc': audio_ssrc
         }
 
         self._management[stream_idx].get_characteristic('SetupEndpoints').set_value(response_tlv)
 
+    def schedule(self, scheduler):
+        """Take the timelapse stills from the bridge's ``Scheduler``, the
+        first one after an interval when lazy."""
+        if self.timelapse is not None:
+            self.timelapse.schedule(scheduler,
+                self.timelapse.interval if self.lazy else 0)
+
+    async def run(self):
+        """Start the pre-warmed encoder, if enabled and not lazy. When lazy,
+        it starts once the first stream is over."""
+        if self.encoders.prewarm is not None and not self.lazy:
+            await asyncio.get_running_loop().run_in_executor(
+                None, partial(self._release_camera, hand_over=True))
+            try:
+                await self.encoders.warm()
+            finally:
+                self._end_hand_over()
+
     async def stop(self):
         """Stop all streaming sessions."""
+        self.encoders.prewarm = None
         await asyncio.gather(*(
         self.stop_stream(session_info) for session_info in self.sessions.values()), return_exceptions=True)
+        await self.encoders.stop()
+        if self.timelapse is not None:
+            await self.timelapse.close()
+        self._release_camera()
     
     async def stop_stream(self, session_info):  # pylint: disable=no-self-use
 
         session_id = session_info['id']
-        # self._cam.stop_recording()
-        ffmpeg_process = session_info.get('process')
-        if ffmpeg_process:
-            logger.info('[%s] Stopping stream.', session_id)
-            try:
-                ffmpeg_process.terminate()
-                _, stderr = await asyncio.wait_for(
-                    ffmpeg_process.communicate(), timeout=2.0)
-                logger.debug('Stream command stderr: %s', stderr)
-            except asyncio.TimeoutError:
-                logger.error(
-                    'Timeout while waiting for the stream process '
-                    'to terminate. Trying with kill.'
-                )
-                ffmpeg_process.kill()
-                await ffmpeg_process.wait()
-            logger.debug('Stream process stopped.')
-        else:
-            logger.warning('No process for session ID %s', session_id)
-        
-    # @Accessory.run_at_interval(60)
-    # async def save_snapshot(self):
-    #     # date_stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    #     self._cam.resolution = (1640, 1232)
-    #     self._cam.start_preview()
-    #     sleep(5)
-    #     self._cam.capture(f"/home/pi/brown/images/1.jpg")
-    #     self._cam.stop_preview()
-
-    # def start_record(self, file_name):
-    #     self._cam.start_recording(file_name)
-    #     return
-    
-    # def stop_record(self):
-    #     self._cam.stop_recording()
-    #     return
\ No newline at end of file
+        logger.info('[%s] Stopping stream.', session_id)
+        if not await self.encoders.detach(session_info):
+            logger.warning('No encoder for session ID %s', session_id)
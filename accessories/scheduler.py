@@ -0,0 +1,257 @@
+"""One timer for all the timed jobs of the bridge.
+
+Jobs run at an interval (``every``), on a cron schedule (``cron``) or once
+(``at``). They are kept in a heap ordered by their next run and the
+scheduler sleeps until the first one is due, instead of every job waking up
+on its own. Coroutine functions run as tasks on the driver's loop, other
+functions in its executor. A job still running when it is due again skips
+that run.
+
+Cron and one-shot jobs follow the wall clock. While there are any, the
+scheduler also wakes up every ``CLOCK_CHECK_INTERVAL`` seconds, so their
+times stay exact when the clock is set, as NTP does after the Pi boots. A
+cron run the clock jumped past is skipped rather than run late: the Pi
+boots with the time it was switched off at, so a schedule passed during a
+power cut would otherwise water the plants as soon as NTP answers.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+
+from datetime import datetime, timedelta
+from functools import partial
+from time import monotonic, time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two checks of the wall clock while wall clock jobs wait
+CLOCK_CHECK_INTERVAL = 60
+# Days searched for the next time matching a cron schedule
+CRON_HORIZON = 5 * 366
+
+
+class CronSchedule(object):
+    """The five fields of a crontab line: minute, hour, day of the month,
+    month and day of the week (0 or 7 is Sunday).
+
+    Every field is ``*`` or a list of values and ``a-b`` ranges, each
+    optionally with a ``/step``. As in cron, when both days are restricted
+    a day matching either one matches.
+    """
+
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != len(self.RANGES):
+            raise ValueError('A cron schedule has 5 fields: %r' % spec)
+        self.spec = spec
+        (self.minutes, self.hours, self.days, self.months,
+         weekdays) = [self._parse(field, *limits)
+                      for field, limits in zip(fields, self.RANGES)]
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            span, _, step = part.partition('/')
+            if span == '*':
+                first, last = low, high
+            elif '-' in span:
+                first, last = (int(value) for value in span.split('-', 1))
+            else:
+                first = last = int(span)
+            step = int(step) if step else 1
+            if not low <= first <= last <= high or step < 1:
+                raise ValueError('Bad cron field %r' % field)
+            values.update(range(first, last + 1, step))
+        return values
+
+    def _matches_day(self, day):
+        in_month = day.day in self.days
+        in_week = day.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_month and in_week
+        return in_month or in_week
+
+    def next_after(self, timestamp):
+        """Return the timestamp of the first minute after ``timestamp``
+        matching the schedule, in local time."""
+        start = datetime.fromtimestamp(timestamp).replace(second=0,
+            microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        for _ in range(CRON_HORIZON):
+            if day.month in self.months and self._matches_day(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        moment = day.replace(hour=hour, minute=minute)
+                        if moment >= start:
+                            return moment.timestamp()
+            day += timedelta(days=1)
+        raise ValueError('%r never matches' % self.spec)
+
+
+class Job(object):
+    """A scheduled call, see ``Scheduler``."""
+
+    def __init__(self, func, args, name=None, interval=None, cron=None,
+                 when=None):
+        self.func = func
+        self.args = args
+        self.name = name or getattr(func, '__qualname__', repr(func))
+        self.interval = interval
+        self.cron = cron
+        # Wall clock time of the next run of cron and one-shot jobs
+        self.when = when
+        # Monotonic time of the next run, None once the job is done
+        self.deadline = None
+        self.cancelled = False
+        self.runs = 0
+        self.task = None
+
+    @property
+    def wall_clock(self):
+        return self.when is not None
+
+    def advance(self, now):
+        """Work out the next run after the one due at ``now``."""
+        if self.interval is not None:
+            self.deadline += self.interval
+            if self.deadline <= now:
+                # Missed runs are skipped, not caught up with
+                self.deadline = now + self.interval
+        elif self.cron is not None:
+            self.when = self.cron.next_after(max(self.when, time()))
+            self.deadline = now + self.when - time()
+        else:
+            self.when = self.deadline = None
+
+
+class Scheduler(object):
+    """Run the timed jobs of the bridge from one loop."""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.jobs = []
+        self._heap = []
+        self._order = itertools.count()
+        self._wakeup = None
+
+    def every(self, interval, func, *args, delay=0, name=None):
+        """Run ``func(*args)`` every ``interval`` seconds, first after
+        ``delay`` seconds."""
+        job = Job(func, args, name, interval=interval)
+        job.deadline = monotonic() + delay
+        return self._add(job)
+
+    def cron(self, spec, func, *args, name=None):
+        """Run ``func(*args)`` at the times of a crontab schedule, e.g.
+        ``'0 8 * * 6'`` for Saturdays at 8:00."""
+        schedule = CronSchedule(spec)
+        job = Job(func, args, name or '%s (%s)' % (
+            getattr(func, '__qualname__', repr(func)), spec), cron=schedule,
+            when=schedule.next_after(time()))
+        return self._add(job)
+
+    def at(self, when, func, *args, name=None):
+        """Run ``func(*args)`` once at ``when``, a ``datetime`` or timestamp."""
+        if isinstance(when, datetime):
+            when = when.timestamp()
+        return self._add(Job(func, args, name, when=when))
+
+    def cancel(self, job):
+        job.cancelled = True
+        if job in self.jobs:
+            self.jobs.remove(job)
+        self._wake()
+
+    def _add(self, job):
+        if job.wall_clock:
+            job.deadline = monotonic() + job.when - time()
+        self.jobs.append(job)
+        heapq.heappush(self._heap, (job.deadline, next(self._order), job))
+        self._wake()
+        return job
+
+    def _wake(self):
+        # Jobs may be added from any thread
+        if self._wakeup is not None:
+            self.driver.loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _follow_clock(self):
+        # Wall clock deadlines move with the clock
+        now = monotonic()
+        wall = time()
+        changed = False
+        for index, (deadline, order, job) in enumerate(self._heap):
+            if job.wall_clock and not job.cancelled:
+                if job.cron is not None and \
+                        wall - job.when > CLOCK_CHECK_INTERVAL:
+                    logger.info('Skipping %s, the clock moved past it',
+                        job.name)
+                    job.when = job.cron.next_after(wall)
+                moved = now + job.when - wall
+                if abs(moved - deadline) > 1:
+                    job.deadline = moved
+                    self._heap[index] = (moved, order, job)
+                    changed = True
+        if changed:
+            heapq.heapify(self._heap)
+
+    def _start(self, job):
+        if job.task is not None and not job.task.done():
+            logger.warning('Skipping %s, its last run has not finished',
+                job.name)
+            return
+        job.runs += 1
+        job.task = asyncio.ensure_future(self._call(job))
+
+    async def _call(self, job):
+        try:
+            if asyncio.iscoroutinefunction(job.func):
+                await job.func(*job.args)
+            else:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, partial(job.func, *job.args))
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Scheduled job %s failed', job.name)
+
+    async def run(self):
+        """Run the jobs as they fall due until the driver stops."""
+        self._wakeup = asyncio.Event()
+        stop_event = self.driver.aio_stop_event
+        stopper = asyncio.ensure_future(stop_event.wait())
+        stopper.add_done_callback(lambda _: self._wakeup.set())
+        try:
+            while not stop_event.is_set():
+                self._follow_clock()
+                now = monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, job = heapq.heappop(self._heap)
+                    if job.cancelled:
+                        continue
+                    self._start(job)
+                    job.advance(now)
+                    if job.deadline is None:
+                        self.jobs.remove(job)
+                    else:
+                        heapq.heappush(self._heap,
+                            (job.deadline, next(self._order), job))
+                timeout = self._heap[0][0] - now if self._heap else None
+                if any(job.wall_clock for job in self.jobs):
+                    timeout = min(timeout, CLOCK_CHECK_INTERVAL) \
+                        if timeout is not None else CLOCK_CHECK_INTERVAL
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            stopper.cancel()
+            tasks = [job.task for job in self.jobs
+                     if job.task is not None and not job.task.done()]
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,83 @@
+"""SRTP/SRTCP packet protection for the AES_CM_128_HMAC_SHA1_80 suite (RFC 3711).
+
+Used to encrypt the RTP packets of a shared encoder separately for every
+stream session, each of which has its own master key and salt.
+"""
+import hmac
+import struct
+
+from hashlib import sha1
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+AUTH_TAG_LENGTH = 10
+
+LABEL_RTP_ENCRYPTION = 0
+LABEL_RTP_AUTH = 1
+LABEL_RTP_SALT = 2
+LABEL_RTCP_ENCRYPTION = 3
+LABEL_RTCP_AUTH = 4
+LABEL_RTCP_SALT = 5
+
+
+def _keystream(key, iv, data):
+    encryptor = Cipher(algorithms.AES(key), modes.CTR(iv.to_bytes(16, 'big')),
+        backend=default_backend()).encryptor()
+    return encryptor.update(data) + encryptor.finalize()
+
+
+def derive_key(master_key, master_salt, label, length):
+    """Derive a session key with a key derivation rate of zero."""
+    x = int.from_bytes(master_salt, 'big') ^ (label << 48)
+    return _keystream(master_key, x << 16, bytes(length))
+
+
+class SRTPContext(object):
+    """Protect the outgoing RTP and RTCP packets of one SSRC."""
+
+    def __init__(self, master_key, master_salt):
+        self._rtp_key = derive_key(master_key, master_salt, LABEL_RTP_ENCRYPTION, 16)
+        self._rtp_auth = derive_key(master_key, master_salt, LABEL_RTP_AUTH, 20)
+        self._rtp_salt = int.from_bytes(
+            derive_key(master_key, master_salt, LABEL_RTP_SALT, 14), 'big')
+        self._rtcp_key = derive_key(master_key, master_salt, LABEL_RTCP_ENCRYPTION, 16)
+        self._rtcp_auth = derive_key(master_key, master_salt, LABEL_RTCP_AUTH, 20)
+        self._rtcp_salt = int.from_bytes(
+            derive_key(master_key, master_salt, LABEL_RTCP_SALT, 14), 'big')
+        self._roc = 0
+        self._last_sequence = None
+        self._rtcp_index = 0
+
+    def protect(self, packet):
+        """Return the SRTP packet for the RTP ``packet``."""
+        sequence, = struct.unpack_from('>H', packet, 2)
+        ssrc, = struct.unpack_from('>I', packet, 8)
+        if self._last_sequence is not None and sequence < self._last_sequence \
+                and self._last_sequence - sequence > 0x8000:
+            self._roc = (self._roc + 1) & 0xffffffff
+        self._last_sequence = sequence
+
+        offset = 12 + 4 * (packet[0] & 0x0f)
+        if packet[0] & 0x10:
+            offset += 4 + 4 * struct.unpack_from('>H', packet, offset + 2)[0]
+
+        index = (self._roc << 16) | sequence
+        iv = (self._rtp_salt << 16) ^ (ssrc << 64) ^ (index << 16)
+        protected = bytes(packet[:offset]) + _keystream(
+            self._rtp_key, iv, bytes(packet[offset:]))
+        tag = hmac.new(self._rtp_auth,
+            protected + struct.pack('>I', self._roc), sha1).digest()
+        return protected + tag[:AUTH_TAG_LENGTH]
+
+    def protect_rtcp(self, packet):
+        """Return the SRTCP packet for the (compound) RTCP ``packet``."""
+        ssrc, = struct.unpack_from('>I', packet, 4)
+        index = self._rtcp_index
+        self._rtcp_index = (index + 1) & 0x7fffffff
+
+        iv = (self._rtcp_salt << 16) ^ (ssrc << 64) ^ (index << 16)
+        protected = bytes(packet[:8]) + _keystream(
+            self._rtcp_key, iv, bytes(packet[8:])) + \
+            struct.pack('>I', 0x80000000 | index)
+        tag = hmac.new(self._rtcp_auth, protected, sha1).digest()
+        return protected + tag[:AUTH_TAG_LENGTH]
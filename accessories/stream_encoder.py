@@ -0,0 +1,621 @@
+"""Shared ffmpeg encoders fanned out to HomeKit stream sessions.
+
+Every distinct stream configuration is encoded by a single ffmpeg process,
+which sends plain RTP/RTCP to local UDP ports. The packets are rewritten with
+each session's SSRC and payload type, SRTP-protected with the session's key
+and sent to its address, so adding or removing a viewer never touches the
+encoder.
+"""
+import asyncio
+import base64
+import logging
+import re
+import struct
+
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from functools import partial
+from time import monotonic
+from accessories.srtp import SRTPContext
+
+logger = logging.getLogger(__name__)
+
+# Seconds between keyframes. A session joining a running encoder starts
+# receiving video at the next keyframe.
+KEYFRAME_INTERVAL = 2
+
+# Seconds a reconfigured session waits for the first keyframe of its new
+# encoder before falling back to restarting its current one
+RECONFIGURE_TIMEOUT = 5
+
+# Stream configuration that determines the encoder output
+ENCODER_KEY = (
+    'width', 'height', 'fps', 'v_max_bitrate',
+    'a_max_bitrate', 'a_channel', 'a_sample_rate'
+)
+
+# Lines of ffmpeg stderr kept per encoder for diagnostics
+STDERR_LINES = 50
+# Encoding speed below which the encoder is not keeping up with real time
+SLOW_SPEED = 0.95
+
+PROGRESS_FIELD = re.compile(rb'(frame|fps|bitrate|dup|drop|speed)=\s*([^\s]+)')
+LINE_END = re.compile(rb'[\r\n]')
+
+RTCP_SR = 200
+RTCP_SDES = 202
+
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_STAP_A = 24
+NAL_FU_A = 28
+
+
+def encoder_key(stream_config):
+    return tuple(stream_config.get(name) for name in ENCODER_KEY)
+
+
+def rtp_payload_offset(packet):
+    offset = 12 + 4 * (packet[0] & 0x0f)
+    if packet[0] & 0x10:
+        offset += 4 + 4 * struct.unpack_from('>H', packet, offset + 2)[0]
+    return offset
+
+
+def is_keyframe_start(packet):
+    """Whether the H.264 RTP ``packet`` starts an SPS or IDR picture."""
+    offset = rtp_payload_offset(packet)
+    if offset + 1 >= len(packet):
+        return False
+    nal_type = packet[offset] & 0x1f
+    if nal_type == NAL_STAP_A:
+        return offset + 3 < len(packet) and \
+            packet[offset + 3] & 0x1f in (NAL_IDR, NAL_SPS)
+    if nal_type == NAL_FU_A:
+        return bool(packet[offset + 1] & 0x80) and \
+            packet[offset + 1] & 0x1f in (NAL_IDR, NAL_SPS)
+    return nal_type in (NAL_IDR, NAL_SPS)
+
+
+def _number(value, suffix=b''):
+    try:
+        return float(value[:len(value) - len(suffix)] if suffix and
+            value.endswith(suffix) else value)
+    except ValueError:
+        return None
+
+
+class EncoderStats(object):
+    """Encoder health parsed from ffmpeg's progress output."""
+
+    def __init__(self):
+        self.started = monotonic()
+        self.updated = None
+        self.frames = 0
+        self.fps = 0.0
+        self.bitrate = 0.0
+        self.duplicated = 0
+        self.dropped = 0
+        self.speed = None
+        self.lines = deque(maxlen=STDERR_LINES)
+
+    def update(self, line):
+        self.lines.append(line)
+        fields = dict(PROGRESS_FIELD.findall(line))
+        if b'frame' not in fields:
+            return False
+        self.updated = monotonic()
+        self.frames = int(_number(fields[b'frame']) or 0)
+        self.fps = _number(fields.get(b'fps', b'0')) or 0.0
+        self.bitrate = _number(fields.get(b'bitrate', b'0'), b'kbits/s') or 0.0
+        self.duplicated = int(_number(fields.get(b'dup', b'0')) or 0)
+        self.dropped = int(_number(fields.get(b'drop', b'0')) or 0)
+        self.speed = _number(fields.get(b'speed', b'N/A'), b'x')
+        return True
+
+    @property
+    def behind(self):
+        return self.speed is not None and self.speed < SLOW_SPEED
+
+    def as_dict(self):
+        return {
+            'uptime': monotonic() - self.started,
+            'frames': self.frames,
+            'fps': self.fps,
+            'bitrate': self.bitrate,
+            'duplicated': self.duplicated,
+            'dropped': self.dropped,
+            'speed': self.speed,
+        }
+
+
+class StreamTarget(object):
+    """One session's copy of one media stream of an encoder.
+
+    An inactive target drops packets. With ``wait_keyframe`` it activates
+    itself at the next keyframe and calls ``on_start`` first.
+    """
+
+    def __init__(self, transport, srtp_key, ssrc, payload_type, wait_keyframe,
+                 srtp=None):
+        if srtp is None:
+            key = base64.b64decode(srtp_key)
+            srtp = SRTPContext(key[:16], key[16:])
+        self.srtp = srtp
+        self.transport = transport
+        self.ssrc = ssrc
+        self.payload_type = payload_type[0] if payload_type else None
+        self.wait_keyframe = wait_keyframe
+        self.active = not wait_keyframe
+        self.on_start = None
+        self.sequence = 0
+        self.packets = 0
+        self.octets = 0
+
+    def send_rtp(self, data):
+        if not self.active:
+            if not self.wait_keyframe or not is_keyframe_start(data):
+                return
+            if self.on_start is not None:
+                self.on_start()
+            self.active = True
+        packet = bytearray(data)
+        if self.payload_type is not None:
+            packet[1] = (packet[1] & 0x80) | self.payload_type
+        self.sequence = (self.sequence + 1) & 0xffff
+        struct.pack_into('>H', packet, 2, self.sequence)
+        struct.pack_into('>I', packet, 8, self.ssrc)
+        self.packets += 1
+        self.octets += len(packet)
+        self.transport.sendto(self.srtp.protect(packet))
+
+    def send_rtcp(self, data):
+        if not self.active:
+            return
+        packet = bytearray(data)
+        offset = 0
+        while offset + 8 <= len(packet):
+            if packet[offset + 1] in (RTCP_SR, RTCP_SDES):
+                struct.pack_into('>I', packet, offset + 4, self.ssrc)
+            offset += 4 * (struct.unpack_from('>H', packet, offset + 2)[0] + 1)
+        self.transport.sendto(self.srtp.protect_rtcp(packet))
+
+
+class _Relay(asyncio.DatagramProtocol):
+    """Receive the encoder's packets on a local port and fan them out."""
+
+    def __init__(self, targets, rtcp):
+        self.targets = targets
+        self.rtcp = rtcp
+
+    def datagram_received(self, data, addr):
+        for target in self.targets.values():
+            if self.rtcp:
+                target.send_rtcp(data)
+            else:
+                target.send_rtp(data)
+
+
+class SharedEncoder(object):
+    """One ffmpeg process encoding a stream configuration for many sessions.
+
+    With a ``feed``, ffmpeg's stdin is a pipe and ``feed(stdin)`` is run for
+    as long as the process, to write its input.
+    """
+
+    def __init__(self, cmd, stream_config, feed=None):
+        self.cmd = cmd
+        self.feed = feed
+        self.key = encoder_key(stream_config)
+        self.config = dict(zip(ENCODER_KEY, self.key))
+        self.process = None
+        self.stats = EncoderStats()
+        self.video = {}
+        self.audio = {}
+        self._stderr_reader = None
+        self._feeder = None
+        self._stopping = False
+        self._transports = []
+        self._session_transports = {}
+
+    @property
+    def sessions(self):
+        return len(self.video)
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        ports = {}
+        for name, targets, rtcp in (
+                ('v_local_port', self.video, False),
+                ('v_local_rtcp_port', self.video, True),
+                ('a_local_port', self.audio, False),
+                ('a_local_rtcp_port', self.audio, True)):
+            transport, _ = await loop.create_datagram_endpoint(
+                partial(_Relay, targets, rtcp), local_addr=('127.0.0.1', 0))
+            self._transports.append(transport)
+            ports[name] = transport.get_extra_info('sockname')[1]
+
+        cmd = self.cmd.format(gop=self.config['fps'] * KEYFRAME_INTERVAL,
+            **self.config, **ports).split()
+        logger.info('Executing start stream command: "%s"', ' '.join(cmd))
+        try:
+            self.process = await asyncio.create_subprocess_exec(*cmd,
+                    stdin=asyncio.subprocess.PIPE if self.feed else None,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                    limit=1024)
+        except Exception:
+            self._close_transports()
+            raise
+        self.stats = EncoderStats()
+        self._stderr_reader = asyncio.ensure_future(self._drain_stderr())
+        if self.feed is not None:
+            self._feeder = asyncio.ensure_future(self.feed(self.process.stdin))
+        logger.info('Started encoder %s - PID %d', self.key, self.process.pid)
+
+    async def _drain_stderr(self):
+        # Keep reading so ffmpeg never blocks on a full pipe
+        pending = b''
+        while True:
+            chunk = await self.process.stderr.read(1024)
+            if not chunk:
+                await self.process.wait()
+                if self.process.returncode and not self._stopping:
+                    logger.warning('Encoder %s exited with status %d: %s',
+                        self.key, self.process.returncode,
+                        self.stats.lines[-1] if self.stats.lines else b'')
+                break
+            *lines, pending = LINE_END.split(pending + chunk)
+            pending = pending[-1024:]
+            for line in lines:
+                if not line:
+                    continue
+                was_behind = self.stats.behind
+                if self.stats.update(line) and self.stats.behind != was_behind:
+                    if self.stats.behind:
+                        logger.warning('Encoder %s is behind real time: %s',
+                            self.key, self.stats.as_dict())
+                    else:
+                        logger.info('Encoder %s caught up with real time.',
+                            self.key)
+
+    def session_metrics(self, session_id):
+        """Return the encoder health and the session's packet counters."""
+        metrics = self.stats.as_dict()
+        target = self.video.get(session_id)
+        if target is not None:
+            metrics['packets'] = target.packets
+            metrics['octets'] = target.octets
+        return metrics
+
+    async def add(self, session_info, stream_config, previous=None, on_start=None):
+        """Start sending this encoder's output to the session.
+
+        ``previous`` is the ``(encoder, video, audio)`` the session was served
+        by so far. The SRTP state and sequence numbers of its targets carry
+        over, and at this encoder's first keyframe the session is removed
+        from that encoder (if any), right before ``on_start`` is called.
+        """
+        loop = asyncio.get_running_loop()
+        session_id = session_info['id']
+        video_transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol,
+            remote_addr=(session_info['address'], session_info['v_port']))
+        try:
+            audio_transport, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol,
+                remote_addr=(session_info['address'], session_info['a_port']))
+        except Exception:
+            video_transport.close()
+            raise
+        self._session_transports[session_id] = (video_transport, audio_transport)
+        handover, old_video, old_audio = previous or (None, None, None)
+        video = StreamTarget(video_transport,
+            session_info['v_srtp_key'], session_info['v_ssrc'],
+            stream_config.get('v_payload_type'), wait_keyframe=True,
+            srtp=old_video and old_video.srtp)
+        audio = StreamTarget(audio_transport,
+            session_info['a_srtp_key'], session_info['a_ssrc'],
+            stream_config.get('a_payload_type'), wait_keyframe=False,
+            srtp=old_audio and old_audio.srtp)
+
+        def start():
+            if old_video is not None:
+                video.sequence = old_video.sequence
+                audio.sequence = old_audio.sequence
+            if handover is not None:
+                handover.remove(session_id)
+            audio.active = True
+            if on_start is not None:
+                on_start()
+
+        audio.active = previous is None
+        video.on_start = start
+        self.video[session_id] = video
+        self.audio[session_id] = audio
+
+    def targets(self, session_id):
+        return self, self.video.get(session_id), self.audio.get(session_id)
+
+    def remove(self, session_id):
+        self.video.pop(session_id, None)
+        self.audio.pop(session_id, None)
+        for transport in self._session_transports.pop(session_id, ()):
+            transport.close()
+
+    async def stop(self):
+        logger.info('Stopping encoder %s.', self.key)
+        self._stopping = True
+        try:
+            self.process.terminate()
+            await asyncio.wait_for(self.process.wait(), timeout=2.0)
+        except asyncio.TimeoutError:
+            logger.error(
+                'Timeout while waiting for the stream process '
+                'to terminate. Trying with kill.'
+            )
+            self.process.kill()
+            await self.process.wait()
+        except ProcessLookupError:
+            pass
+        if self._feeder is not None:
+            self._feeder.cancel()
+            await asyncio.gather(self._feeder, return_exceptions=True)
+        if self._stderr_reader is not None:
+            await asyncio.gather(self._stderr_reader, return_exceptions=True)
+        logger.debug('Stream command stderr: %s', b'\n'.join(self.stats.lines))
+        self._close_transports()
+        logger.debug('Stream process stopped.')
+
+    def _close_transports(self):
+        for session_id in list(self._session_transports):
+            self.remove(session_id)
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+
+
+class EncoderManager(object):
+    """Hand out shared encoders to stream sessions, one per configuration.
+
+    With a ``prewarm`` stream configuration one encoder is kept running while
+    nobody is watching, so a session asking for it only has to attach. The
+    warm configuration follows the one sessions have asked for most often.
+    As the camera can only be opened once, the idle encoder is stopped
+    before an encoder for any other configuration is started.
+
+    ``feed`` is passed on to the encoders, see ``SharedEncoder``.
+    """
+
+    def __init__(self, cmd, prewarm=None, feed=None):
+        self.cmd = cmd
+        self.feed = feed
+        self.encoders = {}
+        self.prewarm = prewarm
+        self._requested = Counter()
+        self._configs = {}
+        self._lock = None
+
+    async def warm(self):
+        """Start the pre-warmed encoder if no encoder is running."""
+        async with self._get_lock():
+            await self._warm()
+
+    @asynccontextmanager
+    async def paused(self):
+        """Stop the encoders nobody is watching for the duration of the
+        block, e.g. for a snapshot to open the camera, and warm up again
+        after it. Yields whether no encoder is left running."""
+        async with self._get_lock():
+            for idle in [idle for idle in self.encoders.values()
+                         if not idle.sessions]:
+                logger.info('Pausing idle encoder %s', idle.key)
+                del self.encoders[idle.key]
+                await idle.stop()
+            try:
+                yield not self.encoders
+            finally:
+                await self._warm()
+
+    async def attach(self, session_info, stream_config):
+        """Start sending an encoder's output to the session.
+
+        The encoder for the session's configuration is started if no other
+        session is using it yet. The time until the first packet is sent to
+        the session is stored as its ``first_packet_time``.
+        """
+        requested = monotonic()
+        session_id = session_info['id']
+
+        def on_start():
+            session_info['first_packet_time'] = monotonic() - requested
+            logger.info('[%s] First packet after %.3f s (%s encoder)',
+                session_id, session_info['first_packet_time'],
+                'warm' if warm else 'cold')
+
+        self._count(stream_config)
+        encoder = None
+        try:
+            async with self._get_lock():
+                warm = encoder_key(stream_config) in self.encoders
+                encoder = await self._encoder_for(stream_config)
+                await encoder.add(session_info, stream_config, on_start=on_start)
+        except Exception:
+            if encoder is not None:
+                # Do not leave an encoder started for this session running
+                encoder.remove(session_id)
+                await self._release(encoder)
+            raise
+        session_info['encoder'] = encoder
+        return encoder
+
+    async def detach(self, session_info):
+        """Stop sending to the session, stopping the encoder if it was the last."""
+        encoder = session_info.pop('encoder', None)
+        if encoder is None:
+            return False
+        encoder.remove(session_info['id'])
+        await self._release(encoder)
+        return True
+
+    async def reconfigure(self, session_info, stream_config):
+        """Move a running session to the encoder for its new configuration.
+
+        The session keeps receiving its current encoder's output until the
+        new encoder's first keyframe, so the switch leaves no gap in the
+        video. Both encoders then need the camera, which only works with a
+        ``feed``, or if the new one is already running. Otherwise, and if
+        the new encoder exits or has no keyframe within
+        ``RECONFIGURE_TIMEOUT``, the current encoder is restarted with the
+        new configuration, see ``_restart``. The time from the request to
+        the switch is stored as the session's ``adapt_time``.
+        """
+        requested = monotonic()
+        session_id = session_info['id']
+        old = session_info.get('encoder')
+        config = dict(old.config) if old is not None else {}
+        config.update((name, stream_config[name]) for name in ENCODER_KEY
+                      if stream_config.get(name) is not None)
+        stream_config = dict(stream_config, **config)
+        key = encoder_key(config)
+        if old is not None and key == old.key:
+            session_info['adapt_time'] = 0.0
+            return old
+        self._count(stream_config)
+
+        if old is not None and self.feed is None and key not in self.encoders:
+            # The new encoder could not open the camera next to the old one
+            return await self._restart(session_info, stream_config, requested)
+
+        switched = asyncio.get_running_loop().create_future()
+
+        def on_start():
+            if not switched.done():
+                switched.set_result(monotonic())
+
+        encoder = None
+        try:
+            async with self._get_lock():
+                encoder = await self._encoder_for(stream_config)
+                await encoder.add(session_info, stream_config,
+                    previous=old and old.targets(session_id), on_start=on_start)
+        except Exception:
+            if encoder is not None:
+                encoder.remove(session_id)
+                await self._release(encoder)
+            raise
+
+        exited = asyncio.ensure_future(encoder.process.wait())
+        try:
+            await asyncio.wait((switched, exited), timeout=RECONFIGURE_TIMEOUT,
+                return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            exited.cancel()
+        if not switched.done():
+            logger.warning('[%s] Encoder %s %s.', session_id, key,
+                'exited' if not encoder.running else 'did not start')
+            encoder.remove(session_id)
+            await self._release(encoder)
+            if old is None:
+                return None
+            return await self._restart(session_info, stream_config, requested)
+
+        self._switched(session_info, encoder, switched.result() - requested)
+        if old is not None and old is not encoder:
+            await self._release(old)
+        return encoder
+
+    async def _restart(self, session_info, stream_config, requested):
+        """Restart the session's encoder with the new configuration.
+
+        That would cut off the other viewers of a shared encoder, so the
+        session stays on it and its encoder is returned unchanged.
+        """
+        session_id = session_info['id']
+        old = session_info['encoder']
+        key = encoder_key(stream_config)
+        if old.sessions > 1:
+            logger.warning('[%s] Encoder %s is shared, keeping it instead of '
+                'starting %s.', session_id, old.key, key)
+            return old
+        logger.info('[%s] Restarting encoder %s as %s.', session_id, old.key,
+            key)
+        _, video, audio = old.targets(session_id)
+        await self.detach(session_info)
+        async with self._get_lock():
+            encoder = await self._encoder_for(stream_config)
+            await encoder.add(session_info, stream_config,
+                previous=(None, video, audio))
+        self._switched(session_info, encoder, monotonic() - requested)
+        return encoder
+
+    @staticmethod
+    def _switched(session_info, encoder, adapt_time):
+        session_info['encoder'] = encoder
+        session_info['adapt_time'] = adapt_time
+        logger.info('[%s] Switched to encoder %s in %.3f s',
+            session_info['id'], encoder.key, adapt_time)
+
+    def _count(self, stream_config):
+        # Keep the most requested configuration warm
+        if self.prewarm is None:
+            return
+        key = encoder_key(stream_config)
+        self._requested[key] += 1
+        self._configs[key] = dict(zip(ENCODER_KEY, key))
+        self.prewarm = self._configs[self._requested.most_common(1)[0][0]]
+
+    async def _warm(self):
+        # Must be called with the lock held
+        if self.prewarm is not None and not self.encoders:
+            logger.info('Pre-warming encoder %s', encoder_key(self.prewarm))
+            await self._encoder_for(self.prewarm)
+
+    async def _encoder_for(self, stream_config):
+        # Must be called with the lock held
+        key = encoder_key(stream_config)
+        encoder = self.encoders.get(key)
+        if encoder is not None and not encoder.running:
+            # ffmpeg died, the sessions still attached to it get nothing anyway
+            logger.warning('Replacing encoder %s, which exited', key)
+            del self.encoders[key]
+            await encoder.stop()
+            encoder = None
+        if encoder is None:
+            for idle in [idle for idle in self.encoders.values()
+                         if not idle.sessions]:
+                del self.encoders[idle.key]
+                await idle.stop()
+            encoder = SharedEncoder(self.cmd, stream_config, self.feed)
+            await encoder.start()
+            self.encoders[key] = encoder
+        return encoder
+
+    async def _release(self, encoder):
+        # Stop an encoder nobody is watching any more, unless it is the one
+        # to keep warm
+        async with self._get_lock():
+            if encoder.sessions or self.encoders.get(encoder.key) is not encoder:
+                return
+            if self.prewarm is not None and len(self.encoders) == 1 \
+                    and encoder.key == encoder_key(self.prewarm):
+                return
+            del self.encoders[encoder.key]
+            await encoder.stop()
+            await self._warm()
+
+    def _get_lock(self):
+        # Created on first use so it belongs to the driver's running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def stop(self):
+        encoders = list(self.encoders.values())
+        self.encoders = {}
+        await asyncio.gather(*(encoder.stop() for encoder in encoders),
+            return_exceptions=True)
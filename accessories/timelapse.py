@@ -0,0 +1,161 @@
+"""Timelapse of the plants, encoded as the stills are taken.
+
+A still is taken from the camera every ``interval`` seconds and encoded on its
+own by a short-lived ffmpeg into one H.264 frame of MPEG-TS, which is appended
+to the current segment. So the video grows one frame at a time, nothing has
+to be re-encoded from a folder of JPEGs, and between two stills neither the
+GPU encoder nor the camera is held, leaving both to the HomeKit streams. The
+frames are timestamped one after the other, so segments of
+``segment_frames`` frames stay playable while being written and can simply
+be concatenated. The oldest segments are deleted to keep the directory under
+``budget`` bytes.
+"""
+import asyncio
+import logging
+import os
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+TIMELAPSE_CMD = (
+    'ffmpeg -y -loglevel error '
+    '-f image2pipe -c:v mjpeg -i - -frames:v 1 '
+    '-c:v h264_omx -b:v {bitrate}k -pix_fmt yuv420p -r {fps} '
+    '-output_ts_offset {offset} -f mpegts -'
+)
+TIMELAPSE_INTERVAL = 600
+TIMELAPSE_SIZE = (1280, 720)
+TIMELAPSE_FPS = 24
+TIMELAPSE_BITRATE = 2000
+# One day of stills at the default interval
+SEGMENT_FRAMES = 144
+# Bytes of segments kept on disk
+TIMELAPSE_BUDGET = 2 * 1024 ** 3
+SEGMENT_SUFFIX = '.ts'
+# Seconds ffmpeg may take to encode a still
+ENCODE_TIMEOUT = 30
+
+
+class Timelapse(object):
+    """Take stills from a ``BrownCamera`` and encode them into segments."""
+
+    def __init__(self, camera, directory, interval=TIMELAPSE_INTERVAL,
+                 size=TIMELAPSE_SIZE, fps=TIMELAPSE_FPS,
+                 bitrate=TIMELAPSE_BITRATE, segment_frames=SEGMENT_FRAMES,
+                 budget=TIMELAPSE_BUDGET, cmd=TIMELAPSE_CMD):
+        self.camera = camera
+        self.directory = directory
+        self.interval = interval
+        self.size = size
+        self.fps = fps
+        self.bitrate = bitrate
+        self.segment_frames = segment_frames
+        self.budget = budget
+        self.cmd = cmd
+        self.frames = 0
+        self._path = None
+        self._last_still = None
+
+    def schedule(self, scheduler, delay=0):
+        """Take a still every ``interval`` seconds from the bridge's
+        ``Scheduler``, the first after ``delay``; ``close`` finishes the
+        segment."""
+        return scheduler.every(self.interval, self.add_frame, delay=delay)
+
+    async def add_frame(self):
+        try:
+            await self.capture()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to add a timelapse frame')
+
+    async def close(self):
+        self._close_segment()
+
+    async def capture(self):
+        try:
+            still = await self.camera.async_get_snapshot({
+                'image-width': self.size[0], 'image-height': self.size[1]},
+                keep_open=False)
+        except IOError as e:
+            logger.info('Skipping timelapse frame: %s', e)
+            return
+        if still is self._last_still:
+            # The camera is streaming and only had the previous still
+            logger.debug('Skipping timelapse frame, camera busy.')
+            return
+        self._last_still = still
+        frame = await self.encode(still, self.frames / self.fps)
+        loop = asyncio.get_running_loop()
+        if self._path is None:
+            await loop.run_in_executor(None, self._open_segment)
+        await loop.run_in_executor(None, self._append, frame)
+        self.frames += 1
+        if self.frames >= self.segment_frames:
+            self._close_segment()
+
+    async def encode(self, still, offset):
+        """Return a JPEG ``still`` encoded as an MPEG-TS frame starting
+        ``offset`` seconds into the segment."""
+        cmd = self.cmd.format(fps=self.fps, bitrate=self.bitrate,
+            offset=offset).split()
+        process = await asyncio.create_subprocess_exec(*cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE)
+        try:
+            frame, _ = await asyncio.wait_for(process.communicate(still),
+                ENCODE_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode or not frame:
+            raise IOError('ffmpeg failed to encode the still (status %s)'
+                % process.returncode)
+        return frame
+
+    def _open_segment(self):
+        os.makedirs(self.directory, 0o755, True)
+        self.evict()
+        self._path = os.path.join(self.directory, 'timelapse-%s%s' % (
+            datetime.now().strftime('%Y%m%d-%H%M%S'), SEGMENT_SUFFIX))
+        logger.info('Starting timelapse segment %s', self._path)
+        self.frames = 0
+
+    def _append(self, frame):
+        with open(self._path, 'ab') as segment:
+            segment.write(frame)
+
+    def _close_segment(self):
+        if self._path is None:
+            return
+        logger.info('Finished timelapse segment %s (%d frames)',
+            self._path, self.frames)
+        self._path = None
+        self.frames = 0
+
+    def segments(self):
+        """Return the paths of the segments, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in sorted(names)
+                if name.startswith('timelapse-') and name.endswith(SEGMENT_SUFFIX)]
+
+    def evict(self):
+        """Delete the oldest segments until the others fit in the budget.
+
+        Called before a segment is started, so the budget includes one
+        segment's worth of headroom.
+        """
+        segments = [(path, os.path.getsize(path)) for path in self.segments()]
+        total = sum(size for _, size in segments)
+        largest = max((size for _, size in segments), default=0)
+        for path, size in segments:
+            if total + largest <= self.budget:
+                break
+            logger.info('Removing timelapse segment %s to stay within budget',
+                path)
+            os.remove(path)
+            total -= size
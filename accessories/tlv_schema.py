@@ -0,0 +1,351 @@
+"""Declarative TLV8 schemas for the HAP camera stream characteristics.
+
+A schema becomes a record class, a named tuple of its fields, that decodes
+straight from the request buffer, nested TLVs included, without building
+intermediate dicts. Responses are rendered from a ``TLVTemplate``: the TLV
+layout is laid out once in a preallocated buffer and only the variable
+values are written into it for every response.
+"""
+import base64
+import struct
+
+from collections import namedtuple
+from operator import itemgetter
+
+# Field kinds and the fixed-size struct used to decode/encode them
+STRUCTS = {
+    'bool': struct.Struct('?'),
+    'u8': struct.Struct('<B'),
+    'u16': struct.Struct('<H'),
+    'u32': struct.Struct('<I'),
+    'f32': struct.Struct('<f'),
+}
+# Layouts kept per record class
+LAYOUTS = 8
+
+
+_f32 = STRUCTS['f32'].unpack_from
+_new_record = tuple.__new__
+# Appended to the unpacked parts, for the fields missing from a layout
+_MISSING = (None,)
+
+# Functions decoding a field of each kind from ``buf[start:end]``
+DECODERS = {
+    'bytes': lambda buf, start, end: buf[start:end],
+    'str': lambda buf, start, end: str(buf[start:end], 'utf-8'),
+    'bool': lambda buf, start, end: buf[start] != 0,
+    'u8': lambda buf, start, end: buf[start],
+    'u16': lambda buf, start, end: buf[start] | buf[start + 1] << 8,
+    'u32': lambda buf, start, end: int.from_bytes(buf[start:start + 4], 'little'),
+    'f32': lambda buf, start, end: _f32(buf, start)[0],
+}
+
+
+def _utf8(value):
+    return str(value, 'utf-8')
+
+
+def _join_fragments(data, tag, start, offset, end):
+    """Join a value longer than 255 bytes, split over items of the same tag."""
+    chunks = [data[start:offset]]
+    while offset + 1 < end and data[offset] == tag:
+        length = data[offset + 1]
+        chunks.append(data[offset + 2:offset + 2 + length])
+        offset += 2 + length
+        if length != 255:
+            break
+    value = bytes(b''.join(chunks))
+    return value, 0, len(value), offset
+
+
+class TLVRecord(object):
+    """Base class of the records made by ``tlv_record``.
+
+    The items of a record are walked one by one the first time a record of
+    its length is decoded, and their layout, the tags and lengths in order,
+    is compiled into a ``struct``. The Home app lays out its requests the
+    same way every time, so the next records of that length are unpacked
+    in one call and only checked against the layout.
+    """
+    __slots__ = ()
+    # Tag: (field index, kind, decoder)
+    _tags = {}
+    # Record length: compiled layout
+    _layouts = {}
+
+    @classmethod
+    def decode(cls, data, start=0, end=None):
+        """Decode the TLV8 items in ``data[start:end]`` into a new record.
+
+        Fields missing from the data are ``None``, unknown tags are skipped.
+        """
+        if end is None:
+            end = len(data)
+        layout = cls._layouts.get(end - start)
+        if layout is not None:
+            unpack, headers, expected, fields, converters = layout
+            parts = unpack(data, start)
+            if headers(parts) == expected:
+                values = fields(parts + _MISSING)
+                if converters:
+                    values = list(values)
+                    for index, convert in converters:
+                        values[index] = convert(values[index])
+                return _new_record(cls, values)
+        return cls._decode(data, start, end)
+
+    @classmethod
+    def _decode(cls, data, start, end):
+        tags = cls._tags
+        values = [None] * len(cls._fields)
+        items = []
+        offset = start
+        while offset + 1 < end:
+            tag = data[offset]
+            length = data[offset + 1]
+            value_start = offset + 2
+            offset = value_end = value_start + length
+            buf = data
+            if length == 255 and offset < end and data[offset] == tag:
+                buf, value_start, value_end, offset = _join_fragments(
+                    data, tag, value_start, offset, end)
+                items = None
+            elif items is not None:
+                items.append((tag, length))
+            field = tags.get(tag)
+            if field is not None:
+                values[field[0]] = field[2](buf, value_start, value_end)
+        if items and offset == end and len(cls._layouts) < LAYOUTS:
+            cls._learn(items, end - start)
+        return _new_record(cls, values)
+
+    @classmethod
+    def _learn(cls, items, length):
+        """Compile the layout of a record of ``length`` bytes made of the
+        ``(tag, length)`` items, unless a field is repeated or has an odd
+        size."""
+        formats = ['<']
+        headers = []
+        expected = []
+        positions = {}
+        converters = []
+        for tag, size in items:
+            formats.append('BB')
+            headers += (len(headers) + len(positions),
+                        len(headers) + len(positions) + 1)
+            expected += (tag, size)
+            field = cls._tags.get(tag)
+            if field is None:
+                formats.append('%dx' % size)
+                continue
+            index, kind, decoder = field
+            packer = STRUCTS.get(kind)
+            if index in positions:
+                return
+            if packer is None:
+                formats.append('%ds' % size)
+                if kind == 'str':
+                    converters.append((index, _utf8))
+                elif kind != 'bytes':
+                    converters.append((index, decoder))
+            elif packer.size == size:
+                formats.append(packer.format[-1])
+            else:
+                return
+            positions[index] = len(headers) + len(positions)
+        missing = len(headers) + len(positions)
+        cls._layouts[length] = (
+            struct.Struct(''.join(formats)).unpack_from,
+            itemgetter(*headers), tuple(expected),
+            itemgetter(*[positions.get(index, missing)
+                         for index in range(len(cls._fields))]),
+            tuple(converters))
+
+    @classmethod
+    def from_base64(cls, value):
+        return cls.decode(base64.b64decode(value))
+
+
+def tlv_record(name, fields):
+    """Make a ``TLVRecord`` class of a schema, a named tuple of its fields.
+
+    :param fields: ``(tag, attribute, kind)`` tuples, at least two.
+        ``kind`` is one of 'bytes', 'str', 'bool', 'u8', 'u16', 'u32',
+        'f32' or a record class for a nested TLV.
+    """
+    tags = {}
+    for index, (tag, _, kind) in enumerate(fields):
+        nested = isinstance(kind, type) and issubclass(kind, TLVRecord)
+        tags[tag] = (index, kind, kind.decode if nested else DECODERS[kind])
+    return type(name, (TLVRecord, namedtuple(name, [
+        attribute for _, attribute, _ in fields])), {
+            '__slots__': (),
+            '_tags': tags,
+            '_layouts': {},
+        })
+
+
+class TLVTemplate(object):
+    """A TLV8 response laid out once, with fixed-size slots for the values.
+
+    The spec is a list of entries, each one of:
+
+    - ``(tag, b'...')`` a constant value,
+    - ``(tag, name, kind)`` a slot, where ``kind`` is a struct kind such as
+      'u16' or the byte length of a raw value,
+    - ``(tag, [entries])`` a nested TLV.
+    """
+
+    def __init__(self, spec):
+        self._buffer, self._slots = self._compile(spec)
+
+    @classmethod
+    def _compile(cls, spec):
+        buffer = bytearray()
+        slots = {}
+        for entry in spec:
+            tag = entry[0]
+            if len(entry) == 3:
+                _, name, kind = entry
+                packer = STRUCTS.get(kind)
+                length = packer.size if packer else kind
+                value = bytes(length)
+                slots[name] = (len(buffer) + 2, length, packer)
+            elif isinstance(entry[1], list):
+                value, nested = cls._compile(entry[1])
+                for name, (offset, length, packer) in nested.items():
+                    slots[name] = (len(buffer) + 2 + offset, length, packer)
+            else:
+                value = entry[1]
+            if len(value) > 255:
+                raise ValueError('Template values must fit in one TLV item')
+            buffer += bytes((tag, len(value))) + value
+        return buffer, slots
+
+    def render(self, to_base64=False, **values):
+        """Fill the slots with ``values`` and return the encoded TLV."""
+        buffer = self._buffer
+        for name, value in values.items():
+            offset, length, packer = self._slots[name]
+            if packer is not None:
+                packer.pack_into(buffer, offset, value)
+            elif len(value) != length:
+                raise ValueError('%s must be %d bytes long' % (name, length))
+            else:
+                buffer[offset:offset + length] = value
+        if to_base64:
+            return base64.b64encode(buffer).decode('utf-8')
+        return bytes(buffer)
+
+
+# SetupEndpoints
+
+AddressInfo = tlv_record('AddressInfo', (
+    (1, 'is_ipv6', 'bool'),
+    (2, 'address', 'str'),
+    (3, 'video_port', 'u16'),
+    (4, 'audio_port', 'u16'),
+))
+
+SRTPParams = tlv_record('SRTPParams', (
+    (1, 'crypto_suite', 'u8'),
+    (2, 'master_key', 'bytes'),
+    (3, 'master_salt', 'bytes'),
+))
+
+SetupEndpointsRequest = tlv_record('SetupEndpointsRequest', (
+    (1, 'session_id', 'bytes'),
+    (3, 'address', AddressInfo),
+    (4, 'video_srtp', SRTPParams),
+    (5, 'audio_srtp', SRTPParams),
+))
+
+# SelectedRTPStreamConfiguration
+
+SessionControl = tlv_record('SessionControl', (
+    (1, 'session_id', 'bytes'),
+    (2, 'command', 'u8'),
+))
+
+VideoCodecParams = tlv_record('VideoCodecParams', (
+    (1, 'profile_id', 'bytes'),
+    (2, 'level', 'bytes'),
+    (3, 'packetization_mode', 'bytes'),
+))
+
+VideoAttributes = tlv_record('VideoAttributes', (
+    (1, 'width', 'u16'),
+    (2, 'height', 'u16'),
+    (3, 'fps', 'u8'),
+))
+
+RTPParams = tlv_record('RTPParams', (
+    (1, 'payload_type', 'bytes'),
+    (2, 'ssrc', 'u32'),
+    (3, 'max_bitrate', 'u16'),
+    (4, 'rtcp_interval', 'f32'),
+    (5, 'max_mtu', 'bytes'),
+    (6, 'comfort_noise_payload_type', 'bytes'),
+))
+
+VideoConfiguration = tlv_record('VideoConfiguration', (
+    (1, 'codec', 'bytes'),
+    (2, 'codec_params', VideoCodecParams),
+    (3, 'attributes', VideoAttributes),
+    (4, 'rtp_params', RTPParams),
+))
+
+AudioCodecParams = tlv_record('AudioCodecParams', (
+    (1, 'channel', 'u8'),
+    (2, 'bitrate', 'bool'),
+    (3, 'sample_rate', 'u8'),
+    (4, 'packet_time', 'u8'),
+))
+
+AudioConfiguration = tlv_record('AudioConfiguration', (
+    (1, 'codec', 'bytes'),
+    (2, 'codec_params', AudioCodecParams),
+    (3, 'rtp_params', RTPParams),
+    (4, 'comfort_noise', 'bytes'),
+))
+
+SelectedStreamConfiguration = tlv_record('SelectedStreamConfiguration', (
+    (1, 'session', SessionControl),
+    (2, 'video', VideoConfiguration),
+    (3, 'audio', AudioConfiguration),
+))
+
+
+def srtp_template(prefix, crypto_suite):
+    return [
+        (1, crypto_suite),
+        (2, prefix + '_master_key', 16),
+        (3, prefix + '_master_salt', 14),
+    ]
+
+
+def setup_endpoints_template(address, is_ipv6, srtp_suite=None, no_srtp=None):
+    """Return the SetupEndpoints response template for a stream address.
+
+    With ``srtp_suite`` the SRTP parameters echo the session's keys, otherwise
+    the constant ``no_srtp`` value is sent.
+    """
+    if srtp_suite is not None:
+        video_srtp = srtp_template('video', srtp_suite)
+        audio_srtp = srtp_template('audio', srtp_suite)
+    else:
+        video_srtp = audio_srtp = no_srtp
+    return TLVTemplate([
+        (1, 'session_id', 16),
+        (2, 'status', 1),
+        (3, [
+            (1, is_ipv6),
+            (2, address.encode('utf-8')),
+            (3, 'video_port', 'u16'),
+            (4, 'audio_port', 'u16'),
+        ]),
+        (4, video_srtp),
+        (5, audio_srtp),
+        (6, 'video_ssrc', 'u32'),
+        (7, 'audio_ssrc', 'u32'),
+    ])
@@ -1,11 +1,25 @@
 import logging
-import RPi.GPIO as GPIO
+from hardware import GPIO
 
-from time import sleep
-from datetime import datetime
+from collections import deque
+from time import monotonic, time
+from pyhap import util
 from pyhap.accessory import Accessory
 from pyhap.const import CATEGORY_OUTLET
 
+# Milliseconds of switch bounce ignored on the sense pin
+EDGE_BOUNCE_MS = 50
+# Seconds between two checks of the relay pin against the switch state, a
+# safety net for changes that were not noticed
+RECONCILE_INTERVAL = 60
+# The same for a switch without a sense pin, for which these checks are the
+# only way to notice changes made to the relay outside the bridge
+UNSENSED_RECONCILE_INTERVAL = 5
+# Number of watering events kept per switch
+DOSE_HISTORY = 100
+
+logger = logging.getLogger(__name__)
+
 def _gpio_setup(pin):
     if GPIO.getmode() is None:
         GPIO.setmode(GPIO.BCM)
@@ -48,14 +62,35 @@ class WateringSwitch(Accessory):
         reverse, 
         startstate,
         *args, 
+        sense_pin=None,
         **kwargs):
-
+        """
+        :param sense_pin: optional input pin wired to the relay pin. Output
+            pins have no edge detection, so changes made to the relay outside
+            this accessory are only seen right away through this pin.
+        """
         super().__init__(*args, **kwargs)
 
         self.pin_number = pin_number
         self.counter = counter
         self.reverse = reverse
         self.startstate = startstate
+        self.sense_pin = sense_pin
+        if sense_pin is None:
+            self.reconcile_interval = UNSENSED_RECONCILE_INTERVAL
+        else:
+            self.reconcile_interval = RECONCILE_INTERVAL
+        # Called with the new state whenever the relay is switched, from
+        # whichever thread noticed it
+        self.listeners = []
+        # (start time, seconds on, stopped by the timer) of every watering,
+        # also passed to the dose listeners
+        self.doses = deque(maxlen=DOSE_HISTORY)
+        self.dose_listeners = []
+        self._on_since = None
+        self._on_started = None
+        self._dose_timer = None
+        self._dose_done = False
 
         _gpio_setup(self.pin_number)
 
@@ -66,32 +101,68 @@ class WateringSwitch(Accessory):
         self.relay_in_use = serv_switch.configure_char(
             'OutletInUse', setter_callback=self.get_relay_in_use)
 
-        self.timer = 1
-
         self.set_relay(startstate)
 
-    @Accessory.run_at_interval(1)
-    def run(self):
+        if sense_pin is not None:
+            GPIO.setup(sense_pin, GPIO.IN)
+            GPIO.add_event_detect(sense_pin, GPIO.BOTH,
+                callback=self._on_edge, bouncetime=EDGE_BOUNCE_MS)
+
+    async def run(self):
+        while True:
+            self.sync_state()
+            if await util.event_wait(self.driver.aio_stop_event,
+                    self.reconcile_interval):
+                break
+
+    def _on_edge(self, channel):
+        # Called from the RPi.GPIO event thread
+        self.sync_state()
+
+    def _changed(self, state):
+        changed_at = monotonic()
+        self.driver.loop.call_soon_threadsafe(self._time_dose, state, changed_at)
+        for listener in self.listeners:
+            listener(state)
+
+    def _time_dose(self, state, changed_at):
+        # Arm the auto-off when the pump goes on and record the watering when
+        # it goes off. Runs in the event loop.
+        if state and self._on_since is None:
+            self._on_since = changed_at
+            self._on_started = time() - (monotonic() - changed_at)
+            self._dose_done = False
+            self._dose_timer = self.driver.loop.call_later(
+                self.counter - (monotonic() - changed_at), self._stop_dose)
+        elif not state and self._on_since is not None:
+            if self._dose_timer is not None:
+                self._dose_timer.cancel()
+                self._dose_timer = None
+            on_time = changed_at - self._on_since
+            dose = (self._on_started, on_time, self._dose_done)
+            self.doses.append(dose)
+            for listener in self.dose_listeners:
+                listener(dose)
+            logger.info('%s watered for %.3f s (%s)', self.display_name,
+                on_time, 'timer' if self._dose_done else 'stopped')
+            self._on_since = None
+
+    def _stop_dose(self):
+        self._dose_timer = None
+        self._dose_done = True
+        set_gpio_state(self.pin_number, 0, self.reverse)
+        self.sync_state()
+
+    def sync_state(self):
+        """Notify the Home app right away if the relay pin has changed."""
         state = get_gpio_state(self.pin_number, self.reverse)
 
         if self.relay_on.value != state:
             self.relay_on.value = state
             self.relay_on.notify()
             self.relay_in_use.notify()
-
-        oldstate = 1
-
-        if state != oldstate:
-            self.timer = 1
-            oldstate == state
-
-        if self.timer == self.counter:
-            set_gpio_state(self.pin_number, 0, self.reverse)
-            self.timer = 1
-
-        self.timer = self.timer + 1
-        #logging.info("counter %s state is %s", self.timer, state)
-
+            self._changed(state)
+        return state
 
     def set_relay(self, state):
         if get_gpio_state(self.pin_number, self.reverse) != state:
@@ -99,22 +170,12 @@ class WateringSwitch(Accessory):
                 set_gpio_state(self.pin_number, 1, self.reverse)
             else:
                 set_gpio_state(self.pin_number, 0, self.reverse)
+            self._changed(state)
+
+    def water(self):
+        """Switch the pump on for a dose, as if from the Home app."""
+        set_gpio_state(self.pin_number, 1, self.reverse)
+        self.sync_state()
 
     def get_relay_in_use(self, state):
         return True
-
-    # @Accessory.run_at_interval(60)
-    # def checks_need_water(self):
-    #     logging.info("checks_need_water")
-    #     execution_date = datetime.now()
-    #     date_stamp = execution_date.strftime("%Y%m%d-%H%M%S")
-    #     if True:
-    #     # if (execution_date.isoweekday() == 6 
-    #     #     and execution_date.hour == 8
-    #     #     and execution_date.min in range(0, 3600)):
-
-    #         self._camera.start_record(f"/home/pi/brown/images/{date_stamp}.h264")
-    #         self.set_relay(1)
-    #         sleep(30)
-    #         self._camera.stop_record()
-    #     return
\ No newline at end of file
@@ -0,0 +1,135 @@
+"""One scheduler for all the plant zones of the bridge.
+
+A zone is a moisture sensor, the relay powering it while it is read and the
+pump watering it. Instead of every accessory running its own interval loop,
+the zones are sampled from the bridge's ``Scheduler``: the sensors of all
+zones are powered up together, settle once and are read in one go. The pump
+switches report their own changes and time their doses with loop timers, so
+they are only reconciled with their pins at a low rate, as a safety net, or
+every few seconds for the switches without a sense pin. A
+zone can also be watered on a crontab schedule.
+
+Readings and waterings are recorded in the history stores, with the zone's
+index in the scheduler as zone number.
+"""
+import asyncio
+import logging
+
+from functools import partial
+from time import monotonic
+
+from hardware import GPIO
+
+import metrics
+from accessories.moisture_sensor import SAMPLE_INTERVAL, SETTLE_TIME
+from accessories.watering_switch import (RECONCILE_INTERVAL,
+    UNSENSED_RECONCILE_INTERVAL)
+
+logger = logging.getLogger(__name__)
+
+SENSOR_READ = metrics.histogram('sensor_read_seconds',
+    'Time to read the moisture sensors of all zones, after they settled')
+
+
+class ZoneScheduler(object):
+    """Sample the sensors and update the pumps of all zones."""
+
+    def __init__(self, moisture=None, watering=None,
+                 sample_interval=SAMPLE_INTERVAL,
+                 reconcile_interval=RECONCILE_INTERVAL,
+                 unsensed_reconcile_interval=UNSENSED_RECONCILE_INTERVAL):
+        """
+        :param moisture: ``TimeSeriesStore`` of the humidity readings.
+        :param watering: ``TimeSeriesStore`` of the pump on-times, stamped
+            with the time the pump went on.
+        """
+        self.moisture = moisture
+        self.watering = watering
+        self.sample_interval = sample_interval
+        self.reconcile_interval = reconcile_interval
+        self.unsensed_reconcile_interval = unsensed_reconcile_interval
+        self.sensors = []
+        self.switches = []
+        self.schedules = []
+
+    def add_zone(self, sensor, switch, schedule=None):
+        """
+        :param schedule: optional crontab schedule of the waterings of the
+            zone, e.g. ``'0 8 * * 6'`` for Saturdays at 8:00.
+        """
+        if self.watering is not None:
+            switch.dose_listeners.append(
+                partial(self._record_dose, len(self.switches)))
+        self.add_sensor(sensor)
+        self.switches.append(switch)
+        self.schedules.append(schedule)
+
+    def add_sensor(self, sensor):
+        """Sample a sensor without a pump, as ``MoistureSensor.run`` does."""
+        self.sensors.append(sensor)
+
+    def _record_dose(self, zone, dose):
+        start, on_time, _ = dose
+        self.watering.append(zone, on_time, start)
+
+    def __contains__(self, acc):
+        return acc in self.sensors or acc in self.switches
+
+    def schedule(self, scheduler):
+        """Register the sampling, the reconciliation and the watering
+        schedules of the zones with the bridge's ``Scheduler``."""
+        scheduler.every(self.sample_interval, self.sample)
+        sensed = [switch for switch in self.switches
+                  if switch.sense_pin is not None]
+        unsensed = [switch for switch in self.switches
+                    if switch.sense_pin is None]
+        if sensed:
+            scheduler.every(self.reconcile_interval, self._sync_switches,
+                sensed)
+        if unsensed:
+            scheduler.every(self.unsensed_reconcile_interval,
+                self._sync_switches, unsensed)
+        for switch, spec in zip(self.switches, self.schedules):
+            if spec is not None:
+                scheduler.cron(spec, switch.water,
+                    name='%s watering (%s)' % (switch.display_name, spec))
+
+    @staticmethod
+    def _sync_switches(switches):
+        for switch in switches:
+            switch.sync_state()
+
+    async def sample(self):
+        """Read the sensors of all zones within one settle window."""
+        loop = asyncio.get_running_loop()
+        relays = sorted({sensor.relay_pin for sensor in self.sensors
+                         if sensor.relay_pin != 0})
+        if relays:
+            await loop.run_in_executor(None, self._set_relays, relays, GPIO.LOW)
+        try:
+            if relays:
+                await asyncio.sleep(SETTLE_TIME)
+            started = monotonic()
+            readings = await loop.run_in_executor(None, self._read_sensors)
+            SENSOR_READ.observe(monotonic() - started)
+        finally:
+            if relays:
+                await loop.run_in_executor(None, self._set_relays, relays,
+                    GPIO.HIGH)
+
+        for zone, (sensor, dry) in enumerate(readings):
+            humidity = 0 if dry else 100
+            sensor.char_humidity.set_value(humidity)
+            logger.debug('%s: %s', sensor.display_name,
+                "DRY" if dry else "NOT DRY")
+            if self.moisture is not None:
+                self.moisture.append(zone, humidity)
+
+    @staticmethod
+    def _set_relays(relays, level):
+        for pin in relays:
+            GPIO.output(pin, level)
+
+    def _read_sensors(self):
+        return [(sensor, GPIO.input(sensor.sensor_pin))
+                for sensor in self.sensors]
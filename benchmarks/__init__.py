@@ -0,0 +1,8 @@
+"""Benchmarks of the hot paths, run against the simulated hardware.
+
+Run them all from the repository root with ``python3 -m benchmarks``, or one
+suite with e.g. ``python3 -m benchmarks streaming``.
+"""
+import os
+
+os.environ.setdefault('BROWN_HARDWARE', 'fake')
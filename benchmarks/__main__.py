@@ -0,0 +1,21 @@
+import sys
+
+from benchmarks import broker, camera, gpio, streaming, tlv_codec
+
+SUITES = {
+    'streaming': streaming.main,
+    'camera': camera.main,
+    'gpio': gpio.main,
+    'tlv': tlv_codec.main,
+    'broker': broker.main,
+}
+
+
+def main(names):
+    for name in names or SUITES:
+        print('== %s' % name)
+        SUITES[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,45 @@
+"""Benchmarks of the camera broker's shared memory rings.
+
+    python3 -m benchmarks broker
+"""
+import os
+
+from benchmarks.harness import measure
+from hardware import test_frames
+
+from broker import FrameRing, MJPEG_SLOTS, MJPEG_SLOT_SIZE, RingOutput
+
+SIZE = (1280, 720)
+
+
+def main():
+    frames = test_frames(*SIZE)
+    ring = FrameRing.create('brown-benchmark-%d' % os.getpid(), MJPEG_SLOTS,
+        MJPEG_SLOT_SIZE)
+    try:
+        output = RingOutput(ring, 'mjpeg')
+        # Every frame in two buffers, like the camera hands them over
+        chunks = [(frame[:len(frame) // 2], frame[len(frame) // 2:])
+                  for frame in frames]
+        index = [0]
+
+        def write():
+            first, second = chunks[index[0] % len(chunks)]
+            index[0] += 1
+            output.write(first)
+            output.write(second)
+        print(measure('RingOutput.write mjpeg', write, number=20000))
+
+        # Read through the writer's own mapping, as attaching to a ring from
+        # the process that created it confuses the resource tracker
+        into = bytearray()
+
+        def read():
+            ring.read(ring.sequence, into)
+        print(measure('FrameRing.read', read, number=20000))
+    finally:
+        ring.close()
+
+
+if __name__ == '__main__':
+    main()
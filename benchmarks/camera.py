@@ -0,0 +1,54 @@
+"""Benchmarks of the HomeKit camera's stream setup handlers.
+
+    python3 -m benchmarks camera
+"""
+import asyncio
+import logging
+import tempfile
+
+from pyhap.accessory_driver import AccessoryDriver
+
+from benchmarks.harness import measure
+from benchmarks.tlv_codec import (selected_stream_configuration_value,
+    setup_endpoints_value)
+
+from accessories.picamera import BrownCamera
+from accessories.tlv_schema import SelectedStreamConfiguration
+
+OPTIONS = {
+    'video': {
+        'codec': {'profiles': [b'\x00', b'\x01', b'\x02'],
+                  'levels': [b'\x00', b'\x01', b'\x02']},
+        'resolutions': [[640, 360, 30], [1280, 720, 30]],
+    },
+    'audio': {'codecs': [{'type': 'OPUS', 'samplerate': 24}]},
+    'srtp': True,
+    'address': '192.168.1.10',
+    'start_stream_cmd': 'true',
+}
+
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.NamedTemporaryFile() as state:
+        driver = AccessoryDriver(port=51826, persist_file=state.name, loop=loop)
+        camera = BrownCamera(OPTIONS, driver, 'Camera')
+
+        endpoints = setup_endpoints_value()
+        print(measure('BrownCamera.set_endpoints',
+            lambda: camera.set_endpoints(endpoints), number=10000))
+
+        async def start_stream(session_info, stream_config):
+            return True
+        camera.start_stream = start_stream
+        config = SelectedStreamConfiguration.from_base64(
+            selected_stream_configuration_value())
+        print(measure('BrownCamera._start_stream', lambda: loop.run_until_complete(
+            camera._start_stream(config, False)), number=5000))
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Benchmarks of the watering switch on the simulated GPIO.
+
+    python3 -m benchmarks gpio
+"""
+import asyncio
+import tempfile
+
+from pyhap.accessory_driver import AccessoryDriver
+
+from benchmarks.harness import measure
+from hardware import GPIO
+
+from accessories.watering_switch import WateringSwitch
+
+PUMP_PIN = 21
+SENSE_PIN = 20
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.NamedTemporaryFile() as state:
+        driver = AccessoryDriver(port=51826, persist_file=state.name, loop=loop)
+        GPIO.link(PUMP_PIN, SENSE_PIN)
+        switch = WateringSwitch(PUMP_PIN, 60, False, 0, driver, 'Water',
+            sense_pin=SENSE_PIN)
+
+        print(measure('WateringSwitch.sync_state', switch.sync_state,
+            number=50000))
+
+        def toggle():
+            switch.set_relay(1)
+            switch.set_relay(0)
+            # Run the dose timers scheduled by the change
+            loop.run_until_complete(asyncio.sleep(0))
+        print(measure('WateringSwitch.set_relay on/off', toggle, number=5000))
+
+        state_ = [0]
+
+        def edge():
+            # A change made outside the bridge, seen through the sense pin
+            state_[0] ^= 1
+            GPIO.output(PUMP_PIN, state_[0])
+            loop.run_until_complete(asyncio.sleep(0))
+        print(measure('WateringSwitch edge', edge, number=5000))
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
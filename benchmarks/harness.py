@@ -0,0 +1,92 @@
+"""Timing and allocation measurement shared by the benchmark suites."""
+import gc
+import tracemalloc
+
+from time import perf_counter, perf_counter_ns
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(samples, percent):
+    """Return the ``percent`` percentile of sorted ``samples``."""
+    if not samples:
+        return 0
+    index = min(len(samples) - 1, int(round(percent / 100 * (len(samples) - 1))))
+    return samples[index]
+
+
+class Result(object):
+    """Throughput, latency percentiles and allocations of one benchmark."""
+
+    def __init__(self, name, latencies, elapsed, alloc_peak=None, alloc_kept=None,
+                 unit='op'):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.count = len(latencies)
+        self.elapsed = elapsed
+        self.alloc_peak = alloc_peak
+        self.alloc_kept = alloc_kept
+        self.unit = unit
+
+    @property
+    def throughput(self):
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        result = {
+            'name': self.name,
+            'count': self.count,
+            'throughput': self.throughput,
+            'alloc_peak': self.alloc_peak,
+            'alloc_kept': self.alloc_kept,
+        }
+        for percent in PERCENTILES:
+            result['p%d' % percent] = percentile(self.latencies, percent) / 1e3
+        return result
+
+    def __str__(self):
+        line = '%-34s %10.0f %s/s ' % (self.name, self.throughput, self.unit)
+        line += ' '.join('p%d %8.1f us' % (percent,
+            percentile(self.latencies, percent) / 1e3) for percent in PERCENTILES)
+        if self.alloc_peak is not None:
+            line += '  alloc %7.0f B/%s peak, %5.0f B kept' % (
+                self.alloc_peak, self.unit, self.alloc_kept)
+        return line
+
+
+def measure(name, func, number=10000, warmup=100, allocations=1000):
+    """Call ``func`` ``number`` times and return its ``Result``.
+
+    Latencies are taken per call. Allocations are measured in a separate
+    pass of ``allocations`` calls under tracemalloc: the mean peak of memory
+    allocated during one call, and the mean memory still held after it.
+    """
+    for _ in range(warmup):
+        func()
+
+    latencies = []
+    gc.collect()
+    start = perf_counter()
+    for _ in range(number):
+        begin = perf_counter_ns()
+        func()
+        latencies.append(perf_counter_ns() - begin)
+    elapsed = perf_counter() - start
+
+    alloc_peak = alloc_kept = None
+    if allocations:
+        peak = 0
+        tracemalloc.start()
+        try:
+            first, _ = tracemalloc.get_traced_memory()
+            for _ in range(allocations):
+                before, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                func()
+                peak += tracemalloc.get_traced_memory()[1] - before
+            last, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        alloc_peak = peak / allocations
+        alloc_kept = (last - first) / allocations
+    return Result(name, latencies, elapsed, alloc_peak, alloc_kept)
@@ -0,0 +1,173 @@
+"""Benchmarks of the web server: the frame ring, the HTTP handler and the
+live view's muxer.
+
+    python3 -m benchmarks streaming
+"""
+import socket
+import threading
+
+from time import perf_counter, perf_counter_ns, sleep
+
+from benchmarks.harness import Result, measure
+from hardware import test_frames
+
+import server
+
+SIZE = (1280, 720)
+FRAMERATE = 30
+CLIENTS = 4
+DURATION = 3
+
+
+class QuietHandler(server.StreamingHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def write_frames(output, frames):
+    # Every frame in two buffers, split beforehand
+    chunks = [(frame[:len(frame) // 2], frame[len(frame) // 2:])
+              for frame in frames]
+    index = [0]
+
+    def write():
+        first, second = chunks[index[0] % len(chunks)]
+        index[0] += 1
+        output.write(first)
+        output.write(second)
+    return write
+
+
+def bench_output(frames):
+    output = server.StreamingOutput()
+    yield measure('StreamingOutput.write', write_frames(output, frames),
+        number=20000)
+
+    def read():
+        with output.frame() as (sequence, frame):
+            len(frame)
+    yield measure('StreamingOutput.frame', read, number=20000)
+
+
+def bench_motion():
+    detector = server.MotionDetector({})
+    frames = test_frames(*server.MOTION_SIZE, format='yuv')
+    index = [0]
+
+    def check():
+        index[0] += 1
+        detector.check(frames[index[0] % len(frames)], 0.0)
+    yield measure('MotionDetector.check', check, number=5000)
+
+
+def bench_live():
+    live = server.LiveOutput('%dx%d' % SIZE)
+    chunks = test_frames(*SIZE, count=FRAMERATE * server.LIVE_KEYFRAME_INTERVAL,
+                         format='h264')
+    index = [0]
+
+    def write():
+        index[0] += 1
+        live.write(chunks[index[0] % len(chunks)])
+    yield measure('LiveOutput.write', write, number=5000)
+
+
+def bench_index():
+    server.outputs.setdefault(server.RESOLUTION, server.StreamingOutput())
+    ours, theirs = socket.socketpair()
+    request = b'GET /index.html HTTP/1.0\r\n\r\n'
+
+    def get_index():
+        theirs.sendall(request)
+        QuietHandler(ours, ('127.0.0.1', 0), None)
+        theirs.recv(65536)
+    try:
+        yield measure('StreamingHandler /index.html', get_index, number=5000)
+    finally:
+        ours.close()
+        theirs.close()
+
+
+def _stamp(frame, counter):
+    # Frame number in a JPEG comment right after SOI, to match the frames a
+    # client receives with the time they were published
+    return frame[:2] + b'\xff\xfe\x00\x0a' + counter.to_bytes(8, 'big') + frame[2:]
+
+
+def _client(port, published, latencies, stop):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(b'GET /stream.mjpg HTTP/1.0\r\n\r\n')
+    reader = sock.makefile('rb')
+    try:
+        while reader.readline() not in (b'\r\n', b''):
+            pass
+        while not stop.is_set():
+            length = None
+            line = reader.readline()
+            while line not in (b'\r\n', b''):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+                line = reader.readline()
+            if length is None:
+                if line == b'':
+                    break
+                continue
+            frame = reader.read(length)
+            received = perf_counter_ns()
+            counter = int.from_bytes(frame[6:14], 'big')
+            latencies.append(received - published[counter])
+    finally:
+        reader.close()
+        sock.close()
+
+
+def bench_stream(frames, clients=CLIENTS, duration=DURATION):
+    output = server.StreamingOutput()
+    server.outputs[server.RESOLUTION] = output
+    httpd = server.StreamingServer(('127.0.0.1', 0), QuietHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    port = httpd.server_address[1]
+
+    published = {}
+    latencies = []
+    stop = threading.Event()
+    readers = [threading.Thread(target=_client,
+        args=(port, published, latencies, stop), daemon=True)
+        for _ in range(clients)]
+    for reader in readers:
+        reader.start()
+    sleep(0.2)
+
+    start = perf_counter()
+    counter = 0
+    interval = 1.0 / FRAMERATE
+    while perf_counter() - start < duration:
+        frame = _stamp(frames[counter % len(frames)], counter)
+        published[counter] = perf_counter_ns()
+        output.write(frame)
+        counter += 1
+        sleep(max(0.0, start + counter * interval - perf_counter()))
+    elapsed = perf_counter() - start
+    stop.set()
+    output.write(_stamp(frames[0], counter))
+    published[counter] = perf_counter_ns()
+    output.write(frames[1])
+    httpd.shutdown()
+    httpd.server_close()
+    for reader in readers:
+        reader.join(1)
+    # Latency from the frame's write to its arrival at a client
+    yield Result('/stream.mjpg x%d @%d fps' % (clients, FRAMERATE),
+        latencies, elapsed, unit='frame')
+
+
+def main():
+    frames = test_frames(*SIZE)
+    for results in (bench_output(frames), bench_motion(), bench_live(),
+                    bench_index(), bench_stream(frames)):
+        for result in results:
+            print(result)
+
+
+if __name__ == '__main__':
+    main()
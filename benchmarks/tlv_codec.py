@@ -0,0 +1,214 @@
+"""Micro-benchmark of the stream setup TLV parsing.
+
+Compares the schemas in accessories/tlv_schema.py with the previous
+``tlv.decode``/``struct.unpack`` path of ``set_endpoints`` and
+``_start_stream``. Run from the repository root:
+
+    python3 -m benchmarks.tlv_codec
+"""
+import os
+import struct
+import timeit
+
+from pyhap import tlv
+
+from accessories.tlv_schema import (SelectedStreamConfiguration,
+    SetupEndpointsRequest, setup_endpoints_template)
+
+NUMBER = 20000
+
+SESSION_ID = os.urandom(16)
+ADDRESS = '192.168.1.42'
+STREAM_ADDRESS = '192.168.1.10'
+AES_CM_128_HMAC_SHA1_80 = b'\x00'
+
+
+def setup_endpoints_value():
+    srtp = tlv.encode(b'\x01', b'\x00', b'\x02', os.urandom(16), b'\x03', os.urandom(14))
+    address = tlv.encode(
+        b'\x01', b'\x00',
+        b'\x02', ADDRESS.encode('utf-8'),
+        b'\x03', struct.pack('<H', 51234),
+        b'\x04', struct.pack('<H', 51236))
+    return tlv.encode(
+        b'\x01', SESSION_ID,
+        b'\x03', address,
+        b'\x04', srtp,
+        b'\x05', srtp,
+        to_base64=True)
+
+
+def selected_stream_configuration_value():
+    video = tlv.encode(
+        b'\x01', b'\x00',
+        b'\x02', tlv.encode(b'\x01', b'\x02', b'\x02', b'\x02', b'\x03', b'\x00'),
+        b'\x03', tlv.encode(
+            b'\x01', struct.pack('<H', 1280),
+            b'\x02', struct.pack('<H', 720),
+            b'\x03', struct.pack('<B', 30)),
+        b'\x04', tlv.encode(
+            b'\x01', b'\x63',
+            b'\x02', struct.pack('<I', 123456),
+            b'\x03', struct.pack('<H', 299),
+            b'\x04', struct.pack('<f', 0.5),
+            b'\x05', struct.pack('<H', 1378)))
+    audio = tlv.encode(
+        b'\x01', b'\x03',
+        b'\x02', tlv.encode(b'\x01', b'\x01', b'\x02', b'\x00', b'\x03', b'\x02',
+                            b'\x04', b'\x14'),
+        b'\x03', tlv.encode(
+            b'\x01', b'\x6e',
+            b'\x02', struct.pack('<I', 654321),
+            b'\x03', struct.pack('<H', 24),
+            b'\x04', struct.pack('<f', 5.0),
+            b'\x06', b'\x0d'),
+        b'\x04', b'\x00')
+    session = tlv.encode(b'\x01', SESSION_ID, b'\x02', b'\x01')
+    return tlv.encode(b'\x01', session, b'\x02', video, b'\x03', audio,
+                      to_base64=True)
+
+
+def legacy_set_endpoints(value):
+    objs = tlv.decode(value, from_base64=True)
+    session_id = objs[b'\x01']
+    address_info_objs = tlv.decode(objs[b'\x03'])
+    struct.unpack('?', address_info_objs[b'\x01'])
+    address_info_objs[b'\x02'].decode('utf8')
+    video_port = struct.unpack('<H', address_info_objs[b'\x03'])[0]
+    audio_port = struct.unpack('<H', address_info_objs[b'\x04'])[0]
+    video_info_objs = tlv.decode(objs[b'\x04'])
+    video_key = video_info_objs[b'\x02']
+    video_salt = video_info_objs[b'\x03']
+    audio_info_objs = tlv.decode(objs[b'\x05'])
+    audio_key = audio_info_objs[b'\x02']
+    audio_salt = audio_info_objs[b'\x03']
+
+    video_srtp_tlv = tlv.encode(b'\x01', AES_CM_128_HMAC_SHA1_80,
+        b'\x02', video_key, b'\x03', video_salt)
+    audio_srtp_tlv = tlv.encode(b'\x01', AES_CM_128_HMAC_SHA1_80,
+        b'\x02', audio_key, b'\x03', audio_salt)
+    res_address_tlv = tlv.encode(
+        b'\x01', b'\x00',
+        b'\x02', STREAM_ADDRESS.encode('utf-8'),
+        b'\x03', struct.pack('<H', video_port),
+        b'\x04', struct.pack('<H', audio_port))
+    return tlv.encode(
+        b'\x01', session_id,
+        b'\x02', b'\x00',
+        b'\x03', res_address_tlv,
+        b'\x04', video_srtp_tlv,
+        b'\x05', audio_srtp_tlv,
+        b'\x06', struct.pack('<I', 1234),
+        b'\x07', struct.pack('<I', 5678),
+        to_base64=True)
+
+
+def schema_set_endpoints(value, template):
+    request = SetupEndpointsRequest.from_base64(value)
+    address_info = request.address
+    return template.render(
+        to_base64=True,
+        session_id=request.session_id,
+        status=b'\x00',
+        video_port=address_info.video_port,
+        audio_port=address_info.audio_port,
+        video_master_key=request.video_srtp.master_key,
+        video_master_salt=request.video_srtp.master_salt,
+        audio_master_key=request.audio_srtp.master_key,
+        audio_master_salt=request.audio_srtp.master_salt,
+        video_ssrc=1234,
+        audio_ssrc=5678)
+
+
+def legacy_start_stream(value):
+    objs = tlv.decode(value, from_base64=True)
+    opts = {}
+    video_objs = tlv.decode(objs[b'\x02'])
+    video_codec_param_objs = tlv.decode(video_objs[b'\x02'])
+    opts['v_profile_id'] = video_codec_param_objs[b'\x01']
+    opts['v_level'] = video_codec_param_objs[b'\x02']
+    video_attr_objs = tlv.decode(video_objs[b'\x03'])
+    opts['width'] = struct.unpack('<H', video_attr_objs[b'\x01'])[0]
+    opts['height'] = struct.unpack('<H', video_attr_objs[b'\x02'])[0]
+    opts['fps'] = struct.unpack('<B', video_attr_objs[b'\x03'])[0]
+    video_rtp_param_objs = tlv.decode(video_objs[b'\x04'])
+    opts['v_ssrc'] = struct.unpack('<I', video_rtp_param_objs[b'\x02'])[0]
+    opts['v_payload_type'] = video_rtp_param_objs[b'\x01']
+    opts['v_max_bitrate'] = struct.unpack('<H', video_rtp_param_objs[b'\x03'])[0]
+    opts['v_rtcp_interval'] = struct.unpack('<f', video_rtp_param_objs[b'\x04'])[0]
+    opts['v_max_mtu'] = video_rtp_param_objs[b'\x05']
+
+    audio_objs = tlv.decode(objs[b'\x03'])
+    opts['a_codec'] = audio_objs[b'\x01']
+    audio_codec_param_objs = tlv.decode(audio_objs[b'\x02'])
+    audio_rtp_param_objs = tlv.decode(audio_objs[b'\x03'])
+    opts['a_comfort_noise'] = audio_objs[b'\x04']
+    opts['a_channel'] = audio_codec_param_objs[b'\x01'][0]
+    opts['a_bitrate'] = struct.unpack('?', audio_codec_param_objs[b'\x02'])[0]
+    opts['a_sample_rate'] = 8 * (1 + audio_codec_param_objs[b'\x03'][0])
+    opts['a_packet_time'] = struct.unpack('<B', audio_codec_param_objs[b'\x04'])[0]
+    opts['a_ssrc'] = struct.unpack('<I', audio_rtp_param_objs[b'\x02'])[0]
+    opts['a_payload_type'] = audio_rtp_param_objs[b'\x01']
+    opts['a_max_bitrate'] = struct.unpack('<H', audio_rtp_param_objs[b'\x03'])[0]
+    opts['a_rtcp_interval'] = struct.unpack('<f', audio_rtp_param_objs[b'\x04'])[0]
+    opts['a_comfort_payload_type'] = audio_rtp_param_objs[b'\x06']
+
+    session_objs = tlv.decode(objs[b'\x01'])
+    opts['id'] = session_objs[b'\x01']
+    return opts
+
+
+def schema_start_stream(value):
+    config = SelectedStreamConfiguration.from_base64(value)
+    video = config.video
+    audio = config.audio
+    return {
+        'v_profile_id': video.codec_params.profile_id,
+        'v_level': video.codec_params.level,
+        'width': video.attributes.width,
+        'height': video.attributes.height,
+        'fps': video.attributes.fps,
+        'v_ssrc': video.rtp_params.ssrc,
+        'v_payload_type': video.rtp_params.payload_type,
+        'v_max_bitrate': video.rtp_params.max_bitrate,
+        'v_rtcp_interval': video.rtp_params.rtcp_interval,
+        'v_max_mtu': video.rtp_params.max_mtu,
+        'a_codec': audio.codec,
+        'a_comfort_noise': audio.comfort_noise,
+        'a_channel': audio.codec_params.channel,
+        'a_bitrate': audio.codec_params.bitrate,
+        'a_sample_rate': 8 * (1 + audio.codec_params.sample_rate),
+        'a_packet_time': audio.codec_params.packet_time,
+        'a_ssrc': audio.rtp_params.ssrc,
+        'a_payload_type': audio.rtp_params.payload_type,
+        'a_max_bitrate': audio.rtp_params.max_bitrate,
+        'a_rtcp_interval': audio.rtp_params.rtcp_interval,
+        'a_comfort_payload_type': audio.rtp_params.comfort_noise_payload_type,
+        'id': config.session.session_id,
+    }
+
+
+def report(name, legacy, schema):
+    legacy_time = min(timeit.repeat(legacy, number=NUMBER, repeat=3)) / NUMBER
+    schema_time = min(timeit.repeat(schema, number=NUMBER, repeat=3)) / NUMBER
+    print('%-16s legacy %7.1f us  schema %7.1f us  speedup %.1fx' % (
+        name, legacy_time * 1e6, schema_time * 1e6, legacy_time / schema_time))
+
+
+def main():
+    endpoints = setup_endpoints_value()
+    selected = selected_stream_configuration_value()
+    template = setup_endpoints_template(STREAM_ADDRESS, b'\x00',
+        AES_CM_128_HMAC_SHA1_80)
+
+    assert legacy_set_endpoints(endpoints) == schema_set_endpoints(endpoints, template)
+    assert legacy_start_stream(selected) == schema_start_stream(selected)
+
+    report('set_endpoints', lambda: legacy_set_endpoints(endpoints),
+        lambda: schema_set_endpoints(endpoints, template))
+    report('_start_stream', lambda: legacy_start_stream(selected),
+        lambda: schema_start_stream(selected))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Startup timeline of the bridge.
+
+The timeline starts with the process, as the kernel saw it in ``/proc``, so
+the interpreter's own startup counts too. Each ``mark`` ends a phase that
+began at the previous one, e.g.::
+
+    boot.TIMELINE.mark('import')
+    ...
+    boot.TIMELINE.report()
+
+``report`` logs the phases against ``BOOT_BUDGET`` and keeps them as the
+``startup_phase_seconds`` metric, to track boot times after power cuts.
+"""
+import logging
+import os
+
+from time import monotonic
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds from the process start until the bridge is advertised and running
+BOOT_BUDGET = 15
+
+STARTUP_PHASE = metrics.gauge('startup_phase_seconds',
+    'Seconds taken by each phase of the startup', ['phase'])
+STARTUP_BUDGET = metrics.gauge('startup_budget_seconds',
+    'Seconds the startup is expected to take at most')
+
+
+def process_age():
+    """Return the seconds since the process started, 0 if unknown."""
+    try:
+        with open('/proc/self/stat') as stat:
+            # The fields after the command name, which may contain spaces
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as uptime:
+            now = float(uptime.read().split()[0])
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return max(0.0, now - started)
+
+
+class Timeline(object):
+    """Durations of the phases of the startup, in order."""
+
+    def __init__(self, budget=BOOT_BUDGET):
+        self.budget = budget
+        self._last = monotonic()
+        age = process_age()
+        self.started = self._last - age
+        # Until the first module importing this one
+        self.phases = [('interpreter', age)] if age else []
+
+    def mark(self, phase):
+        """End ``phase``, which began at the previous mark."""
+        now = monotonic()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self.started
+
+    def report(self):
+        """Log the phases and expose them as metrics."""
+        STARTUP_PHASE.set_function(lambda: dict(self.phases))
+        STARTUP_BUDGET.set(self.budget)
+        phases = ', '.join('%s %.2f s' % phase for phase in self.phases)
+        if self.total > self.budget:
+            logger.warning('Started in %.2f s, over the %s s budget: %s',
+                self.total, self.budget, phases)
+        else:
+            logger.info('Started in %.2f s of the %s s budget: %s',
+                self.total, self.budget, phases)
+
+
+TIMELINE = Timeline()
@@ -0,0 +1,580 @@
+"""Camera broker, the one process that opens the camera.
+
+The camera can only be opened once, so with the broker running it records
+everything the other processes need, each on its own splitter port, and
+publishes it in ring buffers in shared memory:
+
+- the MJPEG frames of every stream size of the web server (server.py),
+- the small YUV frames its motion detection compares,
+- an H.264 stream, fed to the HomeKit stream encoders instead of v4l2.
+
+The web server, the snapshots of the bridge and its stream sessions then read
+the rings side by side. A ring has one writer and never waits for its
+readers: every slot carries the sequence number of its frame, cleared while
+the slot is rewritten, and a reader checks it before and after taking the
+frame out. Readers copy a frame into a buffer of their own, which is reused
+for every frame, so a frame is never torn and nothing is allocated per frame.
+Readers following a ring connect to its socket and block on it: the broker
+sends every connected reader a byte when it publishes a frame, so nothing
+polls the rings, and a reader notices a broker that crashed when the socket
+hangs up.
+
+Run it with ``python3 broker.py``; the rings are removed when it stops.
+"""
+import asyncio
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import threading
+
+from multiprocessing import resource_tracker, shared_memory
+from time import time
+
+logger = logging.getLogger(__name__)
+
+RING_PREFIX = 'brown-'
+# Magic, slots, slot size, state, broker's process id, newest sequence
+RING_HEADER = struct.Struct('<4sIIIIQ')
+# Sequence (0 while written), length, flags, wall time
+SLOT_HEADER = struct.Struct('<QIId')
+RING_MAGIC = b'BRWN'
+RUNNING = 1
+STOPPED = 2
+# Slot flag of an H.264 chunk starting with the stream headers, where a
+# decoder can start
+KEYFRAME = 1
+# NAL unit type of a sequence parameter set
+NAL_SPS = 7
+
+# Slots and slot size in bytes of the rings. MJPEG frames of the full
+# resolution stay well below the slot size; H.264 chunks larger than a slot
+# are split over several.
+MJPEG_SLOTS = 8
+MJPEG_SLOT_SIZE = 512 * 1024
+YUV_SLOTS = 4
+H264_SLOTS = 128
+H264_SLOT_SIZE = 64 * 1024
+# Bits per second and seconds between keyframes of the H.264 stream
+H264_BITRATE = 1000000
+H264_KEYFRAME_INTERVAL = 2
+
+# Seconds a reader waits for a frame before it checks whether to stop
+WAIT_TIMEOUT = 1
+# Seconds between two attempts to open a ring that does not exist (yet)
+REOPEN_INTERVAL = 1
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _address(name):
+    # Abstract socket, gone with the broker however it exits
+    return '\0' + name
+
+
+def ring_name(kind, size):
+    """Return the shared memory name of the ``kind`` ring of a WxH size."""
+    if not isinstance(size, str):
+        size = '%dx%d' % tuple(size)
+    return '%s%s-%s' % (RING_PREFIX, kind, size)
+
+
+class FrameRing(object):
+    """A ring of frame slots in shared memory.
+
+    ``create`` it in the broker, which is the only writer, and ``attach`` to
+    it from the readers.
+    """
+
+    def __init__(self, memory, owner=False):
+        self.memory = memory
+        self.owner = owner
+        magic, self.slot_count, self.slot_size, _, _, _ = \
+            RING_HEADER.unpack_from(memory.buf)
+        if magic != RING_MAGIC:
+            raise ValueError('%s is not a frame ring' % memory.name)
+        self._stride = SLOT_HEADER.size + self.slot_size
+        self._writing = None
+        self._length = 0
+        # Writer: listening socket and the readers connected to it
+        self._listener = None
+        self._readers = []
+        # Reader: connection to the writer, and whether it hung up
+        self._socket = None
+        self._hung_up = False
+
+    @classmethod
+    def create(cls, name, slots, slot_size):
+        """Create the ring ``name``, replacing one a stopped or crashed
+        broker left.
+
+        Raises RuntimeError if the ring belongs to a broker still running.
+        """
+        try:
+            stale = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            pass
+        else:
+            try:
+                magic, _, _, state, pid, _ = RING_HEADER.unpack_from(stale.buf) \
+                    if stale.size >= RING_HEADER.size else (None,) * 6
+            finally:
+                stale.close()
+            if magic == RING_MAGIC and state != STOPPED and _running(pid):
+                raise RuntimeError('%s belongs to the broker running as '
+                    'process %d' % (name, pid))
+            stale.unlink()
+        memory = shared_memory.SharedMemory(name, create=True,
+            size=RING_HEADER.size + slots * (SLOT_HEADER.size + slot_size))
+        RING_HEADER.pack_into(memory.buf, 0, RING_MAGIC, slots, slot_size,
+            RUNNING, os.getpid(), 0)
+        ring = cls(memory, owner=True)
+        ring._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            ring._listener.bind(_address(name))
+            ring._listener.listen()
+            ring._listener.setblocking(False)
+        except OSError:
+            ring.close()
+            raise
+        return ring
+
+    @classmethod
+    def attach(cls, name, notified=False):
+        """Open an existing ring. Raises FileNotFoundError if there is none.
+
+        A ``notified`` ring is connected to its broker and can ``wait`` for
+        new frames; it raises FileNotFoundError too if the broker is gone.
+        """
+        memory = shared_memory.SharedMemory(name)
+        # Only the broker may unlink the ring when the reader exits
+        resource_tracker.unregister(memory._name, 'shared_memory')  # pylint: disable=protected-access
+        ring = cls(memory)
+        if notified:
+            ring._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                ring._socket.connect(_address(name))
+            except OSError:
+                ring.close()
+                raise FileNotFoundError('%s has no broker writing it' % name)
+            ring._socket.setblocking(False)
+        return ring
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    @property
+    def sequence(self):
+        """Sequence number of the newest frame, 0 before the first."""
+        return RING_HEADER.unpack_from(self.memory.buf)[5]
+
+    @property
+    def stopped(self):
+        return self._hung_up or \
+            RING_HEADER.unpack_from(self.memory.buf)[3] == STOPPED
+
+    def _offset(self, sequence):
+        return RING_HEADER.size + (sequence - 1) % self.slot_count * self._stride
+
+    # Writer
+
+    def start(self):
+        """Start writing the next frame, invalidating its slot."""
+        self._writing = self.sequence + 1
+        self._length = 0
+        SLOT_HEADER.pack_into(self.memory.buf, self._offset(self._writing),
+            0, 0, 0, 0.0)
+
+    @property
+    def writing(self):
+        return self._writing is not None
+
+    def append(self, buf):
+        """Add ``buf`` to the frame being written.
+
+        The frame is abandoned if it does not fit in a slot.
+        """
+        if self._writing is None:
+            return
+        end = self._length + len(buf)
+        if end > self.slot_size:
+            logger.warning('Dropped a frame of %s larger than %d bytes',
+                self.name, self.slot_size)
+            self._writing = None
+            return
+        start = self._offset(self._writing) + SLOT_HEADER.size
+        self.memory.buf[start + self._length:start + end] = buf
+        self._length = end
+
+    def commit(self, flags=0):
+        """Publish the frame being written."""
+        sequence, self._writing = self._writing, None
+        if sequence is None:
+            return
+        SLOT_HEADER.pack_into(self.memory.buf, self._offset(sequence),
+            sequence, self._length, flags, time())
+        struct.pack_into('<Q', self.memory.buf, RING_HEADER.size - 8, sequence)
+        if self._listener is not None:
+            self._notify()
+
+    def _notify(self):
+        """Send every connected reader a byte, accepting new ones first."""
+        while True:
+            try:
+                reader, _ = self._listener.accept()
+            except BlockingIOError:
+                break
+            reader.setblocking(False)
+            self._readers.append(reader)
+        for reader in list(self._readers):
+            try:
+                reader.send(b'\0')
+            except BlockingIOError:
+                # It has not read the previous ones yet
+                pass
+            except OSError:
+                self._readers.remove(reader)
+                reader.close()
+
+    # Readers
+
+    def fileno(self):
+        """File descriptor of a ``notified`` ring, readable when the broker
+        published a frame or hung up."""
+        return self._socket.fileno()
+
+    def drain(self):
+        """Consume the pending signals of a ``notified`` ring."""
+        try:
+            while self._socket.recv(4096):
+                pass
+            self._hung_up = True
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._hung_up = True
+
+    def wait(self, timeout=None):
+        """Block until the broker of a ``notified`` ring publishes a frame
+        or hangs up, at most ``timeout`` seconds."""
+        if select.select([self._socket], [], [], timeout)[0]:
+            self.drain()
+
+    def read(self, sequence, into):
+        """Copy frame ``sequence`` into the bytearray ``into``.
+
+        Returns the frame's ``(length, flags, time)``, or None if that frame
+        is not in the ring (any more). ``into`` grows if it is too small.
+        """
+        offset = self._offset(sequence)
+        buf = self.memory.buf
+        if SLOT_HEADER.unpack_from(buf, offset)[0] != sequence:
+            return None
+        _, length, flags, timestamp = SLOT_HEADER.unpack_from(buf, offset)
+        if len(into) < length:
+            into.extend(bytes(length - len(into)))
+        start = offset + SLOT_HEADER.size
+        with memoryview(into) as target:
+            target[:length] = buf[start:start + length]
+        if SLOT_HEADER.unpack_from(buf, offset)[0] != sequence:
+            # Overwritten while it was copied
+            return None
+        return length, flags, timestamp
+
+    def find(self, flags):
+        """Return the sequence of the newest frame with ``flags``, or None."""
+        newest = self.sequence
+        for sequence in range(newest, max(0, newest - self.slot_count), -1):
+            slot = SLOT_HEADER.unpack_from(self.memory.buf, self._offset(sequence))
+            if slot[0] == sequence and slot[2] & flags:
+                return sequence
+        return None
+
+    def latest(self):
+        """Return a copy of the newest frame as bytes, None before the first."""
+        into = bytearray()
+        for _ in range(self.slot_count):
+            sequence = self.sequence
+            if not sequence:
+                return None
+            frame = self.read(sequence, into)
+            if frame is not None:
+                with memoryview(into) as view:
+                    return bytes(view[:frame[0]])
+        return None
+
+    def close(self):
+        if self.owner:
+            RING_HEADER.pack_into(self.memory.buf, 0, RING_MAGIC,
+                self.slot_count, self.slot_size, STOPPED, os.getpid(),
+                self.sequence)
+        for sock in self._readers + [self._listener, self._socket]:
+            if sock is not None:
+                sock.close()
+        self._readers = []
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def latest_frame(name):
+    """Return the newest frame of a ring, None if there is none."""
+    try:
+        ring = FrameRing.attach(name)
+    except FileNotFoundError:
+        return None
+    try:
+        return ring.latest()
+    finally:
+        ring.close()
+
+
+def follow(name, write, stop_event):
+    """Call ``write`` with a ``memoryview`` of the newest frame of a ring,
+    whenever there is a new one, until ``stop_event`` is set.
+
+    Frames a slow ``write`` had no time for are skipped. The view is only
+    valid during the call. The ring is reopened if the broker restarts.
+    """
+    into = bytearray()
+    while not stop_event.is_set():
+        try:
+            ring = FrameRing.attach(name, notified=True)
+        except FileNotFoundError:
+            stop_event.wait(REOPEN_INTERVAL)
+            continue
+        logger.info('Following the camera broker ring %s', name)
+        last = 0
+        try:
+            while not stop_event.is_set() and not ring.stopped:
+                sequence = ring.sequence
+                if sequence == last:
+                    ring.wait(WAIT_TIMEOUT)
+                    continue
+                frame = ring.read(sequence, into)
+                last = sequence
+                if frame is not None:
+                    with memoryview(into)[:frame[0]] as view:
+                        write(view)
+        finally:
+            ring.close()
+
+
+def follow_stream(name, write, stop_event):
+    """Call ``write`` with a ``memoryview`` of every H.264 chunk of a ring
+    in order, starting at its newest keyframe, until ``stop_event`` is set.
+
+    When ``write`` falls behind by a whole ring it continues at the next
+    keyframe. The view is only valid during the call.
+    """
+    into = bytearray()
+    ring = None
+    try:
+        while not stop_event.is_set():
+            if ring is None or ring.stopped:
+                if ring is not None:
+                    ring.close()
+                    ring = None
+                try:
+                    ring = FrameRing.attach(name, notified=True)
+                except FileNotFoundError:
+                    stop_event.wait(REOPEN_INTERVAL)
+                    continue
+                logger.info('Following the camera broker ring %s', name)
+                sequence = None
+            if sequence is None:
+                sequence = ring.find(KEYFRAME)
+                if sequence is None:
+                    ring.wait(WAIT_TIMEOUT)
+                    continue
+            if sequence > ring.sequence:
+                ring.wait(WAIT_TIMEOUT)
+                continue
+            chunk = ring.read(sequence, into)
+            if chunk is None:
+                logger.warning('H.264 reader of %s fell behind, skipping to '
+                    'the next keyframe', name)
+                sequence = None
+                continue
+            with memoryview(into)[:chunk[0]] as view:
+                write(view)
+            sequence += 1
+    finally:
+        if ring is not None:
+            ring.close()
+
+
+async def feed(name, writer):
+    """Write the H.264 stream of a ring to an asyncio ``writer``, starting
+    at its newest keyframe, until the writer is closed.
+
+    When the writer falls behind by a whole ring it continues at the next
+    keyframe. The ring's socket is watched by the event loop, so the loop
+    only wakes up when there is a chunk.
+    """
+    loop = asyncio.get_running_loop()
+    signalled = asyncio.Event()
+    into = bytearray()
+    ring = None
+
+    async def next_signal():
+        # The loop sets the event while the socket is readable, so a signal
+        # that came after the ring was checked is not lost
+        if signalled.is_set():
+            signalled.clear()
+            ring.drain()
+        else:
+            await signalled.wait()
+
+    try:
+        while True:
+            if ring is None or ring.stopped:
+                if ring is not None:
+                    loop.remove_reader(ring.fileno())
+                    ring.close()
+                    ring = None
+                try:
+                    ring = FrameRing.attach(name, notified=True)
+                except FileNotFoundError:
+                    await asyncio.sleep(REOPEN_INTERVAL)
+                    continue
+                signalled.clear()
+                loop.add_reader(ring.fileno(), signalled.set)
+                sequence = None
+            if sequence is None:
+                sequence = ring.find(KEYFRAME)
+                if sequence is None:
+                    await next_signal()
+                    continue
+            if sequence > ring.sequence:
+                await next_signal()
+                continue
+            chunk = ring.read(sequence, into)
+            if chunk is None:
+                logger.warning('H.264 reader of %s fell behind, skipping to '
+                    'the next keyframe', name)
+                sequence = None
+                continue
+            writer.write(into[:chunk[0]])
+            await writer.drain()
+            sequence += 1
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        if ring is not None:
+            loop.remove_reader(ring.fileno())
+            ring.close()
+
+
+def starts_with_sps(buf):
+    """Tell whether an H.264 chunk starts with an SPS, as the chunks of a
+    keyframe do. The encoder may set any nal_ref_idc, so only the NAL unit
+    type is compared."""
+    if buf[:4] == b'\x00\x00\x00\x01':
+        header = 4
+    elif buf[:3] == b'\x00\x00\x01':
+        header = 3
+    else:
+        return False
+    return len(buf) > header and buf[header] & 0x1f == NAL_SPS
+
+
+class RingOutput(object):
+    """Picamera output publishing what is recorded into a ``FrameRing``.
+
+    ``kind`` is the recording format. MJPEG frames arrive in several
+    buffers and are published at their end of image marker, YUV frames are
+    one buffer each, and H.264 buffers are published as they come.
+    """
+
+    def __init__(self, ring, kind):
+        self.ring = ring
+        self.kind = kind
+
+    def write(self, buf):
+        ring = self.ring
+        if self.kind == 'mjpeg':
+            if buf[:2] == b'\xff\xd8':
+                ring.start()
+            ring.append(buf)
+            if buf[-2:] == b'\xff\xd9':
+                ring.commit()
+        elif self.kind == 'yuv':
+            ring.start()
+            ring.append(buf)
+            ring.commit()
+        else:
+            flags = KEYFRAME if starts_with_sps(buf) else 0
+            with memoryview(buf) as view:
+                for start in range(0, len(buf), ring.slot_size):
+                    ring.start()
+                    ring.append(view[start:start + ring.slot_size])
+                    ring.commit(flags if start == 0 else 0)
+        return len(buf)
+
+
+def main():
+    # What is recorded follows the web server's settings
+    from hardware import PiCamera
+    from server import (FRAMERATE, MOTION_DETECTION, MOTION_SIZE, RESOLUTION,
+                        STREAM_SIZES, parse_size, stream_quality)
+
+    logging.basicConfig(level=logging.INFO, format="[%(module)s] %(message)s")
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+
+    rings = []
+    recordings = []
+    for size in [RESOLUTION] + STREAM_SIZES:
+        quality = stream_quality(size)
+        recordings.append((FrameRing.create(ring_name('mjpeg', size),
+            MJPEG_SLOTS, MJPEG_SLOT_SIZE), 'mjpeg', parse_size(size),
+            {'quality': quality} if quality else {}))
+    if MOTION_DETECTION:
+        width, height = MOTION_SIZE
+        # Frames are padded to 32 columns and 16 rows
+        yuv_size = (width + 31) // 32 * 32 * ((height + 15) // 16 * 16) * 3 // 2
+        recordings.append((FrameRing.create(ring_name('yuv', MOTION_SIZE),
+            YUV_SLOTS, yuv_size), 'yuv', MOTION_SIZE, {}))
+    recordings.append((FrameRing.create(ring_name('h264', RESOLUTION),
+        H264_SLOTS, H264_SLOT_SIZE), 'h264', parse_size(RESOLUTION), {
+            'bitrate': H264_BITRATE,
+            'intra_period': FRAMERATE * H264_KEYFRAME_INTERVAL,
+            'inline_headers': True,
+        }))
+    try:
+        with PiCamera(resolution=RESOLUTION, framerate=FRAMERATE) as camera:
+            #Uncomment the next line to change your Pi's Camera rotation (in degrees)
+            #camera.rotation = 90
+            for port, (ring, kind, size, options) in enumerate(recordings):
+                rings.append(ring)
+                camera.start_recording(RingOutput(ring, kind), format=kind,
+                    splitter_port=port,
+                    resize=size if size != parse_size(RESOLUTION) else None,
+                    **options)
+                logger.info('Recording %s %dx%d into %s', kind, size[0],
+                    size[1], ring.name)
+            try:
+                stop.wait()
+            finally:
+                for port in range(len(rings)):
+                    camera.stop_recording(splitter_port=port)
+    finally:
+        for ring, _, _, _ in recordings:
+            ring.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,22 @@
+import logging
 import signal
 
+import boot
 
 from pyhap import camera, util
-from pyhap.accessory import Bridge
 from pyhap.accessory_driver import AccessoryDriver
+from accessories.bridge import BrownBridge
 from accessories.moisture_sensor import MoistureSensor
 from accessories.picamera import BrownCamera
 from accessories.watering_switch import WateringSwitch
 
+boot.TIMELINE.mark('import')
+
+# Get the bridge into the Home app sooner after a power cut: the camera is not
+# opened before the first snapshot or stream, so neither the pre-warmed
+# encoder nor the timelapse start with the bridge
+FAST_BOOT = True
+
 # FFMPEG_CMD = (
 #     'raspivid -o - -t 0 -w {width} -h {height} | '
 #     'ffmpeg -i pipe: '
@@ -19,6 +28,9 @@ from accessories.watering_switch import WateringSwitch
 #     'localrtcpport={v_port}&pkt_size=1378"'
 # )
 
+# Started once per distinct stream configuration. It sends plain RTP to local
+# ports, from where every session watching that configuration gets its own
+# SRTP-protected copy (see accessories/stream_encoder.py).
 FFMPEG_CMD = (
     #'raspivid -o - -t 0 -n -w {width} -h {height} | '
     'ffmpeg '
@@ -32,22 +44,36 @@ FFMPEG_CMD = (
     '-pix_fmt yuv420p -color_range mpeg '
     '-f rawvideo -tune zerolatency '
     '-vf scale={width}:{height} '
-    '-r {fps} ' 
+    '-r {fps} '
+    '-g {gop} -bsf:v dump_extra '
     '-vb {v_max_bitrate}k -bufsize {v_max_bitrate}k '
     '-f rtp '
-    #'-payload_type {v_payload_type} '
-    '-ssrc {v_ssrc} '
-    '-srtp_out_suite AES_CM_128_HMAC_SHA1_80 '
-    '-srtp_out_params {v_srtp_key} '
-    'srtp://{address}:{v_port}?rtcpport={v_port}&pkt_size=1378 '
-    '-re -f mp3 -i music.mp3 -vn -sn -dn ' 
+    '-payload_type 99 '
+    'rtp://127.0.0.1:{v_local_port}?rtcpport={v_local_rtcp_port}&pkt_size=1378 '
+    '-re -f mp3 -i music.mp3 -vn -sn -dn '
     '-acodec libopus -ab {a_max_bitrate}k -ac {a_channel} -ar {a_sample_rate}000 '
     '-f rtp '
-    #'-payload_type {a_payload_type} '
-    '-ssrc {a_ssrc} '
-    '-srtp_out_suite AES_CM_128_HMAC_SHA1_80 '
-    '-srtp_out_params {a_srtp_key} '
-    'srtp://{address}:{a_port}?rtcpport={a_port}&pkt_size=188'
+    '-payload_type 110 '
+    'rtp://127.0.0.1:{a_local_port}?rtcpport={a_local_rtcp_port}&pkt_size=188'
+)
+
+# Used instead with the camera broker. The H.264 the broker records is piped
+# in and only repackaged, so every session gets the broker's resolution and
+# bitrate.
+BROKER_FFMPEG_CMD = (
+    'ffmpeg '
+    '-use_wallclock_as_timestamps 1 -f h264 -i pipe:0 '
+    '-an -sn -dn '
+    '-vcodec copy '
+    '-bsf:v dump_extra '
+    '-f rtp '
+    '-payload_type 99 '
+    'rtp://127.0.0.1:{v_local_port}?rtcpport={v_local_rtcp_port}&pkt_size=1378 '
+    '-re -f mp3 -i music.mp3 -vn -sn -dn '
+    '-acodec libopus -ab {a_max_bitrate}k -ac {a_channel} -ar {a_sample_rate}000 '
+    '-f rtp '
+    '-payload_type 110 '
+    'rtp://127.0.0.1:{a_local_port}?rtcpport={a_local_rtcp_port}&pkt_size=188'
 )
 
 options = {
@@ -93,22 +119,101 @@ options = {
     },
     "srtp": True,
     "start_stream_cmd": FFMPEG_CMD,
-    # hard code the address if auto-detection does not work as desired: e.g. "192.168.1.226"
-    "address": util.get_local_address(), 
+    # seconds a snapshot is reused for Home app tile refreshes
+    "snapshot_ttl": 10,
+    # keep an encoder running for the most requested stream so the Home app
+    # shows video sooner; True, or a dict overriding the warm configuration,
+    # e.g. {"width": 640, "height": 360}. It holds the camera while idle and
+    # is stopped for a moment for snapshots and timelapse stills.
+    "prewarm": False,
+    # a still every 10 minutes, encoded on its own and appended to H.264
+    # segments in the directory; the oldest segments are removed to stay
+    # within the budget in bytes
+    "timelapse": {
+        "directory": "/home/pi/brown/timelapse",
+        "interval": 600,
+        "budget": 2 * 1024 ** 3,
+    },
+    # the resolution the camera broker (broker.py) records at, e.g. "1280x720",
+    # to take snapshots and streams from it instead of opening the camera, so
+    # the web app (with CAMERA_BROKER in server.py) can run at the same time
+    "broker": None,
+    # leave the camera closed until the first snapshot or stream
+    "lazy": FAST_BOOT,
+    # hard code the address if auto-detection does not work as desired: e.g.
+    # "192.168.1.226"; None to detect it, see local_address()
+    "address": None,
 }
+if options["broker"]:
+    options["start_stream_cmd"] = BROKER_FFMPEG_CMD
+
+# One entry per plant zone: the moisture sensor pin, the relay powering the
+# sensor (0 if it is always powered), the pump pin and the seconds the pump
+# runs every time it is switched on. All zones are sampled together. An input
+# pin wired to the pump pin can be set as "sense_pin" so that relay changes
+# made outside the bridge reach the Home app right away; without one they take
+# up to UNSENSED_RECONCILE_INTERVAL (watering_switch.py). "schedule" waters the
+# zone on a crontab schedule (minute hour day month weekday), None to only
+# water from the Home app.
+zones = [
+    {
+        "sensor": "Moisture Sensor",
+        "sensor_pin": 17,
+        "relay_pin": 26,
+        "switch": "Water",
+        "pump_pin": 21,
+        "duration": 60,
+        "sense_pin": None,
+        # Saturdays at 8:00
+        "schedule": "0 8 * * 6",
+    },
+]
+
+# Moisture readings and waterings of all zones, see timeseries.py
+HISTORY_DIR = '/home/pi/brown/history'
+# The bridge's metrics (snapshots, streams, sensors, event loop) are served
+# as http://[host_name]:9101/metrics, None to disable
+METRICS_PORT = 9101
+
+# Listen on every interface if the address cannot be detected because the
+# network is not up yet; the bridge is only advertised at its real address
+# once it is restarted with the network up
+ADDRESS_FALLBACK = "0.0.0.0"
 
 def get_bridge(driver):
-    bridge = Bridge(driver, 'Brown')
-    moisture_sensor = MoistureSensor(driver,'Moisture Sensor')
+    bridge = BrownBridge(driver, 'Brown', history_dir=HISTORY_DIR,
+        metrics_port=METRICS_PORT, timeline=boot.TIMELINE)
+    sensors = [MoistureSensor(driver, zone["sensor"],
+        sensor_pin=zone["sensor_pin"], relay_pin=zone["relay_pin"])
+        for zone in zones]
     acc = BrownCamera(options, driver, "Camera")
-    water = WateringSwitch(21, 60, False, 0, driver, "Water")
-    bridge.add_accessory(moisture_sensor)
+    switches = [WateringSwitch(zone["pump_pin"], zone["duration"], False, 0,
+        driver, zone["switch"], sense_pin=zone.get("sense_pin"))
+        for zone in zones]
+    for moisture_sensor in sensors:
+        bridge.add_accessory(moisture_sensor)
     bridge.add_accessory(acc)
-    bridge.add_accessory(water)
+    for zone, moisture_sensor, water in zip(zones, sensors, switches):
+        bridge.add_accessory(water)
+        bridge.add_zone(moisture_sensor, water, zone.get("schedule"))
 
     return bridge
 
-driver = AccessoryDriver(port=51826, persist_file='/home/pi/brown/brown.state')
+def local_address():
+    """Return the configured address, or detect it once the setup runs."""
+    if options["address"] is not None:
+        return options["address"]
+    try:
+        return util.get_local_address()
+    except OSError as e:
+        logging.warning('Could not detect the local address, using %s: %s',
+            ADDRESS_FALLBACK, e)
+        return ADDRESS_FALLBACK
+
+options["address"] = local_address()
+driver = AccessoryDriver(port=51826, address=options["address"],
+    persist_file='/home/pi/brown/brown.state')
 driver.add_accessory(accessory=get_bridge(driver))
+boot.TIMELINE.mark('setup')
 signal.signal(signal.SIGTERM, driver.signal_handler)
 driver.start()
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""Fragmented MP4 muxed from the camera's H.264, for Media Source Extensions.
+
+``Muxer`` takes the Annex B byte stream the encoder writes, in chunks of any
+size, and turns every frame into a fragment of its own (``moof`` + ``mdat``),
+so a browser can play the stream as it arrives. The ``init`` segment is
+built from the first SPS and PPS; frames before the first keyframe are
+dropped. A frame is complete when the next one starts, and lasts until then.
+"""
+import struct
+
+from time import monotonic
+
+# Ticks per second of the decode times
+TIMESCALE = 90000
+
+# NAL unit types
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+START_CODE = b'\x00\x00\x01'
+
+# Sample flags of a keyframe and of a frame depending on others
+KEYFRAME_FLAGS = 0x02000000
+FRAME_FLAGS = 0x01010000
+
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def box(kind, *payload):
+    return struct.pack('>I4s', 8 + sum(len(part) for part in payload),
+        kind) + b''.join(payload)
+
+
+def full_box(kind, version, flags, *payload):
+    return box(kind, struct.pack('>I', version << 24 | flags), *payload)
+
+
+def codec(sps):
+    """Return the RFC 6381 codec of an SPS, e.g. ``'avc1.640028'``."""
+    return 'avc1.%02x%02x%02x' % (sps[1], sps[2], sps[3])
+
+
+def init_segment(sps, pps, width, height):
+    """Return the ``ftyp`` and ``moov`` of a stream with one video track."""
+    avcc = box(b'avcC', bytes((1, sps[1], sps[2], sps[3], 0xff, 0xe1)),
+        struct.pack('>H', len(sps)), sps, b'\x01',
+        struct.pack('>H', len(pps)), pps)
+    avc1 = box(b'avc1', bytes(6), struct.pack('>H', 1), bytes(16),
+        struct.pack('>HHIIIH', width, height, 0x480000, 0x480000, 0, 1),
+        bytes(32), struct.pack('>Hh', 0x18, -1), avcc)
+    empty = struct.pack('>I', 0)
+    stbl = box(b'stbl',
+        full_box(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+        full_box(b'stts', 0, 0, empty),
+        full_box(b'stsc', 0, 0, empty),
+        full_box(b'stsz', 0, 0, empty, empty),
+        full_box(b'stco', 0, 0, empty))
+    minf = box(b'minf',
+        full_box(b'vmhd', 0, 1, bytes(8)),
+        box(b'dinf', full_box(b'dref', 0, 0, struct.pack('>I', 1),
+            full_box(b'url ', 0, 1))),
+        stbl)
+    mdia = box(b'mdia',
+        # Language 'und'
+        full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, TIMESCALE, 0,
+            0x55c4, 0)),
+        full_box(b'hdlr', 0, 0, struct.pack('>I4s', 0, b'vide'), bytes(12),
+            b'VideoHandler\x00'),
+        minf)
+    trak = box(b'trak',
+        full_box(b'tkhd', 0, 3, struct.pack('>5I', 0, 0, 1, 0, 0), bytes(8),
+            struct.pack('>4H', 0, 0, 0, 0), MATRIX,
+            struct.pack('>II', width << 16, height << 16)),
+        mdia)
+    moov = box(b'moov',
+        full_box(b'mvhd', 0, 0, struct.pack('>5IH', 0, 0, 1000, 0, 0x10000,
+            0x100), bytes(10), MATRIX, bytes(24), struct.pack('>I', 2)),
+        trak,
+        box(b'mvex', full_box(b'trex', 0, 0, struct.pack('>5I', 1, 1, 0, 0, 0))))
+    return box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom', b'iso6',
+        b'avc1', b'mp41') + moov
+
+
+def media_segment(sequence, decode_time, duration, nal_units, keyframe):
+    """Return the ``moof`` and ``mdat`` of a fragment holding one frame."""
+    size = sum(4 + len(nal) for nal in nal_units)
+    trun_flags = 0x000701  # data offset, sample duration, size and flags
+    traf = [full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1)),  # base is moof
+            full_box(b'tfdt', 1, 0, struct.pack('>Q', decode_time))]
+    # The trun is the last box of the moof, 32 bytes
+    moof_size = 8 + 16 + 8 + sum(len(part) for part in traf) + 32
+    traf.append(full_box(b'trun', 0, trun_flags, struct.pack('>IiIII', 1,
+        moof_size + 8, duration, size,
+        KEYFRAME_FLAGS if keyframe else FRAME_FLAGS)))
+    parts = [box(b'moof', full_box(b'mfhd', 0, 0, struct.pack('>I', sequence)),
+                 box(b'traf', *traf)),
+             struct.pack('>I4s', 8 + size, b'mdat')]
+    for nal in nal_units:
+        parts.append(struct.pack('>I', len(nal)))
+        parts.append(nal)
+    return b''.join(parts)
+
+
+class Muxer(object):
+    """Turn the H.264 a camera records at ``width`` x ``height`` into fMP4
+    fragments, see the module's docstring."""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.sps = None
+        self.pps = None
+        self.init = None
+        self.codec = None
+        self.sequence = 0
+        self._buffer = bytearray()
+        self._nal_units = []
+        self._keyframe = False
+        self._vcl = False
+        self._started = None
+        self._decode_time = 0
+
+    def write(self, buf):
+        """Add a chunk of the stream, returning the ``(fragment, keyframe)``
+        of the frames it completed."""
+        fragments = []
+        buffer = self._buffer
+        buffer += buf
+        start = buffer.find(START_CODE)
+        if start < 0:
+            return fragments
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(START_CODE, start + 3)
+                if end < 0:
+                    break
+                # Zeros before a start code belong to it, not to the NAL unit
+                nal = bytes(view[start + 3:end]).rstrip(b'\x00')
+                if nal:
+                    self._add(nal, fragments)
+                start = end
+        del buffer[:start]
+        # A frame ends where the next one starts, no need to wait for the
+        # whole first NAL unit of that one
+        if len(buffer) >= 5 and self._vcl and self._starts_frame(buffer[3:5]):
+            self._finish(fragments)
+        return fragments
+
+    @staticmethod
+    def _starts_frame(header):
+        kind = header[0] & 0x1f
+        if kind in (NAL_SLICE, NAL_IDR):
+            # The first slice of a frame has first_mb_in_slice 0, coded as
+            # a single 1 bit
+            return len(header) > 1 and header[1] & 0x80
+        return kind in (NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD)
+
+    def _add(self, nal, fragments):
+        if self._vcl and self._starts_frame(nal[:2]):
+            self._finish(fragments)
+        if self._started is None:
+            self._started = monotonic()
+        kind = nal[0] & 0x1f
+        if kind == NAL_SPS:
+            self.sps = nal
+        elif kind == NAL_PPS:
+            self.pps = nal
+        elif kind != NAL_AUD:
+            # Parameter sets only go in the init segment
+            self._nal_units.append(nal)
+            if kind in (NAL_SLICE, NAL_IDR):
+                self._vcl = True
+                self._keyframe = self._keyframe or kind == NAL_IDR
+
+    def _finish(self, fragments):
+        now = monotonic()
+        duration = max(1, round((now - self._started) * TIMESCALE))
+        if self.init is None and self._keyframe and self.sps and self.pps:
+            self.init = init_segment(self.sps, self.pps, self.width,
+                self.height)
+            self.codec = codec(self.sps)
+        if self.init is not None:
+            self.sequence += 1
+            fragments.append((media_segment(self.sequence, self._decode_time,
+                duration, self._nal_units, self._keyframe), self._keyframe))
+            self._decode_time += duration
+        self._nal_units = []
+        self._keyframe = False
+        self._vcl = False
+        self._started = now
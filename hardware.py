@@ -0,0 +1,343 @@
+"""GPIO and camera backends.
+
+On the Pi these are ``RPi.GPIO`` and ``picamera.PiCamera``, the latter only
+imported when a camera is opened. With the environment variable
+``BROWN_HARDWARE=fake`` they are replaced by simulated ones, so the bridge,
+the web server and the benchmarks run on any Linux box:
+
+- ``FakeGPIO`` keeps the pin levels in memory and calls the edge detection
+  callbacks when an input changes, either set by hand with ``set_input`` or
+  through an output ``link``-ed to it.
+- ``FakeCamera`` produces real baseline JPEG frames (or raw YUV ones) of any
+  size at the configured framerate, from a short pre-encoded cycle of a
+  moving gradient. Setting its ``paused`` attribute freezes the scene. Its
+  H.264 recordings only have the NAL unit structure of real ones, enough to
+  pass them around but not to decode them.
+"""
+import os
+import threading
+
+from time import monotonic, sleep
+
+BACKEND = os.environ.get('BROWN_HARDWARE', 'pi')
+
+# Pre-encoded frames per simulated recording, replayed in a loop
+FRAME_CYCLE = 30
+
+
+class FakeGPIO(object):
+    """In-memory stand-in for the ``RPi.GPIO`` module."""
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self):
+        self._mode = None
+        self.levels = {}
+        self.directions = {}
+        self.links = {}
+        self._callbacks = {}
+        self._lock = threading.RLock()
+
+    def setwarnings(self, flag):
+        pass
+
+    def getmode(self):
+        return self._mode
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    def setup(self, channel, direction, pull_up_down=None, initial=None):
+        with self._lock:
+            self.directions[channel] = direction
+            if initial is not None:
+                self.levels[channel] = initial
+            else:
+                self.levels.setdefault(channel,
+                    self.HIGH if pull_up_down == self.PUD_UP else self.LOW)
+
+    def output(self, channel, state):
+        with self._lock:
+            self.levels[channel] = int(bool(state))
+            linked = self.links.get(channel, ())
+        for pin in linked:
+            self.set_input(pin, state)
+
+    def input(self, channel):
+        return self.levels.get(channel, self.LOW)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        if self.directions.get(channel) != self.IN:
+            raise RuntimeError('You must setup() the GPIO channel as an input '
+                'first')
+        self._callbacks[channel] = (edge, callback)
+
+    def remove_event_detect(self, channel):
+        self._callbacks.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        with self._lock:
+            for pins in (self.levels, self.directions, self._callbacks):
+                if channel is None:
+                    pins.clear()
+                else:
+                    pins.pop(channel, None)
+
+    # Simulation helpers
+
+    def link(self, output, input):
+        """Wire an output pin to an input pin, like a sense wire."""
+        self.links.setdefault(output, []).append(input)
+
+    def set_input(self, channel, state):
+        """Drive an input pin, calling its edge callback on a change.
+
+        The callback runs in the calling thread instead of a GPIO thread.
+        """
+        state = int(bool(state))
+        with self._lock:
+            previous = self.levels.get(channel, self.LOW)
+            self.levels[channel] = state
+            edge, callback = self._callbacks.get(channel, (None, None))
+        if callback is None or previous == state:
+            return
+        if edge == self.BOTH or edge == (self.RISING if state else self.FALLING):
+            callback(channel)
+
+
+# Baseline JPEG encoding of a grayscale image where every 8x8 block has a
+# single level, so only the DC coefficients have to be coded.
+
+def _huffman_codes(bits, values):
+    codes = {}
+    code = 0
+    index = 0
+    for length, count in enumerate(bits, 1):
+        for _ in range(count):
+            codes[values[index]] = (code, length)
+            code += 1
+            index += 1
+        code <<= 1
+    return codes
+
+# The standard luminance DC table and an AC table with only end-of-block
+DC_BITS = (0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0)
+DC_VALUES = bytes(range(12))
+AC_BITS = (1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+AC_VALUES = b'\x00'
+DC_CODES = _huffman_codes(DC_BITS, DC_VALUES)
+EOB_CODE = _huffman_codes(AC_BITS, AC_VALUES)[0]
+
+
+def _segment(marker, payload):
+    return bytes((0xff, marker)) + (len(payload) + 2).to_bytes(2, 'big') + payload
+
+
+def jpeg_header(width, height):
+    return b''.join((
+        b'\xff\xd8',
+        # Quantization table 0, a DC step of 8 maps a level to level - 128
+        _segment(0xdb, b'\x00' + bytes([8] * 64)),
+        # Baseline, 8 bits, one component with table 0
+        _segment(0xc0, b'\x08' + height.to_bytes(2, 'big') +
+                 width.to_bytes(2, 'big') + b'\x01\x01\x11\x00'),
+        _segment(0xc4, b'\x00' + bytes(DC_BITS) + DC_VALUES),
+        _segment(0xc4, b'\x10' + bytes(AC_BITS) + AC_VALUES),
+        _segment(0xda, b'\x01\x01\x00\x00\x3f\x00'),
+    ))
+
+
+def encode_jpeg(width, height, level):
+    """Return a grayscale JPEG with ``level(column, row)`` in every block."""
+    out = bytearray(jpeg_header(width, height))
+    eob, eob_length = EOB_CODE
+    acc = 0
+    nbits = 0
+    previous = 0
+    for row in range((height + 7) // 8):
+        for column in range((width + 7) // 8):
+            dc = level(column, row) - 128
+            diff = dc - previous
+            previous = dc
+            size = abs(diff).bit_length()
+            code, length = DC_CODES[size]
+            if diff < 0:
+                diff += (1 << size) - 1
+            acc = (((acc << length | code) << size | diff) << eob_length) | eob
+            nbits += length + size + eob_length
+            while nbits >= 8:
+                nbits -= 8
+                byte = acc >> nbits
+                out.append(byte)
+                if byte == 0xff:
+                    out.append(0)
+                acc &= (1 << nbits) - 1
+    if nbits:
+        byte = (acc << (8 - nbits)) | ((1 << (8 - nbits)) - 1)
+        out.append(byte)
+        if byte == 0xff:
+            out.append(0)
+    out += b'\xff\xd9'
+    return bytes(out)
+
+
+def test_level(index):
+    """Return the level of every 8x8 block in frame ``index`` of the test
+    gradient, which moves one block per frame."""
+    return lambda column, row: (column + index) * 4 % 224 + row % 32
+
+
+def test_frame(width, height, index):
+    """Return frame ``index`` of the test gradient as a JPEG."""
+    return encode_jpeg(width, height, test_level(index))
+
+
+def test_yuv_frame(width, height, index):
+    """Return frame ``index`` of the test gradient as YUV420, padded like
+    the camera pads it to a multiple of 32 columns and 16 rows."""
+    stride = (width + 31) // 32 * 32
+    rows = (height + 15) // 16 * 16
+    level = test_level(index)
+    luma = b''.join(bytes(level(column // 8, row // 8)
+                          for column in range(stride)) for row in range(rows))
+    return luma + b'\x80' * (stride * rows // 2)
+
+
+def test_h264_chunk(index, intra_period=FRAME_CYCLE):
+    """Return chunk ``index`` of an undecodable H.264 stream, with stream
+    headers and an IDR slice every ``intra_period`` frames. Only the NAL
+    unit headers and the start of the slices are like in a real stream,
+    with the nal_ref_idc of 1 the Pi's encoder uses."""
+    start = b'\x00\x00\x00\x01'
+    if index % intra_period:
+        return start + b'\x21\x9a' + b'\x55' * 2000
+    return start + b'\x27\x64\x00\x28' + b'\x55' * 5 + \
+        start + b'\x28\xee\x3c\x80' + \
+        start + b'\x25\x88' + b'\x55' * 8000
+
+
+_frames = {}
+_frames_lock = threading.Lock()
+
+
+def test_frames(width, height, count=FRAME_CYCLE, format='jpeg'):
+    """Return the cached cycle of ``count`` test frames of a size."""
+    with _frames_lock:
+        key = (width, height, count, format)
+        if key not in _frames:
+            if format == 'h264':
+                _frames[key] = [test_h264_chunk(index, count)
+                                for index in range(count)]
+            else:
+                frame = test_yuv_frame if format == 'yuv' else test_frame
+                _frames[key] = [frame(width, height, index)
+                                for index in range(count)]
+        return _frames[key]
+
+
+def _size(value):
+    if isinstance(value, str):
+        width, height = value.split('x')
+        return int(width), int(height)
+    return tuple(value)
+
+
+class FakeCamera(object):
+    """Stand-in for ``picamera.PiCamera`` producing test JPEG frames."""
+
+    def __init__(self, resolution=(1280, 720), framerate=30, **kwargs):
+        self.resolution = _size(resolution)
+        self.framerate = framerate
+        self.rotation = 0
+        self.paused = False
+        self.closed = False
+        self._recordings = {}
+        self._captures = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for port in list(self._recordings):
+            self.stop_recording(splitter_port=port)
+        self.closed = True
+
+    def capture(self, output, format='jpeg', use_video_port=False,
+                resize=None, **options):
+        width, height = _size(resize or self.resolution)
+        frame = test_frame(width, height, self._captures)
+        self._captures += 1
+        if isinstance(output, str):
+            with open(output, 'wb') as output_file:
+                output_file.write(frame)
+        else:
+            output.write(frame)
+
+    def start_recording(self, output, format='mjpeg', splitter_port=1,
+                        resize=None, **options):
+        if splitter_port in self._recordings:
+            raise RuntimeError('The camera is already using port %d' % splitter_port)
+        width, height = _size(resize or self.resolution)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._record,
+            args=(output, test_frames(width, height,
+                  options.get('intra_period', FRAME_CYCLE), format=format),
+                  format == 'mjpeg', stop), daemon=True)
+        self._recordings[splitter_port] = (thread, stop)
+        thread.start()
+
+    def _record(self, output, frames, split, stop):
+        interval = 1.0 / self.framerate
+        deadline = monotonic()
+        index = 0
+        while not stop.is_set():
+            frame = frames[index % len(frames)]
+            if split:
+                # The real encoder hands frames over in several buffers too
+                half = len(frame) // 2
+                output.write(frame[:half])
+                output.write(frame[half:])
+            else:
+                # Unencoded frames come in one buffer each
+                output.write(frame)
+            if not self.paused:
+                index += 1
+            deadline += interval
+            delay = deadline - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        sleep(timeout)
+
+    def stop_recording(self, splitter_port=1):
+        thread, stop = self._recordings.pop(splitter_port)
+        stop.set()
+        thread.join()
+
+
+if BACKEND == 'fake':
+    GPIO = FakeGPIO()
+    PiCamera = FakeCamera
+else:
+    import RPi.GPIO as GPIO
+
+    def PiCamera(*args, **kwargs):  # pylint: disable=invalid-name
+        """Open the camera. ``picamera`` loads the camera's libraries, so it
+        is only imported once a camera is opened."""
+        from picamera import PiCamera as camera  # pylint: disable=import-outside-toplevel
+        return camera(*args, **kwargs)
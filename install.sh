@@ -10,7 +10,7 @@ fi
 PACKAGES="python3 libavahi-compat-libdnssd-dev"
 apt-get update
 apt-get install $PACKAGES -y
-pip install picamera gpiozero HAP-python[QRCode]
+pip install picamera numpy gpiozero HAP-python[QRCode]
 
 ## Enable Camera Interface
 CONFIG="/boot/config.txt"
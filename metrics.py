@@ -0,0 +1,223 @@
+"""Counters, gauges and histograms exposed in the Prometheus text format.
+
+Every process keeps its metrics in ``REGISTRY``; modules declare theirs at
+import time::
+
+    FRAMES = metrics.counter('mjpeg_frames_produced_total',
+        'Frames produced by the camera', ['size'])
+    FRAMES.labels('1280x720').inc()
+
+Gauges can also be computed when they are scraped with ``set_function``,
+returning either a value or a dict of label values to values.
+"""
+import asyncio
+import math
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\')
+        .replace('"', r'\"').replace('\n', r'\n')) for name, value in pairs)
+
+
+class _Child(object):
+    """One labelled series of a metric."""
+    __slots__ = ('_metric', '_key')
+
+    def __init__(self, metric, key):
+        self._metric = metric
+        self._key = key
+
+    def inc(self, amount=1):
+        self._metric._inc(self._key, amount)
+
+    def dec(self, amount=1):
+        self._metric._inc(self._key, -amount)
+
+    def set(self, value):
+        self._metric._set(self._key, value)
+
+    def observe(self, value):
+        self._metric._observe(self._key, value)
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError('%s takes the labels %s' % (self.name, self.labelnames))
+        return _Child(self, tuple(str(value) for value in values))
+
+    def remove(self, *values):
+        with self._lock:
+            self._values.pop(tuple(str(value) for value in values), None)
+
+    def set_function(self, function):
+        """Compute the metric from ``function`` whenever it is rendered."""
+        self._function = function
+
+    # Unlabelled metrics
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def set(self, value):
+        self._set((), value)
+
+    def observe(self, value):
+        self._observe((), value)
+
+    def _inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def _observe(self, key, value):
+        raise TypeError('%s is not a histogram' % self.name)
+
+    def _samples(self):
+        if self._function is not None:
+            values = self._function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [('', (key,) if isinstance(key, str) else key, (), value)
+                    for key, value in values.items()]
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, key, extra, value in self._samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                _format_labels(self.labelnames, key, extra), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def _observe(self, key, value):
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            series[1] += value
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            items = [(key, list(counts), total)
+                     for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', _format_value(bound)),),
+                    cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Duplicate metric %s' % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        return ('\n'.join(metric.render() for metric in
+            list(self.metrics.values())) + '\n').encode('utf-8')
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=(), registry=REGISTRY):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), registry=REGISTRY):
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=BUCKETS,
+              registry=REGISTRY):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+async def serve(address, registry=REGISTRY):
+    """Serve ``/metrics`` over HTTP from the running event loop."""
+
+    async def handle(reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            path = request.split(b' ', 2)[1].split(b'?')[0]
+            if path == b'/metrics':
+                status, content = '200 OK', registry.render()
+            else:
+                status, content = '404 Not Found', b''
+            writer.write(('HTTP/1.0 %s\r\nContent-Type: %s\r\n'
+                'Content-Length: %d\r\n\r\n' % (status, CONTENT_TYPE,
+                len(content))).encode('latin-1') + content)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                IndexError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, *address, reuse_address=True)
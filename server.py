@@ -1,9 +1,28 @@
-import io
-import picamera
+import asyncio
+import base64
+import fcntl
+import hashlib
+import json
 import logging
+import math
 import socketserver
-from threading import Condition
-from http import server
+import struct
+import termios
+from contextlib import contextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from functools import partial
+from threading import Condition, Event, Lock, Thread
+from http import HTTPStatus, server
+from time import monotonic, time
+from urllib.parse import urlsplit, parse_qs
+
+import numpy
+
+import broker
+import fmp4
+import metrics
+from hardware import PiCamera
+from timeseries import TimeSeriesStore
 
 PAGE="""\
 <html>
@@ -12,79 +31,1165 @@ PAGE="""\
 </head>
 <body>
 <center><h1>Brown Capability - Live Feed</h1></center>
-<center><img src="stream.mjpg" width="1280" height="720"></center>
+<center>
+<video id="live" width="{width}" height="{height}" autoplay muted playsinline hidden></video>
+<img id="mjpeg" width="{width}" height="{height}" hidden>
+</center>
+<script>
+// The H.264 live view, or the MJPEG stream where it cannot be played
+var live = {live};
+var video = document.getElementById('live');
+var img = document.getElementById('mjpeg');
+
+function playMjpeg() {{
+    video.hidden = true;
+    if (!img.getAttribute('src')) {{
+        img.src = 'stream.mjpg?size={size}';
+    }}
+    img.hidden = false;
+}}
+
+function playLive() {{
+    var socket = new WebSocket((location.protocol == 'https:' ? 'wss://' : 'ws://') +
+        location.host + '/live.ws');
+    var source = new MediaSource();
+    var buffer = null;
+    var queue = [];
+    socket.binaryType = 'arraybuffer';
+
+    function append() {{
+        if (buffer && !buffer.updating && queue.length) {{
+            buffer.appendBuffer(queue.shift());
+        }}
+    }}
+
+    function keepUp() {{
+        // Stay close to the newest frame and drop what was played
+        var ranges = buffer.buffered;
+        if (!ranges.length) {{
+            return;
+        }}
+        var start = ranges.start(ranges.length - 1);
+        var end = ranges.end(ranges.length - 1);
+        if (video.currentTime < start || end - video.currentTime > {lag}) {{
+            video.currentTime = Math.max(start, end - 0.1);
+        }} else if (video.currentTime - ranges.start(0) > 30) {{
+            buffer.remove(0, video.currentTime - 10);
+        }}
+    }}
+
+    socket.onmessage = function (event) {{
+        if (typeof event.data == 'string') {{
+            var type = 'video/mp4; codecs="' + JSON.parse(event.data).codec + '"';
+            if (!MediaSource.isTypeSupported(type)) {{
+                socket.close();
+                return;
+            }}
+            source.addEventListener('sourceopen', function () {{
+                buffer = source.addSourceBuffer(type);
+                buffer.addEventListener('updateend', function () {{
+                    if (!buffer.updating) {{
+                        keepUp();
+                    }}
+                    append();
+                }});
+                append();
+            }});
+            video.src = URL.createObjectURL(source);
+            video.hidden = false;
+        }} else {{
+            queue.push(event.data);
+            append();
+        }}
+    }};
+    socket.onclose = playMjpeg;
+}}
+
+if (live && window.MediaSource) {{
+    playLive();
+}} else {{
+    playMjpeg();
+}}
+</script>
 </body>
 </html>
 """
 
+RESOLUTION = '1280x720'
+FRAMERATE = 30
+# Additional stream sizes, resized by the GPU on the camera's splitter ports
+# and served as /stream.mjpg?size=WxH. The camera has four splitter ports, the
+# full resolution stream uses the first one, then come these, motion
+# detection and the live view. A JPEG quality (1-100) may follow the size,
+# e.g. '1280x720@40', for another quality tier of the same size.
+STREAM_SIZES = ['640x360']
+
+# Adaptive quality. A client of one of these streams is moved to the next one
+# when it falls behind, and back up, at most to the stream it asked for, once
+# it keeps up again. The browser scales the lower tiers to the page's size.
+STREAM_TIERS = [RESOLUTION, '640x360']
+# A client falls behind when on average sending it a frame takes longer than
+# TIER_MAX_LATENCY seconds or more than TIER_MAX_BACKLOG frames still wait in
+# its socket, unacknowledged, when the next one is sent. It keeps up when it
+# stays under TIER_MIN_LATENCY and TIER_MIN_BACKLOG for TIER_UP_HOLD seconds,
+# which doubles every time it has to be moved down again right after being
+# moved up.
+TIER_MAX_LATENCY = 0.25
+TIER_MAX_BACKLOG = 3
+TIER_MIN_LATENCY = 0.05
+TIER_MIN_BACKLOG = 0.5
+TIER_UP_HOLD = 10
+TIER_MAX_UP_HOLD = 160
+# Weight of the newest frame in the averages
+TIER_SMOOTHING = 0.2
+
+# Live view of the index page: H.264 from the GPU encoder at RESOLUTION,
+# muxed into fragmented MP4 and pushed over a WebSocket (/live.ws) to a Media
+# Source Extensions player. One encode is shared by all viewers and takes a
+# fraction of the bandwidth of the MJPEG stream, which remains the fallback.
+LIVE_H264 = True
+LIVE_BITRATE = 1000000
+# Seconds between two keyframes. Viewers start at the newest one and a viewer
+# falling behind by more than that skips to it.
+LIVE_KEYFRAME_INTERVAL = 2
+# Seconds the player may lag behind the newest frame before it jumps ahead
+LIVE_MAX_LAG = 1
+
+# Motion-aware frame rate. A small YUV copy of the video from another splitter
+# port is compared with its previous one every MOTION_CHECK_INTERVAL seconds.
+# Once nothing moved for MOTION_HOLD seconds the streams are only sent at
+# IDLE_FRAMERATE, and at full rate again as soon as something moves.
+MOTION_DETECTION = True
+MOTION_SIZE = (160, 96)
+MOTION_CHECK_INTERVAL = 0.2
+MOTION_HOLD = 10
+IDLE_FRAMERATE = 1
+# A pixel changed if its luma moved by more than MOTION_PIXEL_THRESHOLD, and
+# something moved if at least MOTION_AREA of the pixels changed.
+MOTION_PIXEL_THRESHOLD = 24
+MOTION_AREA = 0.005
+
+# 'threaded' serves every client from its own thread. 'asyncio' serves all
+# clients from one event loop, always sending the newest frame and skipping
+# the ones a client's socket was too backed up to take.
+STREAM_MODE = 'threaded'
+# Take the frames from the camera broker (broker.py) instead of opening the
+# camera, so that the bridge can use the camera at the same time
+CAMERA_BROKER = False
+MAX_STREAM_CLIENTS = 8
+# Seconds a single frame may take to reach a client before the client is
+# dropped, so a stalled socket cannot pin a ring slot forever.
+STREAM_SEND_TIMEOUT = 10
+
+# Number of preallocated JPEG frame slots in the ring and their initial size.
+# Every client pins at most one slot, so there is always one left for the
+# camera next to the newest frame. A slot only grows (once) if a frame does
+# not fit in it.
+FRAME_SLOTS = MAX_STREAM_CLIENTS + 2
+FRAME_SLOT_SIZE = 256 * 1024
+
+# Moisture readings and waterings written by the bridge (see capability.py),
+# served downsampled as /history?start=&end=&buckets=&zone=
+HISTORY_DIR = '/home/pi/brown/history'
+HISTORY_RANGE = 24 * 3600
+HISTORY_BUCKETS = 96
+MAX_HISTORY_BUCKETS = 1000
+
+# The newest frame of a stream is served as /snapshot.jpg?size=&max_age=,
+# with an ETag and Last-Modified so pollers get a 304 while they have it.
+# ETags include the server's start time, since sequences restart with it.
+SNAPSHOT_ETAG = '"%x-{size}-{sequence}"' % int(time())
+
+# RFC 6455
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+WEBSOCKET_TEXT = 0x1
+WEBSOCKET_BINARY = 0x2
+
+# Served as /metrics in the Prometheus text format
+CLIENTS = metrics.gauge('mjpeg_clients',
+    'Connected MJPEG stream clients', ['size'])
+FRAMES_PRODUCED = metrics.counter('mjpeg_frames_produced_total',
+    'JPEG frames published by the camera', ['size'])
+FRAMES_RING_DROPPED = metrics.counter('mjpeg_frames_ring_dropped_total',
+    'JPEG frames dropped because every ring slot was busy', ['size'])
+FRAMES_THROTTLED = metrics.counter('mjpeg_frames_throttled_total',
+    'JPEG frames left out while the scene was static', ['size'])
+MOTION = metrics.gauge('mjpeg_motion',
+    'Whether the streams are at full rate because something moved')
+SNAPSHOTS = metrics.counter('mjpeg_snapshots_total',
+    'Snapshot requests by response status', ['size', 'status'])
+FRAMES_SENT = metrics.counter('mjpeg_client_frames_sent_total',
+    'JPEG frames sent to a client', ['size', 'client'])
+FRAMES_SKIPPED = metrics.counter('mjpeg_client_frames_skipped_total',
+    'JPEG frames a client was too slow to be sent', ['size', 'client'])
+BYTES_SENT = metrics.counter('mjpeg_bytes_sent_total',
+    'JPEG bytes sent to all clients', ['size'])
+FRAME_HANDOFF = metrics.histogram('mjpeg_frame_handoff_seconds',
+    'Time from a frame being published to it being written to a client',
+    ['size'])
+LIVE_CLIENTS = metrics.gauge('live_clients',
+    'Clients watching the H.264 live view')
+LIVE_FRAGMENTS = metrics.counter('live_fragments_produced_total',
+    'Frames of the live view muxed into fragments')
+LIVE_FRAGMENTS_SENT = metrics.counter('live_fragments_sent_total',
+    'Live view fragments sent to the clients')
+LIVE_FRAGMENTS_SKIPPED = metrics.counter('live_fragments_skipped_total',
+    'Live view fragments clients were too slow for, skipping to a keyframe')
+LIVE_BYTES_SENT = metrics.counter('live_bytes_sent_total',
+    'Bytes of live view fragments sent to the clients')
+TIER_CLIENTS = metrics.gauge('mjpeg_tier_clients',
+    'Clients being sent a stream, by the stream they are on', ['size'])
+TIER_CHANGES = metrics.counter('mjpeg_tier_changes_total',
+    'Clients moved to a lower or higher quality stream',
+    ['size', 'direction'])
+
 class StreamingOutput(object):
-    def __init__(self):
-        self.frame = None
-        self.buffer = io.BytesIO()
+    """Ring of preallocated frame slots filled by the camera thread.
+
+    Every complete frame gets a sequence number. Clients read the newest frame
+    through a ``memoryview`` of its slot while holding a pin on it, so the
+    camera never overwrites a frame that is still being sent and no frame is
+    copied or allocated on the way to the clients.
+
+    If ``handoff`` is given, the time from a frame being published to a client
+    leaving the ``frame`` block is observed into it. While ``min_interval`` is
+    set, frames starting sooner than that after the newest one are left out.
+    """
+    def __init__(self, slots=FRAME_SLOTS, slot_size=FRAME_SLOT_SIZE,
+                 handoff=None):
+        self.slots = [bytearray(slot_size) for _ in range(slots)]
+        self.lengths = [0] * slots
+        self.sequences = [0] * slots
+        self.published = [0.0] * slots
+        self.modified = [0.0] * slots
+        self.pins = [0] * slots
+        self.sequence = 0
+        self.latest = None
+        self.dropped = 0
+        self.throttled = 0
+        self.min_interval = 0
         self.condition = Condition()
+        self.listeners = []
+        self.handoff = handoff
+        self._slot = 0
+        self._pos = 0
+        self._skip = True
 
     def write(self, buf):
-        if buf.startswith(b'\xff\xd8'):
-            # New frame, copy the existing buffer's content and notify all
-            # clients it's available
-            self.buffer.truncate()
+        if buf[:2] == b'\xff\xd8':
+            # New frame, publish the finished one and notify all clients
+            # it's available
+            if self._pos and not self._skip:
+                self._publish()
+            self._next_slot()
+        if self._skip:
+            return len(buf)
+        slot = self.slots[self._slot]
+        end = self._pos + len(buf)
+        if end > len(slot):
+            grown = bytearray(max(end, 2 * len(slot)))
+            grown[:self._pos] = slot[:self._pos]
+            self.slots[self._slot] = slot = grown
+        slot[self._pos:end] = buf
+        self._pos = end
+        return len(buf)
+
+    def _publish(self):
+        with self.condition:
+            self.sequence += 1
+            self.lengths[self._slot] = self._pos
+            self.sequences[self._slot] = self.sequence
+            self.published[self._slot] = monotonic()
+            self.modified[self._slot] = time()
+            self.latest = self._slot
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def _next_slot(self):
+        # Pick the next slot that is neither pinned by a client nor holding
+        # the newest frame. If every slot is busy the incoming frame is dropped.
+        self._pos = 0
+        if self.min_interval and self.latest is not None and \
+                monotonic() - self.published[self.latest] < self.min_interval:
+            self._skip = True
+            self.throttled += 1
+            return
+        count = len(self.slots)
+        with self.condition:
+            for step in range(1, count + 1):
+                index = (self._slot + step) % count
+                if not self.pins[index] and index != self.latest:
+                    self._slot = index
+                    self._skip = False
+                    return
+            self._skip = True
+            self.dropped += 1
+
+    @contextmanager
+    def frame(self, last_sequence=0):
+        """Wait for a frame newer than ``last_sequence`` and pin it.
+
+        Yields the frame's sequence number and a ``memoryview`` of the frame,
+        which is only valid inside the ``with`` block.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > last_sequence)
+            index = self.latest
+            sequence = self.sequence
+            self.pins[index] += 1
+        view = memoryview(self.slots[index])[:self.lengths[index]]
+        try:
+            yield sequence, view
+            if self.handoff is not None:
+                self.handoff.observe(monotonic() - self.published[index])
+        finally:
+            view.release()
+            with self.condition:
+                self.pins[index] -= 1
+
+    def copy_latest(self):
+        """Return a ``Snapshot`` of the newest frame, None before the first."""
+        with self.condition:
+            index = self.latest
+            if index is None:
+                return None
+            self.pins[index] += 1
+        try:
+            with memoryview(self.slots[index]) as slot:
+                return Snapshot(self.sequences[index], self.published[index],
+                    self.modified[index], bytes(slot[:self.lengths[index]]))
+        finally:
             with self.condition:
-                self.frame = self.buffer.getvalue()
+                self.pins[index] -= 1
+
+class Snapshot(object):
+    """A frame copied out of the ring, with its sequence number and the
+    monotonic and wall time it was published at."""
+    __slots__ = ('sequence', 'published', 'modified', 'jpeg')
+
+    def __init__(self, sequence, published, modified, jpeg):
+        self.sequence = sequence
+        self.published = published
+        self.modified = modified
+        self.jpeg = jpeg
+
+class MotionDetector(object):
+    """Throttle the ``StreamingOutput``s while the scene is static.
+
+    The camera records small YUV frames into it, one frame per ``write``.
+    The luma of a frame is compared with the one of the previously checked
+    frame, all pixels at once.
+    """
+    def __init__(self, outputs, size=MOTION_SIZE,
+                 check_interval=MOTION_CHECK_INTERVAL, hold=MOTION_HOLD,
+                 idle_framerate=IDLE_FRAMERATE,
+                 pixel_threshold=MOTION_PIXEL_THRESHOLD, area=MOTION_AREA):
+        self.outputs = outputs
+        self.width, self.height = size
+        # The camera pads the frames to 32 columns and 16 rows
+        self.stride = (self.width + 31) // 32 * 32
+        self.rows = (self.height + 15) // 16 * 16
+        self.check_interval = check_interval
+        self.hold = hold
+        self.idle_interval = 1.0 / idle_framerate
+        self.pixel_threshold = pixel_threshold
+        self.min_changed = int(area * self.width * self.height)
+        self.moving = True
+        self.last_motion = monotonic()
+        self._previous = None
+        self._last_check = 0.0
+
+    def write(self, buf):
+        now = monotonic()
+        if now - self._last_check >= self.check_interval:
+            self._last_check = now
+            self.check(buf, now)
+        return len(buf)
+
+    def check(self, frame, now):
+        luma = numpy.frombuffer(frame, dtype=numpy.uint8,
+            count=self.stride * self.rows).reshape(self.rows, self.stride)
+        luma = luma[:self.height, :self.width].astype(numpy.int16)
+        previous, self._previous = self._previous, luma
+        if previous is None:
+            return
+        changed = numpy.count_nonzero(
+            numpy.abs(luma - previous) > self.pixel_threshold)
+        if changed >= self.min_changed:
+            self.last_motion = now
+            if not self.moving:
+                logging.info('Motion detected, streaming at full frame rate')
+                self._set_moving(True)
+        elif self.moving and now - self.last_motion >= self.hold:
+            logging.info('Scene static for %d s, streaming at %g fps',
+                self.hold, 1.0 / self.idle_interval)
+            self._set_moving(False)
+
+    def _set_moving(self, moving):
+        self.moving = moving
+        MOTION.set(int(moving))
+        for output in self.outputs.values():
+            output.min_interval = 0 if moving else self.idle_interval
+
+class QualityTiers(object):
+    """The stream one client is sent, moved along ``tiers`` as it keeps up.
+
+    ``observe`` is called after every frame sent with the time the send
+    took and the bytes of earlier frames still in the client's socket when
+    it started. A client starts on the stream it asked for and never goes
+    above it. The tiers are those of ``streams`` that are recorded; clients
+    of other streams stay on them.
+    """
+    def __init__(self, size, streams, tiers=STREAM_TIERS):
+        self.tiers = [tier for tier in tiers if tier in streams]
+        if size not in self.tiers:
+            self.tiers = [size]
+        self.top = self.index = self.tiers.index(size)
+        self.up_hold = TIER_UP_HOLD
+        self.latency = 0.0
+        self.backlog = 0.0
+        self._changed = monotonic()
+        self._moved_up = False
+        self._calm_since = None
+        TIER_CLIENTS.labels(self.size).inc()
+
+    @property
+    def size(self):
+        return self.tiers[self.index]
+
+    def observe(self, latency, backlog, frame_length):
+        """Average a frame's send ``latency`` and the socket's ``backlog``
+        in bytes before it, and move to another tier if need be. Returns
+        True if the client was moved, so its next frame comes from the new
+        ``size``."""
+        now = monotonic()
+        self.latency += TIER_SMOOTHING * (latency - self.latency)
+        self.backlog += TIER_SMOOTHING * (
+            backlog / max(frame_length, 1) - self.backlog)
+        if self.latency > TIER_MAX_LATENCY or self.backlog > TIER_MAX_BACKLOG:
+            if self.index + 1 < len(self.tiers):
+                if self._moved_up and now - self._changed < self.up_hold:
+                    # The higher tier was too much after all
+                    self.up_hold = min(2 * self.up_hold, TIER_MAX_UP_HOLD)
+                return self._move(1, now)
+            self._calm_since = None
+        elif self.latency < TIER_MIN_LATENCY and self.backlog < TIER_MIN_BACKLOG:
+            if self._calm_since is None:
+                self._calm_since = now
+            if self.index > self.top and now - self._calm_since >= self.up_hold \
+                    and now - self._changed >= self.up_hold:
+                return self._move(-1, now)
+        else:
+            self._calm_since = None
+        return False
+
+    def _move(self, step, now):
+        TIER_CLIENTS.labels(self.size).dec()
+        self.index += step
+        TIER_CLIENTS.labels(self.size).inc()
+        TIER_CHANGES.labels(self.size, 'down' if step > 0 else 'up').inc()
+        self._moved_up = step < 0
+        self._changed = now
+        self._calm_since = None
+        # The averages were of the previous tier's frames
+        self.latency = 0.0
+        self.backlog = 0.0
+        return True
+
+    def close(self):
+        TIER_CLIENTS.labels(self.size).dec()
+
+class LiveOutput(object):
+    """H.264 recorded at ``size``, muxed into fMP4 fragments for the live view.
+
+    The camera thread writes the stream and every frame becomes a fragment.
+    The fragments since the newest keyframe are kept, so a new viewer starts
+    at once from that keyframe, and a viewer that fell further behind skips
+    ahead to it. Fragments are immutable ``bytes`` shared by all viewers.
+    """
+    def __init__(self, size):
+        self.muxer = fmp4.Muxer(*parse_size(size))
+        self.fragments = []
+        self.sequence = 0
+        self.condition = Condition()
+        self.listeners = []
+
+    def write(self, buf):
+        fragments = self.muxer.write(buf)
+        if fragments:
+            with self.condition:
+                for fragment, keyframe in fragments:
+                    self.sequence += 1
+                    if keyframe:
+                        self.fragments = []
+                    self.fragments.append((self.sequence, fragment))
                 self.condition.notify_all()
-            self.buffer.seek(0)
-        return self.buffer.write(buf)
+            for listener in self.listeners:
+                listener()
+        return len(buf)
+
+    def since(self, last_sequence):
+        """Return the newest sequence, the fragments after ``last_sequence``
+        and how many were skipped to get to the newest keyframe."""
+        with self.condition:
+            if self.sequence <= last_sequence:
+                return last_sequence, [], 0
+            first = self.fragments[0][0]
+            skipped = 0
+            if last_sequence < first - 1:
+                if last_sequence:
+                    skipped = first - 1 - last_sequence
+                last_sequence = first - 1
+            return self.sequence, [fragment for _, fragment in
+                self.fragments[last_sequence + 1 - first:]], skipped
+
+    def wait(self, last_sequence):
+        """Like ``since``, once there is something after ``last_sequence``."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > last_sequence)
+        return self.since(last_sequence)
+
+    def intro(self):
+        """Return the WebSocket messages a viewer starts with: the codec, as
+        JSON, and the init segment. None before the first keyframe."""
+        if self.muxer.init is None:
+            return None
+        codec = json.dumps({'codec': self.muxer.codec}).encode('utf-8')
+        return [websocket_header(len(codec), WEBSOCKET_TEXT), codec,
+                websocket_header(len(self.muxer.init)), self.muxer.init]
+
+def websocket_accept(headers):
+    """Return the Sec-WebSocket-Accept of an upgrade request, None if the
+    request is not a WebSocket one."""
+    key = headers.get('Sec-Websocket-Key')
+    if not key or headers.get('Upgrade', '').lower() != 'websocket':
+        return None
+    return base64.b64encode(hashlib.sha1(key.strip().encode('latin-1') +
+        WEBSOCKET_GUID).digest()).decode('ascii')
+
+def websocket_response(accept):
+    """Return the response switching a request over to the WebSocket."""
+    return ('HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: %s\r\n\r\n' % accept).encode('latin-1')
+
+def websocket_header(length, opcode=WEBSOCKET_BINARY):
+    """Return the header of an unmasked, unfragmented WebSocket message."""
+    if length < 126:
+        return bytes((0x80 | opcode, length))
+    if length < 1 << 16:
+        return bytes((0x80 | opcode, 126)) + length.to_bytes(2, 'big')
+    return bytes((0x80 | opcode, 127)) + length.to_bytes(8, 'big')
+
+@contextmanager
+def live_metrics():
+    """Count a live view client, yielding the sent, skipped and bytes
+    counters."""
+    LIVE_CLIENTS.inc()
+    try:
+        yield LIVE_FRAGMENTS_SENT, LIVE_FRAGMENTS_SKIPPED, LIVE_BYTES_SENT
+    finally:
+        LIVE_CLIENTS.dec()
+
+# One StreamingOutput per stream size, each shared by all of its clients
+outputs = {}
+# The LiveOutput, with LIVE_H264
+live = None
+
+def parse_size(size):
+    width, height = size.split('@')[0].split('x')
+    return int(width), int(height)
+
+def stream_quality(size):
+    """Return the JPEG quality of a stream, None for the encoder's default."""
+    _, at, quality = size.partition('@')
+    return int(quality) if at else None
+
+def _output_counts(attribute):
+    return {size: getattr(output, attribute) for size, output in outputs.items()}
+
+FRAMES_PRODUCED.set_function(partial(_output_counts, 'sequence'))
+FRAMES_RING_DROPPED.set_function(partial(_output_counts, 'dropped'))
+FRAMES_THROTTLED.set_function(partial(_output_counts, 'throttled'))
+LIVE_FRAGMENTS.set_function(lambda: live.sequence if live is not None else 0)
+
+@contextmanager
+def client_metrics(size, client):
+    """Count a connected client, yielding its sent, skipped and bytes counters.
+
+    The client's own series are removed once it disconnects.
+    """
+    client = '%s:%s' % client[:2]
+    CLIENTS.labels(size).inc()
+    try:
+        yield (FRAMES_SENT.labels(size, client),
+               FRAMES_SKIPPED.labels(size, client), BYTES_SENT.labels(size))
+    finally:
+        CLIENTS.labels(size).dec()
+        FRAMES_SENT.remove(size, client)
+        FRAMES_SKIPPED.remove(size, client)
+
+def socket_backlog(sock):
+    """Return the bytes written to a socket that its peer has not
+    acknowledged yet, 0 if the system does not tell."""
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ,
+            b'\0\0\0\0'))[0]
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+def requested_size(query):
+    """Return the stream size asked for in ``query``, None if it isn't served."""
+    size = parse_qs(query).get('size', [RESOLUTION])[0]
+    return size if size in outputs else None
+
+history = {name: TimeSeriesStore(HISTORY_DIR, name)
+           for name in ('moisture', 'watering')}
+
+def history_response(query):
+    """Return the JSON of the downsampled history asked for in ``query``.
+
+    ``end`` defaults to now and ``start`` to a day before it, ``buckets``
+    sets the number of buckets. The default end is rounded up to a whole
+    bucket so that clients polling the same range share cached results.
+    The bridge writes the records out every ``timeseries.FLUSH_INTERVAL``
+    seconds, so the newest minute or so is not in the answer yet. Raises
+    ValueError for a bad query.
+    """
+    params = {name: int(values[0]) for name, values in parse_qs(query).items()
+              if name in ('start', 'end', 'buckets', 'zone')}
+    buckets = params.get('buckets', HISTORY_BUCKETS)
+    if not 0 < buckets <= MAX_HISTORY_BUCKETS:
+        raise ValueError('buckets must be between 1 and %d' % MAX_HISTORY_BUCKETS)
+    now = int(time())
+    end = params.get('end')
+    start = params.get('start')
+    if start is None:
+        span = HISTORY_RANGE
+    else:
+        span = (now if end is None else end) - start
+    if span <= 0:
+        raise ValueError('start must be before end')
+    step = -(-span // buckets)
+    if end is None:
+        end = -(-now // step) * step
+    if start is None:
+        start = end - span
+    else:
+        # Rounding end up stretched the range, keep it to ``buckets`` buckets
+        step = -(-(end - start) // buckets)
+    zone = params.get('zone')
+    result = {'start': start, 'end': end, 'step': step}
+    for name, store in history.items():
+        result[name] = store.query(start, end, step, zone)
+    return json.dumps(result).encode('utf-8')
+
+# Last Snapshot served per stream size
+snapshots = {}
+snapshots_lock = Lock()
+
+def latest_snapshot(size, max_age=0):
+    """Return the newest ``Snapshot`` of a stream, None before its first frame.
+
+    A frame is copied out of the ring once, however many requests it serves.
+    The last snapshot served is returned again while it is the newest frame,
+    or while it was published at most ``max_age`` seconds ago.
+    """
+    output = outputs[size]
+    with snapshots_lock:
+        snapshot = snapshots.get(size)
+        if snapshot is None or (snapshot.sequence != output.sequence and
+                monotonic() - snapshot.published > max_age):
+            snapshot = output.copy_latest()
+            if snapshot is not None:
+                snapshots[size] = snapshot
+        return snapshot
+
+def snapshot_response(size, query, headers):
+    """Return the status, headers and content answering a /snapshot.jpg
+    request with the request ``headers``.
+
+    Raises ValueError for a bad query.
+    """
+    max_age = float(parse_qs(query).get('max_age', ['0'])[0])
+    if not math.isfinite(max_age) or max_age < 0:
+        raise ValueError('max_age must be a non-negative number')
+    snapshot = latest_snapshot(size, max_age)
+    if snapshot is None:
+        SNAPSHOTS.labels(size, 503).inc()
+        return HTTPStatus.SERVICE_UNAVAILABLE, [('Retry-After', 1)], b''
+    etag = SNAPSHOT_ETAG.format(size=size, sequence=snapshot.sequence)
+    response_headers = [
+        ('ETag', etag),
+        ('Last-Modified', formatdate(snapshot.modified, usegmt=True)),
+        ('Cache-Control', 'no-cache'),
+    ]
+    if_none_match = headers.get('If-None-Match')
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_none_match is not None:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(',')]
+    elif if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            since = None
+        not_modified = since is not None and int(snapshot.modified) <= since
+    else:
+        not_modified = False
+    if not_modified:
+        SNAPSHOTS.labels(size, 304).inc()
+        return HTTPStatus.NOT_MODIFIED, response_headers, b''
+    SNAPSHOTS.labels(size, 200).inc()
+    response_headers.append(('Content-Type', 'image/jpeg'))
+    return HTTPStatus.OK, response_headers, snapshot.jpeg
+
+def render_page(size):
+    width, height = parse_size(size)
+    return PAGE.format(size=size, width=width, height=height,
+        live='true' if live is not None else 'false',
+        lag=LIVE_MAX_LAG).encode('utf-8')
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
+    # A blocked send gives up after this, releasing the client's frame
+    timeout = STREAM_SEND_TIMEOUT
+
     def do_GET(self):
-        if self.path == '/':
+        url = urlsplit(self.path)
+        size = requested_size(url.query)
+        if url.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
             self.end_headers()
-        elif self.path == '/index.html':
-            content = PAGE.encode('utf-8')
+        elif url.path == '/index.html' and size:
+            content = render_page(size)
             self.send_response(200)
             self.send_header('Content-Type', 'text/html')
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
-        elif self.path == '/stream.mjpg':
+        elif url.path == '/history':
+            try:
+                content = history_response(url.query)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
             self.send_response(200)
-            self.send_header('Age', 0)
-            self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', len(content))
             self.end_headers()
+            self.wfile.write(content)
+        elif url.path == '/snapshot.jpg' and size:
             try:
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-            except Exception as e:
-                logging.warning(
-                    'Removed streaming client %s: %s',
-                    self.client_address, str(e))
+                status, headers, content = snapshot_response(size, url.query,
+                    self.headers)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            self.send_response(status)
+            for header in headers:
+                self.send_header(*header)
+            if status != HTTPStatus.NOT_MODIFIED:
+                self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif url.path == '/metrics':
+            content = metrics.REGISTRY.render()
+            self.send_response(200)
+            self.send_header('Content-Type', metrics.CONTENT_TYPE)
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif url.path == '/live.ws' and live is not None:
+            accept = websocket_accept(self.headers)
+            if accept is None:
+                self.send_error(400, 'Not a WebSocket request')
+                return
+            with self.server.client() as admitted:
+                if admitted:
+                    self.stream_live(accept)
+                else:
+                    self.send_error(503)
+        elif url.path == '/stream.mjpg' and size:
+            with self.server.client() as admitted:
+                if admitted:
+                    self.stream(size)
+                else:
+                    self.send_error(503)
         else:
             self.send_error(404)
             self.end_headers()
 
+    def stream_live(self, accept):
+        """Send the live view over the WebSocket until the client leaves."""
+        self.log_request(101)
+        self.wfile.write(websocket_response(accept))
+        sequence = 0
+        try:
+            with live_metrics() as (sent, skipped, sent_bytes):
+                sequence, fragments, _ = live.wait(sequence)
+                for part in live.intro():
+                    self.wfile.write(part)
+                while True:
+                    for fragment in fragments:
+                        self.wfile.write(websocket_header(len(fragment)))
+                        self.wfile.write(fragment)
+                        sent.inc()
+                        sent_bytes.inc(len(fragment))
+                    sequence, fragments, missed = live.wait(sequence)
+                    skipped.inc(missed)
+        except Exception as e:
+            logging.warning('Removed live view client %s: %s',
+                self.client_address, str(e))
+
+    def stream(self, size):
+        """Send the frames of a stream as MJPEG until the client leaves."""
+        self.send_response(200)
+        self.send_header('Age', 0)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
+        self.end_headers()
+        tiers = QualityTiers(size, outputs)
+        sequence = 0
+        missed = 0
+        try:
+            with client_metrics(size, self.client_address) as (
+                    sent, skipped, sent_bytes):
+                while True:
+                    with outputs[tiers.size].frame(sequence) as (latest, frame):
+                        if sequence:
+                            missed += latest - sequence - 1
+                            skipped.inc(latest - sequence - 1)
+                        sequence = latest
+                        backlog = socket_backlog(self.connection)
+                        started = monotonic()
+                        self.wfile.write(b'--FRAME\r\n')
+                        self.send_header('Content-Type', 'image/jpeg')
+                        self.send_header('Content-Length', len(frame))
+                        self.end_headers()
+                        self.wfile.write(frame)
+                        self.wfile.write(b'\r\n')
+                        sent.inc()
+                        sent_bytes.inc(len(frame))
+                        if tiers.observe(monotonic() - started, backlog,
+                                len(frame)):
+                            # Sequences differ between the streams
+                            sequence = 0
+        except Exception as e:
+            logging.warning(
+                'Removed streaming client %s (missed %d frames): %s',
+                self.client_address, missed, str(e))
+        finally:
+            tiers.close()
+
+def parse_headers(lines):
+    """Return the headers of a request as a dict with title-cased names."""
+    headers = {}
+    for line in lines.split('\r\n'):
+        name, colon, value = line.partition(':')
+        if colon:
+            headers[name.strip().title()] = value.strip()
+    return headers
+
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
 
-with picamera.PiCamera(resolution='1280x720', framerate=30) as camera:
-    output = StreamingOutput()
-    #Uncomment the next line to change your Pi's Camera rotation (in degrees)
-    #camera.rotation = 90
-    camera.start_recording(output, format='mjpeg')
+    def __init__(self, *args, max_clients=MAX_STREAM_CLIENTS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_clients = max_clients
+        self.clients = 0
+        self.clients_lock = Lock()
+
+    @contextmanager
+    def client(self):
+        """Count a streaming client, yielding False if there are too many."""
+        with self.clients_lock:
+            admitted = self.clients < self.max_clients
+            if admitted:
+                self.clients += 1
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                with self.clients_lock:
+                    self.clients -= 1
+
+class AsyncStreamingServer(object):
+    """Serve the pages and ``/stream.mjpg`` from a single asyncio loop.
+
+    Each client is one task. After a frame is handed to a client's transport
+    the task waits until the socket has taken all of it, then picks up the
+    newest frame, so a slow client skips frames instead of lagging behind.
+    """
+    def __init__(self, outputs, live=None, max_clients=MAX_STREAM_CLIENTS):
+        self.outputs = outputs
+        self.live = live
+        self.max_clients = max_clients
+        self.clients = 0
+        self._loop = None
+        self._frame_ready = {}
+        self._listeners = {}
+        self._live_ready = None
+
+    async def serve_forever(self, address):
+        self._loop = asyncio.get_running_loop()
+        for size, output in self.outputs.items():
+            self._frame_ready[size] = asyncio.Event()
+            self._listeners[size] = partial(self._notify, size)
+            output.listeners.append(self._listeners[size])
+        if self.live is not None:
+            self._live_ready = asyncio.Event()
+            self.live.listeners.append(self._notify_live)
+        try:
+            srv = await asyncio.start_server(self.handle, *address,
+                reuse_address=True)
+            async with srv:
+                await srv.serve_forever()
+        finally:
+            for size, output in self.outputs.items():
+                output.listeners.remove(self._listeners[size])
+            if self.live is not None:
+                self.live.listeners.remove(self._notify_live)
+
+    def _notify(self, size):
+        # Called from the camera thread for every new frame
+        self._loop.call_soon_threadsafe(self._on_frame, size)
+
+    def _on_frame(self, size):
+        self._frame_ready[size].set()
+        self._frame_ready[size] = asyncio.Event()
+
+    def _notify_live(self):
+        self._loop.call_soon_threadsafe(self._on_fragment)
+
+    def _on_fragment(self):
+        self._live_ready.set()
+        self._live_ready = asyncio.Event()
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            request_line, _, header_lines = request.decode('latin-1').partition('\r\n')
+            url = urlsplit(request_line.split(' ', 2)[1])
+            size = requested_size(url.query)
+            if url.path == '/':
+                await self.respond(writer, '301 Moved Permanently',
+                    [('Location', '/index.html')])
+            elif url.path == '/index.html' and size:
+                await self.respond(writer, '200 OK',
+                    [('Content-Type', 'text/html')], render_page(size))
+            elif url.path == '/history':
+                try:
+                    content = await asyncio.get_running_loop().run_in_executor(
+                        None, history_response, url.query)
+                except ValueError:
+                    await self.respond(writer, '400 Bad Request')
+                else:
+                    await self.respond(writer, '200 OK',
+                        [('Content-Type', 'application/json')], content)
+            elif url.path == '/snapshot.jpg' and size:
+                try:
+                    status, headers, content = snapshot_response(size,
+                        url.query, parse_headers(header_lines))
+                except ValueError:
+                    await self.respond(writer, '400 Bad Request')
+                else:
+                    await self.respond(writer,
+                        '%d %s' % (status, status.phrase), headers, content)
+            elif url.path == '/metrics':
+                await self.respond(writer, '200 OK',
+                    [('Content-Type', metrics.CONTENT_TYPE)],
+                    metrics.REGISTRY.render())
+            elif url.path == '/stream.mjpg' and size:
+                if self.clients >= self.max_clients:
+                    await self.respond(writer, '503 Service Unavailable')
+                else:
+                    await self.stream(writer, size)
+            elif url.path == '/live.ws' and self.live is not None:
+                accept = websocket_accept(parse_headers(header_lines))
+                if accept is None:
+                    await self.respond(writer, '400 Bad Request')
+                elif self.clients >= self.max_clients:
+                    await self.respond(writer, '503 Service Unavailable')
+                else:
+                    await self.stream_live(writer, accept)
+            else:
+                await self.respond(writer, '404 Not Found')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                IndexError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, headers=(), content=b''):
+        head = ['HTTP/1.0 %s' % status]
+        if not status.startswith('304'):
+            head.append('Content-Length: %d' % len(content))
+        head.extend('%s: %s' % header for header in headers)
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        writer.write(content)
+        await writer.drain()
+
+    async def stream(self, writer, size):
+        # Let drain() return only once the transport buffer is empty, so the
+        # frame's slot is no longer referenced when the pin is released.
+        writer.transport.set_write_buffer_limits(high=0)
+        writer.write(
+            b'HTTP/1.0 200 OK\r\n'
+            b'Age: 0\r\n'
+            b'Cache-Control: no-cache, private\r\n'
+            b'Pragma: no-cache\r\n'
+            b'Content-Type: multipart/x-mixed-replace; boundary=FRAME\r\n'
+            b'\r\n')
+        client = writer.get_extra_info('peername')
+        sock = writer.get_extra_info('socket')
+        tiers = QualityTiers(size, self.outputs)
+        self.clients += 1
+        sequence = 0
+        missed = 0
+        try:
+            with client_metrics(size, client) as (sent, skipped, sent_bytes):
+                while True:
+                    output = self.outputs[tiers.size]
+                    frame_ready = self._frame_ready[tiers.size]
+                    if output.sequence <= sequence:
+                        await frame_ready.wait()
+                    with output.frame(sequence) as (latest, frame):
+                        if sequence:
+                            missed += latest - sequence - 1
+                            skipped.inc(latest - sequence - 1)
+                        sequence = latest
+                        backlog = socket_backlog(sock)
+                        started = monotonic()
+                        writer.write(
+                            b'--FRAME\r\n'
+                            b'Content-Type: image/jpeg\r\n'
+                            b'Content-Length: %d\r\n\r\n' % len(frame))
+                        writer.write(frame)
+                        writer.write(b'\r\n')
+                        await asyncio.wait_for(writer.drain(), STREAM_SEND_TIMEOUT)
+                        sent.inc()
+                        sent_bytes.inc(len(frame))
+                        if tiers.observe(monotonic() - started, backlog,
+                                len(frame)):
+                            # Sequences differ between the streams
+                            sequence = 0
+        except Exception as e:
+            logging.warning(
+                'Removed streaming client %s (missed %d frames): %s',
+                client, missed, str(e))
+        finally:
+            tiers.close()
+            self.clients -= 1
+
+    async def stream_live(self, writer, accept):
+        # Fragments are immutable, so unlike frames they can stay queued in
+        # the transport. A client still draining them when the next ones are
+        # due falls behind and skips to a keyframe.
+        writer.write(websocket_response(accept))
+        client = writer.get_extra_info('peername')
+        self.clients += 1
+        sequence = 0
+        try:
+            with live_metrics() as (sent, skipped, sent_bytes):
+                while True:
+                    live_ready = self._live_ready
+                    if self.live.sequence <= sequence:
+                        await live_ready.wait()
+                        continue
+                    if not sequence:
+                        writer.writelines(self.live.intro())
+                    sequence, fragments, missed = self.live.since(sequence)
+                    skipped.inc(missed)
+                    for fragment in fragments:
+                        writer.write(websocket_header(len(fragment)))
+                        writer.write(fragment)
+                    await asyncio.wait_for(writer.drain(), STREAM_SEND_TIMEOUT)
+                    sent.inc(len(fragments))
+                    sent_bytes.inc(sum(len(fragment) for fragment in fragments))
+        except Exception as e:
+            logging.warning('Removed live view client %s: %s', client, str(e))
+        finally:
+            self.clients -= 1
+
+@contextmanager
+def record(detector, live):
+    """Record the streams, the motion detector's frames and the live view
+    from the camera."""
+    with PiCamera(resolution=RESOLUTION, framerate=FRAMERATE) as camera:
+        #Uncomment the next line to change your Pi's Camera rotation (in degrees)
+        #camera.rotation = 90
+        ports = []
+        for port, (size, output) in enumerate(outputs.items()):
+            quality = stream_quality(size)
+            options = {'quality': quality} if quality else {}
+            camera.start_recording(output, format='mjpeg',
+                splitter_port=port, resize=parse_size(size) if port else None,
+                **options)
+            ports.append(port)
+        if detector is not None:
+            camera.start_recording(detector, format='yuv',
+                splitter_port=len(ports), resize=MOTION_SIZE)
+            ports.append(len(ports))
+        if live is not None:
+            camera.start_recording(live, format='h264',
+                splitter_port=len(ports), bitrate=LIVE_BITRATE,
+                intra_period=FRAMERATE * LIVE_KEYFRAME_INTERVAL,
+                inline_headers=True)
+            ports.append(len(ports))
+        try:
+            yield
+        finally:
+            for port in ports:
+                camera.stop_recording(splitter_port=port)
+
+@contextmanager
+def follow_broker(detector, live):
+    """Take the streams, the motion detector's frames and the live view
+    from the rings of the camera broker."""
+    targets = [(broker.follow, broker.ring_name('mjpeg', size), output.write)
+               for size, output in outputs.items()]
+    if detector is not None:
+        targets.append((broker.follow, broker.ring_name('yuv', MOTION_SIZE),
+            detector.write))
+    if live is not None:
+        # The broker's H.264 recording, whose settings are the broker's
+        targets.append((broker.follow_stream,
+            broker.ring_name('h264', RESOLUTION), live.write))
+    stop = Event()
+    threads = [Thread(target=follow, args=(name, write, stop), daemon=True)
+               for follow, name, write in targets]
+    for thread in threads:
+        thread.start()
     try:
-        address = ('', 80)
-        server = StreamingServer(address, StreamingHandler)
-        server.serve_forever()
+        yield
     finally:
-        camera.stop_recording()
\ No newline at end of file
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def main():
+    global live
+    for size in [RESOLUTION] + STREAM_SIZES:
+        outputs[size] = StreamingOutput(handoff=FRAME_HANDOFF.labels(size))
+    detector = None
+    if MOTION_DETECTION:
+        MOTION.set(1)
+        detector = MotionDetector(outputs)
+    if LIVE_H264:
+        live = LiveOutput(RESOLUTION)
+    source = follow_broker if CAMERA_BROKER else record
+    with source(detector, live):
+        address = ('', 80)
+        if STREAM_MODE == 'asyncio':
+            asyncio.run(AsyncStreamingServer(outputs, live).serve_forever(
+                address))
+        else:
+            server = StreamingServer(address, StreamingHandler)
+            server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""Append-only binary time-series store for sensor readings and waterings.
+
+Every record is a fixed-width ``(timestamp, zone, value)`` struct. Records are
+appended to in-memory pages and written out together at most every
+``flush_interval`` seconds, so the SD card sees one write per interval
+instead of one per reading. The files are split into segments covering
+``segment_duration`` seconds each, named after their start time, and
+segments older than ``retention`` are deleted.
+
+Records are kept sorted by time: they are sorted when they are written, and a
+record older than the end of its segment, e.g. from a watering stamped with
+its start or after the clock was set back, is merged into the segment.
+Readers memory-map the segments overlapping a time range and bisect to its
+start, so a query only touches the records it returns. ``query`` downsamples
+a range into buckets and caches the result until one of the segments it read
+changes, so clients polling the same range do not scan it again.
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from collections import OrderedDict
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# Timestamp in seconds, zone, value
+RECORD = struct.Struct('<IHf')
+# Records per in-memory page
+PAGE_RECORDS = 512
+# Seconds buffered records may wait before they are written
+FLUSH_INTERVAL = 60
+# Seconds of history per segment file
+SEGMENT_DURATION = 7 * 24 * 3600
+# Seconds of history kept
+RETENTION = 2 * 365 * 24 * 3600
+SEGMENT_SUFFIX = '.tsr'
+# Downsampled query results kept per store
+QUERY_CACHE_SIZE = 32
+
+
+class _Timestamps(object):
+    """Sequence view of the timestamps of a buffer of records, for bisect."""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return len(self.buffer) // RECORD.size
+
+    def __getitem__(self, index):
+        return int.from_bytes(
+            self.buffer[index * RECORD.size:index * RECORD.size + 4], 'little')
+
+
+def sort_records(buffer):
+    """Return the records of ``buffer`` sorted by timestamp, records with the
+    same timestamp in their order."""
+    timestamps = _Timestamps(buffer)
+    if all(timestamps[index - 1] <= timestamps[index]
+           for index in range(1, len(timestamps))):
+        return buffer
+    size = RECORD.size
+    records = sorted((buffer[index * size:(index + 1) * size]
+                      for index in range(len(timestamps))),
+                     key=lambda record: int.from_bytes(record[:4], 'little'))
+    return b''.join(records)
+
+
+def scan_buffer(buffer, start, end, zone=None):
+    """Yield the records of ``buffer`` with ``start <= timestamp < end``.
+
+    The records must be sorted by timestamp, see ``sort_records``.
+    """
+    timestamps = _Timestamps(buffer)
+    first = bisect.bisect_left(timestamps, start)
+    last = bisect.bisect_left(timestamps, end, first)
+    for record in RECORD.iter_unpack(
+            buffer[first * RECORD.size:last * RECORD.size]):
+        if zone is None or record[1] == zone:
+            yield record
+
+
+def downsample(records, start, step):
+    """Summarize records per zone into buckets of ``step`` seconds.
+
+    Returns a list of dicts with the bucket's start ``time``, ``zone``,
+    ``count``, ``sum``, ``min``, ``max`` and ``mean``, ordered by time.
+    """
+    buckets = {}
+    for timestamp, zone, value in records:
+        key = ((timestamp - start) // step, zone)
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [1, value, value, value]
+        else:
+            bucket[0] += 1
+            bucket[1] += value
+            if value < bucket[2]:
+                bucket[2] = value
+            elif value > bucket[3]:
+                bucket[3] = value
+    return [{
+        'time': start + index * step,
+        'zone': zone,
+        'count': count,
+        'sum': total,
+        'min': low,
+        'max': high,
+        'mean': total / count,
+    } for (index, zone), (count, total, low, high) in sorted(buckets.items())]
+
+
+class TimeSeriesStore(object):
+    """Buffered writer and reader of the segments of one series.
+
+    ``append`` may be called from any thread. ``flush`` does the file I/O and
+    is meant to run in an executor, see ``schedule``.
+    """
+
+    def __init__(self, directory, name, flush_interval=FLUSH_INTERVAL,
+                 segment_duration=SEGMENT_DURATION, retention=RETENTION):
+        self.directory = directory
+        self.name = name
+        self.flush_interval = flush_interval
+        self.segment_duration = segment_duration
+        self.retention = retention
+        self._pages = []
+        self._page = bytearray(PAGE_RECORDS * RECORD.size)
+        self._count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def append(self, zone, value, timestamp=None):
+        """Buffer one record, stamped with the current time by default."""
+        if timestamp is None:
+            timestamp = time()
+        with self._lock:
+            RECORD.pack_into(self._page, self._count * RECORD.size,
+                int(timestamp), zone, value)
+            self._count += 1
+            if self._count == PAGE_RECORDS:
+                self._pages.append(self._page)
+                self._page = bytearray(PAGE_RECORDS * RECORD.size)
+                self._count = 0
+
+    def _take_buffered(self):
+        with self._lock:
+            pages = self._pages
+            pages.append(self._page[:self._count * RECORD.size])
+            self._pages = []
+            self._count = 0
+        return pages
+
+    def buffered(self):
+        """Return the records not written yet, as one buffer."""
+        with self._lock:
+            return b''.join(self._pages) + \
+                bytes(self._page[:self._count * RECORD.size])
+
+    def segment_path(self, segment_start):
+        return os.path.join(self.directory, '%s-%010d%s' % (
+            self.name, segment_start, SEGMENT_SUFFIX))
+
+    def segments(self):
+        """Return the ``(start, path)`` of the segments on disk, oldest first."""
+        prefix = self.name + '-'
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        segments = []
+        for name in names:
+            if name.startswith(prefix) and name.endswith(SEGMENT_SUFFIX):
+                start = name[len(prefix):-len(SEGMENT_SUFFIX)]
+                if start.isdigit():
+                    segments.append(
+                        (int(start), os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def flush(self):
+        """Write the buffered records to their segments and apply retention."""
+        with self._flush_lock:
+            data = sort_records(b''.join(self._take_buffered()))
+            if data:
+                os.makedirs(self.directory, exist_ok=True)
+                self._write(data)
+            self._expire()
+
+    def _write(self, data):
+        # Records are grouped by segment, so every file is opened once
+        duration = self.segment_duration
+        size = RECORD.size
+        offset = 0
+        while offset < len(data):
+            segment = RECORD.unpack_from(data, offset)[0] // duration * duration
+            end = offset + size
+            while end < len(data) and \
+                    RECORD.unpack_from(data, end)[0] // duration * duration == segment:
+                end += size
+            self._write_segment(self.segment_path(segment), data[offset:end])
+            offset = end
+
+    @staticmethod
+    def _write_segment(path, records):
+        with open(path, 'ab+') as segment_file:
+            length = segment_file.tell()
+            if length >= RECORD.size:
+                segment_file.seek(length - RECORD.size)
+                last = RECORD.unpack(segment_file.read(RECORD.size))[0]
+            else:
+                last = 0
+            if RECORD.unpack_from(records)[0] >= last:
+                segment_file.write(records)
+                return
+            segment_file.seek(0)
+            merged = sort_records(segment_file.read() + records)
+        # Rewritten aside, so readers mapping the segment keep a whole one
+        with open(path + '.tmp', 'wb') as merged_file:
+            merged_file.write(merged)
+        os.replace(path + '.tmp', path)
+
+    def _expire(self):
+        oldest = time() - self.retention
+        for start, path in self.segments():
+            if start + self.segment_duration > oldest:
+                break
+            logger.info('Removing expired history segment %s', path)
+            os.remove(path)
+
+    def _overlapping(self, start, end):
+        return [(segment_start, path) for segment_start, path in self.segments()
+                if segment_start < end and segment_start + self.segment_duration > start]
+
+    def scan(self, start, end, zone=None):
+        """Yield the ``(timestamp, zone, value)`` records in ``[start, end)``.
+
+        Includes the records that are still buffered.
+        """
+        for _, path in self._overlapping(start, end):
+            with open(path, 'rb') as segment_file:
+                if os.fstat(segment_file.fileno()).st_size < RECORD.size:
+                    continue
+                with mmap.mmap(segment_file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as segment:
+                    yield from scan_buffer(segment, start, end, zone)
+        yield from scan_buffer(sort_records(self.buffered()), start, end, zone)
+
+    def query(self, start, end, step, zone=None):
+        """Return ``downsample`` of the records in ``[start, end)``.
+
+        Segments only ever grow, so a cached result stays valid as long as
+        the sizes of the segments it covers and the buffered records are the
+        same.
+        """
+        version = []
+        for _, path in self._overlapping(start, end):
+            try:
+                version.append((path, os.stat(path).st_size))
+            except FileNotFoundError:
+                pass
+        version.append(len(self.buffered()))
+        key = (start, end, step, zone)
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == version:
+                self._cache.move_to_end(key)
+                return cached[1]
+        result = downsample(self.scan(start, end, zone), start, step)
+        with self._cache_lock:
+            self._cache[key] = (version, result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > QUERY_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def schedule(self, scheduler):
+        """Flush every ``flush_interval`` seconds from the bridge's
+        ``Scheduler``."""
+        return scheduler.every(self.flush_interval, self.flush,
+            delay=self.flush_interval, name='%s history flush' % self.name)